@@ -0,0 +1,181 @@
+"""
+Normalization of Russian address object types (see misc.RUSSIAN_ADDRESSES) in free text.
+
+Full names are abbreviated (or abbreviations expanded) in a single pass over the text by a trie compiled once
+from the table. Matching is case-insensitive, treats 'ё' as 'е' and any whitespace run as a single space,
+only whole words are replaced. Table entries with alternatives are expanded to all variants:
+    'Выселки(ок)' - 'Выселки' and 'Выселок', the suffix replaces the word ending
+    'Ж/д остановочный (обгонный) пункт' - standalone '(обгонный)' is an alternative to the previous word
+Short abbreviations are ambiguous in free text ('д' is both 'Деревня' and house), so expanding is intended
+for address type fields or addresses in the table's notation.
+
+Usage:
+    abbreviate_address('Московская обл, деревня Ивановка, улица Ленина')  # 'Московская обл, Д Ивановка, ул Ленина'
+    expand_address('ул. Ленина')  # 'Улица Ленина'
+    for address in AddressTypeNormalizer.get(ADDRESS_ABBREVIATE).normalize_many(lines): ...
+"""
+
+import re
+import itertools
+import threading
+from collections.abc import Iterable, Iterator
+
+# local imports
+from .misc import RUSSIAN_ADDRESSES
+
+ADDRESS_ABBREVIATE = 'abbreviate';  """replace full names of address types by abbreviations"""
+ADDRESS_EXPAND = 'expand';          """replace abbreviations (optionally followed by dot) by full names"""
+ADDRESS_WORD_CHARS = '/-_';         """characters other than letters and digits that do not break a word"""
+
+_TERMINAL = '';  """trie node key of the replacement, never clashes with a character"""
+_SUFFIX_RE = re.compile(r'^(\w.*)\((\w+)\)$')
+_ALTERNATIVE_RE = re.compile(r'^\((.+)\)$')
+
+
+def _fold(text: str) -> str:
+    """Case-insensitive form of the text of the same length."""
+    folded = text.lower()
+    if len(folded) != len(text):
+        folded = ''.join(x.lower()[:1] or x for x in text)
+    return folded.replace('ё', 'е')
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char in ADDRESS_WORD_CHARS
+
+
+def name_variants(name: str) -> list[str]:
+    """
+    Returns all spellings of the address type name from the table, the name without alternatives first.
+    E.g. 'Поселок и (при) станция(и)' => 'Поселок и станция', 'Поселок и станции', 'Поселок при станция', ...
+    """
+    words: list[list[str]] = []
+    for token in name.split():
+        if match := _ALTERNATIVE_RE.match(token):
+            if not words:
+                raise ValueError(f'alternative without preceding word: {name}')
+            words[-1].append(match[1])
+        elif match := _SUFFIX_RE.match(token):
+            word, suffix = match[1], match[2]
+            words.append([word, word[:-len(suffix)] + suffix])
+        else:
+            words.append([token])
+    return [' '.join(x) for x in itertools.product(*words)]
+
+
+class AddressTypeNormalizer:
+    _registry: dict[str, 'AddressTypeNormalizer'] = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, table: dict[str, str] = RUSSIAN_ADDRESSES, mode: str = ADDRESS_ABBREVIATE):
+        """
+        @param table: full names (possibly with alternatives) => abbreviations
+        @param mode: ADDRESS_ABBREVIATE or ADDRESS_EXPAND
+        """
+        if mode not in (ADDRESS_ABBREVIATE, ADDRESS_EXPAND):
+            raise ValueError(f'unknown mode: {mode}')
+        self.mode = mode
+        self._trie: dict = {}
+
+        replacements: dict[str, str] = {}
+        for name, abbreviation in table.items():
+            variants = name_variants(name)
+            if mode == ADDRESS_ABBREVIATE:
+                pairs = [(x, abbreviation) for x in variants]
+            else:
+                pairs = [(abbreviation, variants[0])]
+            for pattern, replacement in pairs:
+                key = ' '.join(_fold(pattern).split())
+                if replacements.setdefault(key, replacement) != replacement:
+                    raise ValueError(f'ambiguous address type "{pattern}": {replacements[key]} or {replacement}')
+
+        for key, replacement in replacements.items():
+            node = self._trie
+            for char in key:
+                node = node.setdefault(char, {})
+            node[_TERMINAL] = replacement
+
+        first_chars = ''.join(sorted(x for x in self._trie if x != _TERMINAL))
+        self._starts = re.compile(
+            rf'(?<![\w{re.escape(ADDRESS_WORD_CHARS)}])[{re.escape(first_chars)}]'
+        ) if first_chars else None
+
+    def __str__(self):
+        return f'AddressTypeNormalizer(mode={self.mode})'
+
+    @classmethod
+    def get(cls, mode: str = ADDRESS_ABBREVIATE) -> 'AddressTypeNormalizer':
+        """Returns process-wide normalizer for RUSSIAN_ADDRESSES in the given mode, compiled on first use."""
+        normalizer = cls._registry.get(mode)
+        if normalizer is None:
+            with cls._registry_lock:
+                normalizer = cls._registry.get(mode)
+                if normalizer is None:
+                    normalizer = cls._registry[mode] = cls(mode=mode)
+        return normalizer
+
+    def _match(self, folded: str, start: int) -> tuple[int, str | None]:
+        """Returns end and replacement of the longest whole word match starting at the position."""
+        node = self._trie
+        pos = start
+        size = len(folded)
+        best_end, best = start, None
+        while True:
+            replacement = node.get(_TERMINAL)
+            if replacement is not None:
+                if pos < size and folded[pos] == '.' and self.mode == ADDRESS_EXPAND:
+                    best_end, best = pos + 1, replacement
+                elif pos >= size or not _is_word_char(folded[pos]):
+                    best_end, best = pos, replacement
+            if pos >= size:
+                break
+            char = folded[pos]
+            if char.isspace():
+                node = node.get(' ')
+                while pos < size and folded[pos].isspace():
+                    pos += 1
+            else:
+                node = node.get(char)
+                pos += 1
+            if node is None:
+                break
+        return best_end, best
+
+    def normalize(self, text: str) -> str:
+        """Replaces address types in the text."""
+        if not text or self._starts is None:
+            return text
+        folded = _fold(text)
+        parts = []
+        last = 0
+        for match in self._starts.finditer(folded):
+            start = match.start()
+            if start < last:
+                continue
+            end, replacement = self._match(folded, start)
+            if replacement is not None:
+                parts.append(text[last:start])
+                parts.append(replacement)
+                if end < len(folded) and _is_word_char(folded[end]):
+                    parts.append(' ')  # consumed dot separated the next word: 'ул.Ленина'
+                last = end
+        if not parts:
+            return text
+        parts.append(text[last:])
+        return ''.join(parts)
+
+    def normalize_many(self, texts: Iterable[str]) -> Iterator[str]:
+        """Replaces address types in every text, consuming texts lazily."""
+        normalize = self.normalize
+        for text in texts:
+            yield normalize(text)
+
+
+def abbreviate_address(text: str) -> str:
+    """Replaces full names of address types in the text by abbreviations."""
+    return AddressTypeNormalizer.get(ADDRESS_ABBREVIATE).normalize(text)
+
+
+def expand_address(text: str) -> str:
+    """Replaces abbreviations of address types in the text by full names."""
+    return AddressTypeNormalizer.get(ADDRESS_EXPAND).normalize(text)
@@ -1,10 +1,11 @@
 from django.contrib import admin
 
 # local imports
-from .models import SemaphoreRecord, TaskHandle, LogEntry
+from .models import SemaphoreRecord, CircuitBreakerRecord, TaskHandle, LogEntry
 
 
 DB_LOG_ENTRY_ADMIN_LIST_PER_PAGE = 200
+TASK_HANDLE_ADMIN_LIST_PER_PAGE = 200
 
 
 @admin.register(SemaphoreRecord)
@@ -12,11 +13,19 @@ class SemaphoreRecordAdmin(admin.ModelAdmin):
     list_display = ['key', 'timeout', 'pinged', 'locked', 'modified']
 
 
+@admin.register(CircuitBreakerRecord)
+class CircuitBreakerRecordAdmin(admin.ModelAdmin):
+    list_display = ['name', 'state', 'opened_at', 'modified']
+
+
 @admin.register(TaskHandle)
 class TaskHandleAdmin(admin.ModelAdmin):
     list_display = [
         'id', 'task_id', 'ormq_id', '_prev', '_next', '_try', 'cancel_requested', '_created', '_updated'
     ]
+    ordering = ('-created_at', )
+    list_per_page = TASK_HANDLE_ADMIN_LIST_PER_PAGE
+    show_full_result_count = False  # avoid full table count on filtered pages
 
     @admin.display(description='Prev')
     def _prev(self, obj):
@@ -0,0 +1,166 @@
+"""
+Archival and pruning of completed Task Handle retry chains.
+
+Task Handles of the retry chain reference each other via prev/next foreign keys with CASCADE deletes,
+so deleting them with ORM cascades recursively. Here finished chains are selected in bounded chunks,
+optionally dumped to gzip-compressed JSONL file (one line per chain), and deleted with a single
+DELETE statement per chunk, bypassing the cascade collector.
+
+Usage, e.g. as Django-Q scheduled task:
+    archive_task_handles(older_than_days=30, dump_path='/var/backups/task_handles.jsonl.gz')
+"""
+
+import gzip
+import json
+import datetime
+import logging
+from django.db import connection, transaction
+from django.db.models import Q
+from django.core.serializers.json import DjangoJSONEncoder
+from django_q.models import Task, OrmQ
+
+# local imports
+from .dateutils import local_now_tz_aware
+from .models import TaskHandle
+
+log = logging.getLogger(__name__)
+
+ARCHIVE_CHUNK_SIZE_DEFAULT = 500;        """default number of chains processed in a single chunk"""
+ARCHIVE_PRUNED_GRACE_DAYS_DEFAULT = 1.0;  """default age of the last try with pruned Task record to count as finished"""
+
+
+def _collect_chains(roots: list[TaskHandle]) -> dict[int, list[dict]]:
+    """
+    Collects all Task Handles of the retry chains starting from given root handles.
+    @param roots: first Task Handles of the retry chains
+    @return: dictionary root handle ID => list of Task Handle values ordered by try number
+    """
+    fields = [f.attname for f in TaskHandle._meta.concrete_fields]
+    chains = {}
+    root_of = {}
+    for root in roots:
+        chains[root.id] = [{x: getattr(root, x) for x in fields}]
+        root_of[root.id] = root.id
+
+    # walk the chains level by level: one query per try number, not per handle
+    level_ids = list(chains)
+    while level_ids:
+        next_level = list(TaskHandle.objects.filter(prev_id__in=level_ids).values(*fields))
+        level_ids = []
+        for values in next_level:
+            root_id = root_of[values['prev_id']]
+            root_of[values['id']] = root_id
+            chains[root_id].append(values)
+            level_ids.append(values['id'])
+
+    return chains
+
+
+def _is_pruned(tail: dict, stopped: dict, queued_ormq_ids: set, pruned_before: datetime.datetime) -> bool:
+    """
+    Last try has no Task record since Django-Q pruned it: it was queued in ORM broker, is gone from the queue
+    and is older than the grace period. Tries without ormq_id (other brokers) or not started yet are not pruned.
+    """
+    return (
+        tail['task_id'] not in stopped and tail['ormq_id'] is not None and tail['ormq_id'] not in queued_ormq_ids
+        and tail['created_at'] < pruned_before
+    )
+
+
+def _finished_task_ids(tails: list[dict], pruned_before: datetime.datetime) -> set[str]:
+    """
+    Returns task IDs of the given last tries completed by Django-Q: having stopped Task record, or having
+    Task record pruned (see _is_pruned) - Django-Q prunes successful tasks beyond Q_CLUSTER save_limit.
+    """
+    task_ids = [x['task_id'] for x in tails]
+    stopped = dict(Task.objects.filter(id__in=task_ids).values_list('id', 'stopped'))
+    queued_ormq_ids = set(
+        OrmQ.objects.filter(id__in=[x['ormq_id'] for x in tails if x['ormq_id']]).values_list('id', flat=True)
+    )
+    return {
+        x['task_id'] for x in tails
+        if stopped.get(x['task_id']) is not None or _is_pruned(x, stopped, queued_ormq_ids, pruned_before)
+    }
+
+
+def _chain_is_finished(chain: list[dict], finished_task_ids: set[str], cutoff: datetime.datetime) -> bool:
+    """Chain is finished if its last try is completed by Django-Q and all tries are older than cutoff."""
+    tail = chain[-1]
+    return tail['next_id'] is None and tail['task_id'] in finished_task_ids and tail['created_at'] < cutoff
+
+
+def _delete_handles(ids: list[int]) -> None:
+    """Deletes Task Handles with a single statement. Chains are deleted entirely, so no dangling references left."""
+    table = connection.ops.quote_name(TaskHandle._meta.db_table)
+    placeholders = ', '.join(['%s'] * len(ids))
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {table} WHERE id IN ({placeholders})', ids)
+
+
+def archive_task_handles(
+        older_than_days: float,
+        dump_path: str = None,
+        chunk_size: int = ARCHIVE_CHUNK_SIZE_DEFAULT,
+        max_chunks: int = None,
+        pruned_grace_days: float = ARCHIVE_PRUNED_GRACE_DAYS_DEFAULT
+) -> int:
+    """
+    Archives and deletes finished Task Handle retry chains older than given number of days.
+
+    @param older_than_days: only chains with all tries created before this number of days ago are processed
+    @param dump_path: if given, chains are appended to this gzip-compressed JSONL file before deletion
+    @param chunk_size: number of chains processed in a single chunk (and transaction)
+    @param max_chunks: stop after this number of chunks; None - process all
+    @param pruned_grace_days: last try queued in ORM broker, gone from the queue and having no Task record
+        counts as finished only if created before this number of days ago
+    @return: number of Task Handles deleted
+    """
+    if chunk_size <= 0:
+        raise ValueError('chunk_size must be positive integer')
+
+    now = local_now_tz_aware()
+    cutoff = now - datetime.timedelta(days=older_than_days)
+    pruned_before = now - datetime.timedelta(days=pruned_grace_days)
+    roots_qs = TaskHandle.objects.filter(prev__isnull=True, created_at__lt=cutoff).order_by('created_at', 'id')
+    dump_file = gzip.open(dump_path, 'at', encoding='utf-8') if dump_path else None
+    deleted_total = 0
+    chunk_num = 0
+    last_root = None
+
+    try:
+        while max_chunks is None or chunk_num < max_chunks:
+            # keyset pagination over created_at index: unfinished chains are skipped, not re-read
+            qs = roots_qs
+            if last_root:
+                qs = qs.filter(
+                    Q(created_at__gt=last_root.created_at) | Q(created_at=last_root.created_at, id__gt=last_root.id)
+                )
+            roots = list(qs[:chunk_size])
+            if not roots:
+                break
+            last_root = roots[-1]
+            chunk_num += 1
+
+            chains = _collect_chains(roots)
+            finished_task_ids = _finished_task_ids([x[-1] for x in chains.values()], pruned_before)
+            finished = [x for x in chains.values() if _chain_is_finished(x, finished_task_ids, cutoff)]
+            if not finished:
+                continue
+
+            ids = [handle['id'] for chain in finished for handle in chain]
+            with transaction.atomic():
+                if dump_file:
+                    for chain in finished:
+                        dump_file.write(json.dumps(chain, cls=DjangoJSONEncoder, ensure_ascii=False))
+                        dump_file.write('\n')
+                    dump_file.flush()
+                _delete_handles(ids)
+
+            deleted_total += len(ids)
+            log.info(f'archived {len(finished)} task handle chains, {len(ids)} task handles deleted')
+
+    finally:
+        if dump_file:
+            dump_file.close()
+
+    return deleted_total
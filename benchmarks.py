@@ -0,0 +1,374 @@
+"""
+Benchmarks of the helpers hot paths against the implementations they replaced.
+Do not require Django settings, except database ones (bulk). Run from the project directory:
+    python -m helpers.benchmarks            # all benchmarks
+    python -m helpers.benchmarks json ...   # selected benchmarks
+    DJANGO_SETTINGS_MODULE=project.settings python -m helpers.benchmarks bulk
+"""
+
+import os
+import re
+import sys
+import random
+import datetime
+import time
+import timeit
+import tracemalloc
+from typing import Any
+from decimal import Decimal
+import simplejson
+
+# local imports
+from .misc import json_dumps, json_dumps_bytes, _json_serial, SimplejsonBackend, OrjsonBackend
+from .misc import _compact_pickled_data, MAX_WIDTH_COMPACTED_VALUE, todict, RUSSIAN_ADDRESSES
+from .misc import FrozenClass, frozen_slots
+from .addresses import AddressTypeNormalizer, ADDRESS_ABBREVIATE, name_variants
+
+BENCHMARK_REPEAT = 5;  """number of measurements, the best one is reported"""
+
+
+def _measure(func: callable, number: int = 1) -> float:
+    """Returns the best time of a single call, in seconds."""
+    return min(timeit.repeat(func, number=number, repeat=BENCHMARK_REPEAT)) / number
+
+
+def _report(title: str, baseline: float, optimized: float):
+    print(f'{title:<48} {baseline*1000:>10.3f} ms {optimized*1000:>10.3f} ms {baseline/optimized:>8.1f}x')
+
+
+def _json_payload(rows: int = 20000, seed: int = 1) -> list[dict]:
+    """API-like result set: decimals, timestamps, unicode strings, nested lists."""
+    rng = random.Random(seed)
+    now = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    return [
+        {
+            'id': x,
+            'name': f'Позиция №{x}',
+            'price': Decimal(rng.randint(1, 10**7)) / 100,
+            'qty': rng.randint(0, 1000),
+            'created_at': now + datetime.timedelta(seconds=x),
+            'tags': [f'tag{rng.randint(0, 50)}' for _ in range(3)],
+            'active': bool(x % 2),
+        }
+        for x in range(rows)
+    ]
+
+
+def bench_json():
+    payload = _json_payload()
+
+    def legacy_dumps():
+        return simplejson.dumps(payload, indent=True, ensure_ascii=False, use_decimal=True, default=_json_serial)
+
+    legacy = legacy_dumps()
+    _report('json_dumps: indented simplejson -> compact', _measure(legacy_dumps), _measure(
+        lambda: json_dumps(payload, compact=True)
+    ))
+    _report('json_dumps: indented simplejson -> bytes', _measure(
+        lambda: legacy_dumps().encode()
+    ), _measure(lambda: json_dumps_bytes(payload)))
+
+    simplejson_backend, orjson_backend = SimplejsonBackend(), OrjsonBackend()
+    _report('json_dumps: indented simplejson -> orjson', _measure(
+        lambda: simplejson_backend.dumps(payload, compact=False)
+    ), _measure(lambda: orjson_backend.dumps(payload, compact=False)))
+
+    # like for like: the same use_decimal on both sides, the baseline is json_loads of simplejson
+    compact = json_dumps_bytes(payload)
+    for use_decimal in (False, True):
+        _report(f'json_loads: {"Decimal" if use_decimal else "float"} simplejson -> orjson', _measure(
+            lambda: simplejson_backend.loads(compact, use_decimal)
+        ), _measure(lambda: orjson_backend.loads(compact, use_decimal)))
+
+
+def _legacy_compact_pickled_data(data: Any, remove_special: bool = True, remove_protected: bool = False) -> Any:
+    """Recursive implementation replaced by misc._compact_pickled_data, kept as the baseline."""
+
+    def _value_is_empty(_val: Any) -> bool:
+        return _val is None or _val in ('', 'none', 'null',) or _val == [] or _val == {}
+
+    if isinstance(data, list):
+        # compact every element of the list and remove empty elements
+        data = [
+            _legacy_compact_pickled_data(x, remove_special=remove_special, remove_protected=remove_protected)
+            for x in data
+        ]
+        data = [x for x in data if not _value_is_empty(x)]
+
+    if isinstance(data, list) and len(data) == 1:
+        # convert list to single value
+        return data[0]
+
+    if isinstance(data, list) and len(data) <= 8 and all(not isinstance(x, dict | list) for x in data):
+        # convert list to comma delimited string if short enough
+        compacted = ', '.join([str(x) for x in data])
+        return compacted if len(compacted) < MAX_WIDTH_COMPACTED_VALUE else data
+
+    if isinstance(data, dict):
+        # compact every element of the dictionary and remove elements with empty or special/protected values
+        compacted = {}
+        for key, value in data.items():
+            value = _legacy_compact_pickled_data(
+                value, remove_special=remove_special, remove_protected=remove_protected
+            )
+            if _value_is_empty(value):
+                continue
+            if remove_protected and key.startswith('_'):
+                continue
+            if remove_special and key in ('py/object', 'py/function', 'py/type',):
+                continue
+            compacted[key] = value
+        data = compacted
+
+    if isinstance(data, dict) and len(data) == 1:
+        # collapse dict with inner dict if latter has single element
+        key, val = list(data.items())[0]
+        if isinstance(val, dict) and len(val) == 1:
+            key_inner, val_inner = list(val.items())[0]
+            data = {f'{key}=>{key_inner}': val_inner}
+
+    if isinstance(data, dict) and len(data) <= 8 and all(not isinstance(x, dict | list) for x in data.values()):
+        # convert list to comma delimited string with key=value pairs if short enough
+        tokens = []
+        for key, val in data.items():
+            tokens.append(f'{key}={val}')
+        compacted = ', '.join(tokens)
+        return compacted if len(compacted) < MAX_WIDTH_COMPACTED_VALUE else data
+
+    return data if not _value_is_empty(data) else None
+
+
+def _compact_corpus(objects: int = 200, seed: int = 1) -> list:
+    """Debug info as flattened by jsonpickle: objects with nested state, short and long lists, empty values."""
+    rng = random.Random(seed)
+
+    def _object(depth: int) -> dict:
+        obj = {
+            'py/object': 'app.models.Order',
+            'id': rng.randint(1, 10**6),
+            'name': f'Заказ №{rng.randint(1, 10**4)}',
+            'comment': rng.choice([None, '', 'none', 'x' * rng.randint(1, 200)]),
+            '_state': {'py/object': 'django.db.models.base.ModelState', 'db': 'default', 'adding': False},
+            'amounts': [str(Decimal(rng.randint(1, 10**6)) / 100) for _ in range(rng.randint(0, 12))],
+            'tags': {'py/tuple': [f'tag{rng.randint(0, 50)}' for _ in range(rng.randint(0, 4))]},
+            'extra': {},
+        }
+        if depth < 3:
+            obj['items'] = [_object(depth + 1) for _ in range(rng.randint(0, 3))]
+        return obj
+
+    return [_object(0) for _ in range(objects)]
+
+
+def bench_compact():
+    corpus = _compact_corpus()
+    assert _legacy_compact_pickled_data(corpus) == _compact_pickled_data(corpus)
+    _report('_compact_pickled_data: recursive -> iterative', _measure(
+        lambda: _legacy_compact_pickled_data(corpus)
+    ), _measure(lambda: _compact_pickled_data(corpus)))
+    # truncated output is not comparable with the full one, so no baseline and no speedup
+    truncated = _measure(lambda: _compact_pickled_data(corpus, max_output=1000))
+    print(f'{"_compact_pickled_data: max_output=1000":<48} {"-":>13} {truncated*1000:>10.3f} ms')
+
+    deep = ['x' * MAX_WIDTH_COMPACTED_VALUE]
+    for num in range(5000):
+        deep = {'py/object': 'app.Node', 'num': num, 'next': deep}
+    start = time.perf_counter()
+    _compact_pickled_data(deep)
+    print(f'{"_compact_pickled_data: 5000 levels deep":<48} {"RecursionError":>13} '
+          f'{(time.perf_counter() - start)*1000:>10.3f} ms')
+
+
+def _legacy_todict(obj, class_key=None):
+    """Implementation replaced by misc.todict, kept as the baseline."""
+    if isinstance(obj, dict):
+        data = {}
+        for (k, v) in obj.items():
+            data[k] = _legacy_todict(v, class_key)
+        return data
+    elif hasattr(obj, '_ast'):
+        # noinspection PyProtectedMember
+        return _legacy_todict(obj._ast())
+    elif hasattr(obj, '__iter__') and not isinstance(obj, str):
+        return [_legacy_todict(v, class_key) for v in obj]
+    elif hasattr(obj, '__dict__'):
+        data = dict([
+            (key, _legacy_todict(value, class_key)) for key, value in obj.__dict__.items()
+            if not callable(value) and not key.startswith('_')
+        ])
+        if class_key is not None and hasattr(obj, "__class__"):
+            data[class_key] = obj.__class__.__name__
+        return data
+    elif isinstance(obj, datetime.datetime):
+        return obj.strftime("%Y-%m-%d %H:%M:%S%z")
+    else:
+        return obj
+
+
+class _TodictRow:
+    def __init__(self, num: int):
+        self.id = num
+        self.name = f'row {num}'
+        self.price = Decimal(num) / 100
+        self.created_at = datetime.datetime(2024, 1, 1) + datetime.timedelta(seconds=num)
+        self.tags = [f'tag{num % 7}', f'tag{num % 11}']
+        self.attrs = {'a': num, 'b': None}
+        self._cache = {}
+
+
+def bench_todict():
+    rows = [_TodictRow(x) for x in range(20000)]
+    assert _legacy_todict(rows, 'class') == todict(rows, 'class')
+    _report('todict: isinstance/hasattr chain -> plans', _measure(
+        lambda: _legacy_todict(rows, 'class')
+    ), _measure(lambda: todict(rows, 'class')))
+
+
+def _addresses(rows: int = 20000, seed: int = 1) -> list[str]:
+    """Address file lines: region, settlement and street with full type names in different cases."""
+    rng = random.Random(seed)
+    settlements = ['деревня', 'Село', 'ПОСЕЛОК СЕЛЬСКОГО ТИПА', 'Хутор', 'Выселок', 'Поселок при станции']
+    streets = ['улица', 'Переулок', 'проспект', 'Шоссе', 'бульвар', 'Тупик', 'Микрорайон', 'набережная']
+    names = ['Ленина', 'Советская', 'Мира', 'Центральная', 'Школьная', 'Садовая', 'Лесная', 'Ёлочная']
+    return [
+        f'{rng.randint(100000, 999999)}, Московская обл, {rng.choice(settlements)} {rng.choice(names)}, '
+        f'{rng.choice(streets)} {rng.choice(names)}, д {rng.randint(1, 200)}'
+        for _ in range(rows)
+    ]
+
+
+def bench_addresses():
+    lines = _addresses()
+    patterns = []
+    for name, abbr in RUSSIAN_ADDRESSES.items():
+        for variant in sorted(name_variants(name), key=len, reverse=True):
+            pattern = r'(?<![\w/-])' + re.escape(variant).replace(r'\ ', r'\s+') + r'(?![\w/-])'
+            patterns.append((re.compile(pattern, re.IGNORECASE), abbr))
+
+    def legacy_normalize():
+        result = []
+        for line in lines:
+            for pattern, abbr in patterns:
+                line = pattern.sub(abbr, line)
+            result.append(line)
+        return result
+
+    normalizer = AddressTypeNormalizer.get(ADDRESS_ABBREVIATE)
+    _report('addresses: per-row regex loop -> trie', _measure(legacy_normalize), _measure(
+        lambda: list(normalizer.normalize_many(lines))
+    ))
+
+
+class _FrozenValue(FrozenClass):
+    def __init__(self, code: str, amount: Decimal, qty: int):
+        self.code = code
+        self.amount = amount
+        self.qty = qty
+        self.freeze()
+
+
+@frozen_slots
+class _SlotsValue:
+    code: str
+    amount: Decimal
+    qty: int
+
+
+@frozen_slots(immutable=True)
+class _ImmutableValue:
+    code: str
+    amount: Decimal
+    qty: int
+
+
+def _memory_per_instance(factory: callable, number: int = 100000) -> float:
+    tracemalloc.start()
+    objects = [factory(x) for x in range(number)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return size / number
+
+
+def bench_frozen(number: int = 100000):
+    amount = Decimal('1.50')
+    for title, cls in (('slots', _SlotsValue), ('immutable', _ImmutableValue)):
+        _report(f'FrozenClass -> {title}: create x{number}', _measure(
+            lambda: [_FrozenValue('code', amount, x) for x in range(number)]
+        ), _measure(lambda: [cls('code', amount, x) for x in range(number)]))
+        baseline = _memory_per_instance(lambda x: _FrozenValue('code', amount, x), number)
+        optimized = _memory_per_instance(lambda x: cls('code', amount, x), number)
+        print(f'{f"FrozenClass -> {title}: bytes per instance":<48} {baseline:>13.1f} {optimized:>13.1f} '
+              f'{baseline/optimized:>8.1f}x')
+
+    frozen, slots = _FrozenValue('code', amount, 1), _SlotsValue('code', amount, 1)
+
+    def _set_frozen():
+        for x in range(number):
+            frozen.qty = x
+
+    def _set_slots():
+        for x in range(number):
+            slots.qty = x
+
+    _report(f'FrozenClass -> slots: set attribute x{number}', _measure(_set_frozen), _measure(_set_slots))
+
+
+def bench_bulk(rows: int = 5000):
+    if not os.environ.get('DJANGO_SETTINGS_MODULE'):
+        print(f'{"bulk: skipped, DJANGO_SETTINGS_MODULE not set":<48}')
+        return
+    import django
+    django.setup()
+    from django.db import connection, models
+    from .dba import bulk_insert, bulk_upsert, get_engine
+
+    class BenchItem(models.Model):
+        code = models.CharField(max_length=20, unique=True)
+        price = models.DecimalField(max_digits=12, decimal_places=2)
+
+        class Meta:
+            app_label = 'helpers'
+            db_table = 'helpers_bench_item'
+
+    data = [{'code': f'c{x}', 'price': Decimal(x) / 100} for x in range(rows)]
+    engine = get_engine()
+    with connection.schema_editor() as editor:
+        editor.create_model(BenchItem)
+    try:
+        def save_loop():
+            BenchItem.objects.all().delete()
+            for row in data:
+                BenchItem(**row).save()
+
+        def insert():
+            BenchItem.objects.all().delete()
+            bulk_insert(BenchItem, data, engine=engine)
+
+        _report(f'bulk: Django save() loop -> bulk_insert x{rows}', _measure(save_loop), _measure(insert))
+        _report(f'bulk: Django save() loop -> bulk_upsert x{rows}', _measure(save_loop), _measure(
+            lambda: bulk_upsert(BenchItem, data, conflict_keys=['code'], engine=engine)
+        ))
+    finally:
+        with connection.schema_editor() as editor:
+            editor.delete_model(BenchItem)
+
+
+BENCHMARKS = {
+    'json': bench_json,
+    'compact': bench_compact,
+    'todict': bench_todict,
+    'addresses': bench_addresses,
+    'frozen': bench_frozen,
+    'bulk': bench_bulk,
+}
+
+
+def main(names: list[str]):
+    print(f'{"benchmark":<48} {"baseline":>13} {"optimized":>13} {"speedup":>9}')
+    for name in names or BENCHMARKS:
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
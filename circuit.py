@@ -0,0 +1,282 @@
+"""
+Circuit breaker for calls to unreliable downstream services.
+
+Counts failures over a rolling time window. When the failure rate exceeds the threshold the circuit opens
+and calls fail fast with CircuitOpenException instead of waiting on a hard-down service. After reset_timeout
+the circuit becomes half-open and lets a few trial calls through: success closes the circuit, failure opens it again.
+
+Usage:
+    breaker = CircuitBreaker.get('payments-api', failure_rate=0.5, reset_timeout=60)
+    result = breaker.call(lambda: http_request('GET', url))
+or together with retries:
+    retry_callable(func, tries=5, random_pause=1, circuit='payments-api')
+
+With shared=True the open/closed state is additionally kept in the database (CircuitBreakerRecord),
+so all processes stop calling the service as soon as one of them opens the circuit. The database is accessed
+outside the breaker's lock; coroutines use async_* methods (as async_retry_callable does) to access it
+via sync_to_async, off the event loop.
+"""
+
+import time
+import logging
+import datetime
+import threading
+from collections import deque
+from asgiref.sync import sync_to_async
+
+# local imports
+from .dateutils import local_now_tz_aware
+
+log = logging.getLogger(__name__)
+
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half-open'
+
+CIRCUIT_FAILURE_RATE_DEFAULT = 0.5;     """default failure rate in the window to open the circuit"""
+CIRCUIT_MIN_CALLS_DEFAULT = 10;         """default minimal number of calls in the window to evaluate failure rate"""
+CIRCUIT_WINDOW_DEFAULT = 60.0;          """default rolling window length, in seconds"""
+CIRCUIT_WINDOW_BUCKETS = 10;            """number of buckets the rolling window is divided into"""
+CIRCUIT_RESET_TIMEOUT_DEFAULT = 30.0;   """default interval after which open circuit becomes half-open, in seconds"""
+CIRCUIT_SYNC_INTERVAL_DEFAULT = 1.0;    """default interval between reading shared state from the database"""
+
+
+class CircuitOpenException(RuntimeError):
+    def __init__(self, circuit: 'CircuitBreaker', retry_after: float):
+        super().__init__(f"Circuit '{circuit.name}' is open, retry after {round(retry_after, 1)} seconds")
+        self.circuit = circuit
+        self.retry_after = retry_after
+
+
+class DatabaseCircuitStore:
+    """Keeps circuit state in CircuitBreakerRecord database table to share it between processes."""
+
+    @staticmethod
+    def load(name: str) -> tuple[str, datetime.datetime | None] | None:
+        from .models import CircuitBreakerRecord
+        record = CircuitBreakerRecord.objects.filter(pk=name).values_list('state', 'opened_at').first()
+        return tuple(record) if record else None
+
+    @staticmethod
+    def save(name: str, state: str, opened_at: datetime.datetime | None) -> None:
+        from .models import CircuitBreakerRecord
+        CircuitBreakerRecord.objects.update_or_create(pk=name, defaults={'state': state, 'opened_at': opened_at})
+
+
+class CircuitBreaker:
+    _registry: dict[str, 'CircuitBreaker'] = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(
+            self, name: str,
+            failure_rate: float = CIRCUIT_FAILURE_RATE_DEFAULT,
+            min_calls: int = CIRCUIT_MIN_CALLS_DEFAULT,
+            window: float = CIRCUIT_WINDOW_DEFAULT,
+            reset_timeout: float = CIRCUIT_RESET_TIMEOUT_DEFAULT,
+            half_open_calls: int = 1,
+            shared: bool = False,
+            sync_interval: float = CIRCUIT_SYNC_INTERVAL_DEFAULT,
+            clock: callable = time.monotonic
+    ):
+        """
+        @param name: circuit name, identifies the protected service
+        @param failure_rate: open the circuit when failures share in the window reaches this value
+        @param min_calls: do not open the circuit until the window contains at least this number of calls
+        @param window: length of the rolling window, in seconds
+        @param reset_timeout: interval after which open circuit becomes half-open, in seconds
+        @param half_open_calls: number of concurrent trial calls allowed in half-open state
+        @param shared: keep the state in the database to share it between processes
+        @param sync_interval: interval between reading shared state from the database, in seconds
+        @param clock: monotonic clock function, replaceable for tests
+        """
+        if not 0 < failure_rate <= 1:
+            raise ValueError('failure_rate must be within (0, 1] interval')
+        if min_calls <= 0 or half_open_calls <= 0:
+            raise ValueError('min_calls and half_open_calls must be positive integers')
+        if window <= 0 or reset_timeout <= 0:
+            raise ValueError('window and reset_timeout must be positive floats')
+
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.store = DatabaseCircuitStore() if shared else None
+        self.sync_interval = sync_interval
+        self.clock = clock
+
+        self.opened = 0;    """number of times the circuit was opened by this process"""
+        self.rejected = 0;  """number of calls rejected because the circuit was open"""
+
+        self._lock = threading.Lock()
+        self._bucket_width = window / CIRCUIT_WINDOW_BUCKETS
+        self._buckets: deque[list[int]] = deque();  """[bucket number, successes, failures]"""
+        self._state = CIRCUIT_CLOSED
+        self._opened_at = 0.0
+        self._half_open_in_flight = 0
+        self._synced_at = None
+
+    def __str__(self):
+        return f'CircuitBreaker(name={self.name}, state={self.state})'
+
+    @classmethod
+    def get(cls, name: str, **kwargs) -> 'CircuitBreaker':
+        """Returns process-wide circuit breaker with given name, creates it with given parameters on first use."""
+        circuit = cls._registry.get(name)
+        if circuit is None:
+            with cls._registry_lock:
+                circuit = cls._registry.get(name)
+                if circuit is None:
+                    circuit = cls._registry[name] = cls(name, **kwargs)
+        return circuit
+
+    @property
+    def state(self) -> str:
+        shared = self._load_shared_if_due()
+        with self._lock:
+            self._update_state(self.clock(), shared)
+            return self._state
+
+    def _load_shared_if_due(self) -> tuple[str, datetime.datetime | None] | None:
+        """Reads shared state from the store if sync interval passed; the database is queried outside the lock."""
+        if not self._sync_due():
+            return None
+        return self.store.load(self.name)
+
+    async def _async_load_shared_if_due(self) -> tuple[str, datetime.datetime | None] | None:
+        if not self._sync_due():
+            return None
+        return await sync_to_async(self.store.load)(self.name)
+
+    def _sync_due(self) -> bool:
+        if not self.store:
+            return False
+        with self._lock:
+            now = self.clock()
+            if self._synced_at is not None and now - self._synced_at < self.sync_interval:
+                return False
+            self._synced_at = now
+            return True
+
+    def _update_state(self, now: float, shared: tuple[str, datetime.datetime | None] | None) -> None:
+        if shared:
+            self._apply_shared(now, *shared)
+        if self._state == CIRCUIT_OPEN and now - self._opened_at >= self.reset_timeout:
+            self._state = CIRCUIT_HALF_OPEN
+            self._half_open_in_flight = 0
+
+    def _apply_shared(self, now: float, state: str, opened_at: datetime.datetime | None) -> None:
+        if state == CIRCUIT_OPEN and self._state == CIRCUIT_CLOSED and opened_at:
+            elapsed = (local_now_tz_aware() - opened_at).total_seconds()
+            if elapsed < self.reset_timeout:
+                log.info(f'circuit "{self.name}" opened by another process')
+                self._state = CIRCUIT_OPEN
+                self._opened_at = now - elapsed
+        elif state == CIRCUIT_CLOSED and self._state == CIRCUIT_OPEN:
+            self._close()
+
+    def _shared_state(self) -> tuple[str, str, datetime.datetime | None] | None:
+        """Returns store.save arguments for the current state, to be saved after the lock is released."""
+        if not self.store:
+            return None
+        return self.name, self._state, local_now_tz_aware() if self._state == CIRCUIT_OPEN else None
+
+    def _record(self, now: float, failed: bool) -> None:
+        bucket_num = int(now // self._bucket_width)
+        if not self._buckets or self._buckets[-1][0] != bucket_num:
+            self._buckets.append([bucket_num, 0, 0])
+        self._buckets[-1][2 if failed else 1] += 1
+        while self._buckets[0][0] <= bucket_num - CIRCUIT_WINDOW_BUCKETS:
+            self._buckets.popleft()
+
+    def _open(self, now: float) -> tuple | None:
+        self._state = CIRCUIT_OPEN
+        self._opened_at = now
+        self.opened += 1
+        log.warning(f'circuit "{self.name}" opened')
+        return self._shared_state()
+
+    def _close(self) -> None:
+        self._state = CIRCUIT_CLOSED
+        self._buckets.clear()
+        log.info(f'circuit "{self.name}" closed')
+
+    def before_call(self) -> None:
+        """Must be called before every protected call. Raises CircuitOpenException if the call is not allowed."""
+        self._before_call(self._load_shared_if_due())
+
+    async def async_before_call(self) -> None:
+        """Asyncio variant of before_call, the shared state is read by sync_to_async outside the event loop."""
+        self._before_call(await self._async_load_shared_if_due())
+
+    def _before_call(self, shared: tuple[str, datetime.datetime | None] | None) -> None:
+        with self._lock:
+            now = self.clock()
+            self._update_state(now, shared)
+            if self._state == CIRCUIT_OPEN:
+                self.rejected += 1
+                raise CircuitOpenException(self, self.reset_timeout - (now - self._opened_at))
+            if self._state == CIRCUIT_HALF_OPEN:
+                if self._half_open_in_flight >= self.half_open_calls:
+                    self.rejected += 1
+                    raise CircuitOpenException(self, 0)
+                self._half_open_in_flight += 1
+
+    def record_success(self) -> None:
+        """Registers successful protected call."""
+        if save := self._record_success():
+            self.store.save(*save)
+
+    async def async_record_success(self) -> None:
+        """Asyncio variant of record_success."""
+        if save := self._record_success():
+            await sync_to_async(self.store.save)(*save)
+
+    def _record_success(self) -> tuple | None:
+        with self._lock:
+            if self._state == CIRCUIT_HALF_OPEN:
+                self._close()
+                return self._shared_state()
+            self._record(self.clock(), failed=False)
+            return None
+
+    def record_failure(self) -> None:
+        """Registers failed protected call, opens the circuit if the failure rate reached the threshold."""
+        if save := self._record_failure():
+            self.store.save(*save)
+
+    async def async_record_failure(self) -> None:
+        """Asyncio variant of record_failure."""
+        if save := self._record_failure():
+            await sync_to_async(self.store.save)(*save)
+
+    def _record_failure(self) -> tuple | None:
+        with self._lock:
+            now = self.clock()
+            if self._state == CIRCUIT_HALF_OPEN:
+                return self._open(now)
+            if self._state == CIRCUIT_OPEN:
+                return None
+            self._record(now, failed=True)
+            successes = sum(x[1] for x in self._buckets)
+            failures = sum(x[2] for x in self._buckets)
+            if successes + failures >= self.min_calls and failures >= self.failure_rate * (successes + failures):
+                return self._open(now)
+            return None
+
+    def record_ignored(self) -> None:
+        """Registers protected call finished with an error unrelated to the service health."""
+        with self._lock:
+            if self._state == CIRCUIT_HALF_OPEN and self._half_open_in_flight > 0:
+                self._half_open_in_flight -= 1
+
+    def call(self, func: callable):
+        """Calls given callable protected by this circuit breaker."""
+        self.before_call()
+        try:
+            result = func()
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
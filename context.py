@@ -0,0 +1,153 @@
+"""
+Execution context of the current Django request or Django-Q task.
+
+Stored in context variables instead of thread locals, so the context is correct both for threads
+and for asyncio tasks (ASGI views, coroutines): every asyncio task runs in its own copy of the context.
+
+Importing this module installs the log record factory adding username and task_id attributes to log records.
+"""
+
+import logging
+from contextvars import ContextVar
+from django.utils.functional import LazyObject, empty
+
+current_request_var: ContextVar = ContextVar('current_request', default=None)
+"""Django HttpRequest being processed in the current context, if any. Managed by current_request module."""
+
+current_task_info_var: ContextVar = ContextVar('current_task_info', default=None)
+"""TaskInfo of the Django-Q task being executed in the current context, if any. Managed by tasks module."""
+
+request_cache_var: ContextVar = ContextVar('request_cache', default=None)
+"""RequestCache of the current request, if any. Managed by current_request module."""
+
+REQUEST_USERNAME_CACHE_ATTR = '_helpers_username'
+"""HttpRequest attribute to cache resolved username of the request user in."""
+
+REQUEST_USERNAME_UNRESOLVED = '?'
+"""Username logged if the request user is not loaded yet, see LazyUsername."""
+
+
+def request_username(request) -> str:
+    """
+    @return: username of the non-anonymous request user or empty string. Cached on the request object.
+    """
+    username = getattr(request, REQUEST_USERNAME_CACHE_ATTR, None)
+    if username is None:
+        if not hasattr(request, 'user'):
+            return ''  # authentication middleware not processed the request yet, nothing to cache
+        user = request.user  # may trigger session and user database lookup
+        username = user.username if user is not None and not user.is_anonymous else ''
+        setattr(request, REQUEST_USERNAME_CACHE_ATTR, username)
+    return username
+
+
+class RequestCache:
+    """Memoization cache living as long as the current request or Django-Q task. Counts hits and misses."""
+    __slots__ = ('_data', 'hits', 'misses')
+
+    def __init__(self):
+        self._data = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get_or_call(self, key, func: callable):
+        """Returns cached value for the key, calls func and caches its result if there is no such value yet."""
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            value = self._data[key] = func()
+            return value
+        self.hits += 1
+        return value
+
+    def clear(self):
+        self._data.clear()
+
+
+def _loaded_user(request):
+    """Returns the request user if it is loaded already, without database access; None if not loaded."""
+    user = getattr(request, 'user', None)
+    if isinstance(user, LazyObject) and user._wrapped is empty:
+        # django.contrib.auth keeps the user loaded via request.user or request.auser here
+        return getattr(request, '_cached_user', None) or getattr(request, '_acached_user', None)
+    return user
+
+
+def loaded_request_username(request) -> str | None:
+    """
+    @return: username of the non-anonymous request user or empty string, None if the user is not loaded yet.
+        Never accesses database, so is safe on the event loop and after the request is finished.
+    """
+    username = getattr(request, REQUEST_USERNAME_CACHE_ATTR, None)
+    if username is None:
+        if not hasattr(request, 'user'):
+            return ''
+        user = _loaded_user(request)
+        if user is None:
+            return None
+        username = user.username if not user.is_anonymous else ''
+        setattr(request, REQUEST_USERNAME_CACHE_ATTR, username)
+    return username
+
+
+class LazyUsername:
+    """
+    Username of the request user, resolved only when converted to string (e.g. by a log formatter or handler).
+    Most log records are filtered out by level and never formatted, so the user lookup is not performed for them.
+    Formatting may happen on the event loop or in a QueueListener thread after the request is finished, so the user
+    is never loaded here: if the request did not load it, REQUEST_USERNAME_UNRESOLVED is formatted.
+    """
+    __slots__ = ('_request', )
+
+    def __init__(self, request):
+        self._request = request
+
+    def __str__(self):
+        username = loaded_request_username(self._request)
+        return REQUEST_USERNAME_UNRESOLVED if username is None else username
+
+    def __repr__(self):
+        return repr(str(self))
+
+    def __format__(self, format_spec):
+        return format(str(self), format_spec)
+
+    def __bool__(self):
+        return bool(str(self))
+
+    def __eq__(self, other):
+        return str(self) == (str(other) if isinstance(other, LazyUsername) else other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __reduce__(self):
+        # pickled (e.g. by SocketHandler or QueueHandler to another process) as plain string
+        return str, (str(self), )
+
+
+# official pattern to extend log records: https://docs.python.org/3/library/logging.html#logging.LogRecord
+__old_log_record_factory = logging.getLogRecordFactory()
+
+
+def record_with_context_factory(*args, **kwargs):
+    """
+    Adds username and task_id attributes to every log record. Empty strings if no current request or task.
+    Username is resolved lazily, see LazyUsername.
+    """
+    record = __old_log_record_factory(*args, **kwargs)
+    request = current_request_var.get()
+    record.username = LazyUsername(request) if request is not None else ''
+    task_info = current_task_info_var.get()
+    record.task_id = task_info.handle.task_id if task_info else ''
+    return record
+
+
+logging.setLogRecordFactory(record_with_context_factory)
@@ -6,41 +6,41 @@ Add it to the middleware classes in your settings.py:
         ...,
         'helpers.current_request.ThreadCurrentRequestMiddleware',
     )
+
+For ASGI deployments with async views use 'helpers.current_request.AsyncCurrentRequestMiddleware' instead.
 """
 
-import logging
-import threading
-from django.conf import settings
+import functools
+from asgiref.sync import markcoroutinefunction
 from django.contrib.auth.models import AnonymousUser, AbstractUser
 from django.http.request import HttpRequest
 
-CURRENT_REQUEST_ATTR_NAME = getattr(settings, 'CURRENT_REQUEST_ATTR_NAME', '_current_request')
-
-_thread_locals = threading.local()
-
-
-def _do_set_current_request(request_func):
-    setattr(_thread_locals, CURRENT_REQUEST_ATTR_NAME, request_func.__get__(request_func, threading.local))
+# local imports
+from .context import current_request_var, current_task_info_var, request_cache_var, request_username, RequestCache
 
 
 def _set_current_request(request: HttpRequest = None):
     """
-    Sets current request in local thread.
+    Sets current request in the current context (thread or asyncio task).
 
     Can be used as a hook e.g. for shell jobs (when request object is not available).
     """
-    _do_set_current_request(lambda x: request)
+    current_request_var.set(request)
 
 
 class SetCurrentRequest:
     def __init__(self, request):
         self.request = request
+        self._token = None
+        self._cache_token = None
 
     def __enter__(self):
-        _do_set_current_request(lambda x: self.request)
+        self._token = current_request_var.set(self.request)
+        self._cache_token = request_cache_var.set(RequestCache())
 
     def __exit__(self, exception_type, exception_value, exception_traceback):
-        _do_set_current_request(lambda x: None)
+        request_cache_var.reset(self._cache_token)
+        current_request_var.reset(self._token)
 
 
 class ThreadCurrentRequestMiddleware(object):
@@ -54,13 +54,26 @@ class ThreadCurrentRequestMiddleware(object):
         return response
 
 
+class AsyncCurrentRequestMiddleware(object):
+    """Async variant of ThreadCurrentRequestMiddleware, keeps request per coroutine under ASGI."""
+    sync_capable = False
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        markcoroutinefunction(self)
+
+    async def __call__(self, request):
+        with SetCurrentRequest(request):
+            response = await self.get_response(request)
+        return response
+
+
 def get_current_request() -> HttpRequest | None:
     """
-    @return: current django request object in the local thread if any.
+    @return: current django request object in the current context (thread or asyncio task) if any.
     """
-    current_request = getattr(_thread_locals, CURRENT_REQUEST_ATTR_NAME, None)
-    if callable(current_request):
-        current_request = current_request()
+    current_request = current_request_var.get()
     assert isinstance(current_request, HttpRequest) or current_request is None
     return current_request
 
@@ -87,18 +100,45 @@ def get_current_username() -> str:
     """
     @return: username of the current non-anonymous django request user or empty string.
     """
-    current_user = get_current_authenticated_user()
-    return current_user.username if current_user else ''
-
-
-# official pattern to extend log records: https://docs.python.org/3/library/logging.html#logging.LogRecord
-__old_log_record_factory = logging.getLogRecordFactory()
+    current_request = get_current_request()
+    return request_username(current_request) if current_request else ''
 
 
-def record_with_username_factory(*args, **kwargs):
-    record = __old_log_record_factory(*args, **kwargs)
-    record.username = get_current_username()
-    return record
+def request_cache() -> RequestCache | None:
+    """
+    @return: memoization cache of the current request (see SetCurrentRequest) or of the current managed Django-Q task,
+             None if there is no such request or task.
+    """
+    cache = request_cache_var.get()
+    if cache is None:
+        task_info = current_task_info_var.get()
+        if task_info:
+            cache = task_info.cache
+    return cache
 
 
-logging.setLogRecordFactory(record_with_username_factory)
+def request_cached(_func: callable = None):
+    """
+    Memoizes results of the decorated function for the lifetime of the current request or managed Django-Q task.
+    Calls the function without caching if there is no current request or task, or arguments are not hashable.
+    """
+    def decorator(func: callable):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            cache = request_cache()
+            if cache is None:
+                return func(*args, **kwargs)
+            # keyed by the function itself: closures and local functions may share __qualname__
+            key = (func, args, tuple(sorted(kwargs.items()))) if kwargs else (func, args)
+            try:
+                hash(key)
+            except TypeError:
+                return func(*args, **kwargs)
+            return cache.get_or_call(key, lambda: func(*args, **kwargs))
+
+        return wrapper
+
+    if _func is None:
+        return decorator
+    else:
+        return decorator(_func)
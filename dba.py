@@ -1,44 +1,212 @@
 """
 Access to Django project database objects via SqlAlchemy.
-Exposes: Session factory object and Mirror for some Django objects.
+Exposes: Session factory object and SqlAlchemy mirrors of Django models (see sa_table, sa_model).
+Engine and Session are created on first use, so importing the module does not connect to the database.
 """
 
-import datetime
+import os
+import asyncio
 import logging
+import threading
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Type
-from sqlalchemy import create_engine, DateTime, Integer, String, Text, BigInteger
-from sqlalchemy.orm import sessionmaker, DeclarativeBase, Mapped, mapped_column
-from sqlalchemy.engine import URL
+from collections.abc import Iterable, Iterator, Mapping, Sequence, Callable
+from sqlalchemy import create_engine, insert, update, bindparam, and_, or_, inspect as sa_inspect, Table
+from sqlalchemy import Select, ColumnElement
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy import Column, ForeignKey, DateTime, Date, Time, Interval, Integer, SmallInteger, BigInteger, Boolean
+from sqlalchemy import String, Text, Numeric, Float, Uuid, LargeBinary, JSON
+from sqlalchemy.types import TypeEngine
+from sqlalchemy.orm import sessionmaker, DeclarativeBase
+from sqlalchemy.engine import URL, Engine, Row
 from django.conf import settings
+from django.db import models
 
 # local imports
 from .dateutils import local_now_tz_aware
 from .models import LogEntry as DjangoOrmLogEntry
-from .misc import jsonpickle_dumps
+from .debuginfo import DebugInfoSerializer
+from .misc import iter_blocks, iter_csv, iter_jsonl
 
+SA_POOL_SIZE_DEFAULT = 5;  """default number of connections kept by the engine pool"""
+SA_MAX_OVERFLOW_DEFAULT = 5;  """default number of connections the engine pool opens beyond pool size"""
+SQLITE_CONNECT_ARGS = ('timeout', 'detect_types', 'check_same_thread', 'cached_statements', 'uri')
+"""Django sqlite OPTIONS passed to sqlite3.connect, others are Django-only"""
+POSTGRESQL_DJANGO_ONLY_OPTIONS = ('isolation_level', 'server_side_binding', 'pool', 'assume_role')
+"""Django PostgreSQL OPTIONS not passed to the driver"""
+DEBUG_INFO_WORKERS = 2;  """default number of threads serializing and writing debug info"""
+DEBUG_INFO_BATCH_SIZE = 100;  """default max number of entities updated by a single debug info batch"""
+BULK_BATCH_SIZE = 1000;  """default number of rows sent by a single statement execution of bulk helpers"""
+COPY_CHUNK_SIZE = 64*1024;  """approximate size of data chunks streamed by copy_rows"""
+STREAM_BATCH_SIZE = 2000;  """default number of rows in a batch yielded by stream_query"""
 ATTRIBUTE_NAME_DEBUG_INFO = 'debug_info';  """Default entity's attribute for saving debug info"""
+ATTRIBUTE_SUFFIX_COMPACT = '_compact';      """Suffix of entity's attribute for precomputed compacted debug info"""
+ATTRIBUTE_SUFFIX_MINIMIZED = '_minimized';  """Suffix of entity's attribute for minimized debug info"""
 
 log = logging.getLogger(__name__)
 
+debug_info_serializer = DebugInfoSerializer()
+"""Serializer of debug info saved by save_debug_info, bounded by default limits."""
+
 
 class Base(DeclarativeBase):
     pass
 
 
-class LogEntry(Base):
-    __tablename__ = DjangoOrmLogEntry._meta.db_table
-
-    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
-    name: Mapped[str] = mapped_column(String(100), nullable=False)
-    level: Mapped[int] = mapped_column(Integer, nullable=False, default=logging.ERROR)
-    msg: Mapped[str] = mapped_column(Text, nullable=False)
-    trace: Mapped[str] = mapped_column(Text, nullable=False)
-    task_id: Mapped[str] = mapped_column(String(12), nullable=False)
-    username: Mapped[str] = mapped_column(String(150), nullable=False)
-    created_at: Mapped[datetime.datetime] = mapped_column(
-        DateTime(timezone=True), nullable=False, default=local_now_tz_aware
+SA_FIELD_TYPES: dict[str, Callable[[models.Field], TypeEngine]] = {
+    'AutoField': lambda f: Integer(),
+    'BigAutoField': lambda f: BigInteger().with_variant(Integer(), 'sqlite'),  # sqlite autoincrements INTEGER only
+    'SmallAutoField': lambda f: SmallInteger().with_variant(Integer(), 'sqlite'),
+    'IntegerField': lambda f: Integer(),
+    'BigIntegerField': lambda f: BigInteger(),
+    'SmallIntegerField': lambda f: SmallInteger(),
+    'PositiveIntegerField': lambda f: Integer(),
+    'PositiveBigIntegerField': lambda f: BigInteger(),
+    'PositiveSmallIntegerField': lambda f: SmallInteger(),
+    'BooleanField': lambda f: Boolean(),
+    'NullBooleanField': lambda f: Boolean(),
+    'CharField': lambda f: String(f.max_length),
+    'SlugField': lambda f: String(f.max_length),
+    'FileField': lambda f: String(f.max_length),
+    'FilePathField': lambda f: String(f.max_length),
+    'GenericIPAddressField': lambda f: String(39),
+    'TextField': lambda f: Text(),
+    'DateTimeField': lambda f: DateTime(timezone=True),
+    'DateField': lambda f: Date(),
+    'TimeField': lambda f: Time(),
+    'DurationField': lambda f: Interval(),
+    'DecimalField': lambda f: Numeric(f.max_digits, f.decimal_places),
+    'FloatField': lambda f: Float(),
+    'UUIDField': lambda f: Uuid(),
+    'BinaryField': lambda f: LargeBinary(),
+    'JSONField': lambda f: JSON(),
+}
+"""Django field internal type => SqlAlchemy column type factory, used by sa_table; extend for custom fields"""
+
+_sa_tables: dict[Type[models.Model], Table] = {}
+_sa_models: dict[Type[models.Model], Type[Base]] = {}
+_sa_mirrors_lock = threading.RLock()
+
+
+def _sa_column(field: models.Field) -> Column:
+    """Returns SqlAlchemy column mirroring concrete Django model field."""
+    if field.is_relation:
+        target = field.target_field
+        column_type = _sa_column(target).type
+        foreign_keys = [ForeignKey(f'{field.related_model._meta.db_table}.{target.column}')]
+    else:
+        factory = SA_FIELD_TYPES.get(field.get_internal_type())
+        if factory is None:
+            raise TypeError(
+                f'no SqlAlchemy type for {field.model.__name__}.{field.name} ({field.get_internal_type()})'
+            )
+        column_type = factory(field)
+        foreign_keys = []
+
+    kwargs = {}
+    if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False):
+        kwargs['default'] = local_now_tz_aware
+        if field.auto_now:
+            kwargs['onupdate'] = local_now_tz_aware
+    elif field.has_default():
+        kwargs['default'] = field.default
+    return Column(
+        field.column, column_type, *foreign_keys, key=field.attname,
+        primary_key=field.primary_key, nullable=field.null, unique=field.unique and not field.primary_key,
+        autoincrement=isinstance(field, models.AutoField) or 'auto', **kwargs
     )
 
+
+def sa_table(model: Type[models.Model]) -> Table:
+    """
+    Returns SqlAlchemy table mirroring the Django model, built from its concrete fields on first use and cached.
+    Columns are keyed by field attname ('prev_id' for 'prev' foreign key); tables of related models are mirrored too.
+    Usage:
+        stmt = select(sa_table(TaskHandle)).where(sa_table(TaskHandle).c.task_id == task_id)
+    """
+    table = _sa_tables.get(model)
+    if table is not None:
+        return table
+    with _sa_mirrors_lock:
+        table = _sa_tables.get(model)
+        if table is None:
+            meta = model._meta
+            table = Base.metadata.tables.get(meta.db_table)
+            if table is None:
+                table = Table(meta.db_table, Base.metadata, *(_sa_column(x) for x in meta.concrete_fields))
+            _sa_tables[model] = table
+            for field in meta.concrete_fields:
+                if field.is_relation:
+                    sa_table(field.related_model)
+    return table
+
+
+def sa_model(model: Type[models.Model]) -> Type[Base]:
+    """
+    Returns SqlAlchemy mapped class mirroring the Django model (see sa_table), created on first use and cached.
+    Attributes are named by field attnames. Returns the class already mapped to the table if there is one.
+    """
+    mapped = _sa_models.get(model)
+    if mapped is not None:
+        return mapped
+    with _sa_mirrors_lock:
+        mapped = _sa_models.get(model)
+        if mapped is None:
+            table = sa_table(model)
+            mapped = next((x.class_ for x in Base.registry.mappers if x.local_table is table), None)
+            if mapped is None:
+                mapped = type(model.__name__, (Base,), {'__table__': table, '__module__': model.__module__})
+            _sa_models[model] = mapped
+    return mapped
+
+
+def verify_sa_mirror(model: Type[models.Model], engine: Engine | None = None) -> list[str]:
+    """
+    Compares the mirror of the Django model with the database table schema, logs and returns found differences:
+    missing table or columns, different nullability, string lengths or python types of values, columns not mirrored
+    which cannot be omitted on insert.
+    """
+    table = sa_table(model)
+    inspector = sa_inspect(engine or get_engine())
+    if not inspector.has_table(table.name):
+        problems = [f'table "{table.name}" not found']
+    else:
+        problems = []
+        reflected = {x['name']: x for x in inspector.get_columns(table.name)}
+        for column in table.columns:
+            db_column = reflected.pop(column.name, None)
+            name = f'{table.name}.{column.name}'
+            if db_column is None:
+                problems.append(f'column "{name}" not found')
+                continue
+            if db_column['nullable'] != column.nullable and not column.primary_key:
+                problems.append(f'column "{name}" nullable is {db_column["nullable"]}, mirror: {column.nullable}')
+            db_type = db_column['type']
+            length = getattr(column.type, 'length', None)
+            db_length = getattr(db_type, 'length', None)
+            if length and db_length and length != db_length:
+                problems.append(f'column "{name}" length is {db_length}, mirror: {length}')
+            try:
+                db_python_type, python_type = db_type.python_type, column.type.python_type
+            except NotImplementedError:
+                continue
+            if db_python_type is not python_type:
+                problems.append(f'column "{name}" type is {db_type}, mirror: {column.type}')
+        for name, db_column in reflected.items():
+            if not db_column['nullable'] and db_column.get('default') is None and not db_column.get('autoincrement'):
+                problems.append(f'column "{table.name}.{name}" is not mirrored and has no default')
+    for problem in problems:
+        log.warning(f'{model.__name__} mirror: {problem}')
+    return problems
+
+
+class LogEntry(Base):
+    __table__ = sa_table(DjangoOrmLogEntry)
+
     def __repr__(self):
         return f'{self.created_at:%Y%m%d-%H%M%S.%f}: {self.msg}'
 
@@ -52,6 +220,9 @@ def derive_sa_connection_string() -> str:
 
     if db_settings['ENGINE'] == 'django.db.backends.sqlite3':
         sql_alchemy_connection = f'sqlite:///{db_settings["NAME"]}'
+        if str(db_settings['NAME']).startswith('file:'):
+            # URI filename, e.g. in-memory test database shared with Django connection
+            sql_alchemy_connection += ('&' if '?' in str(db_settings['NAME']) else '?') + 'uri=true'
 
     elif db_settings['ENGINE'] == 'django.db.backends.postgresql_psycopg2':
         user = db_settings['USER']
@@ -83,16 +254,281 @@ def derive_sa_connection_string() -> str:
     return sql_alchemy_connection
 
 
-engine = create_engine(derive_sa_connection_string())
-"""Default database engine."""
+def derive_sa_engine_options() -> dict[str, Any]:
+    """
+    Derives SqlAlchemy engine options from Django default database configuration:
+    CONN_MAX_AGE => pool_recycle, CONN_HEALTH_CHECKS => pool_pre_ping, driver OPTIONS => connect_args
+    (e.g. statement timeout {'options': '-c statement_timeout=30000'} for PostgreSQL, {'timeout': 20} for sqlite),
+    pool sizes for client-server databases.
+    settings.SQLALCHEMY_ENGINE_OPTIONS, if defined, overrides derived options.
+    """
+    db_settings = settings.DATABASES['default']
+    options: dict[str, Any] = {}
 
-Session = sessionmaker(bind=engine)
-"""
-SqlAlchemy Session objects creator, bound to configured database connection.
+    max_age = db_settings.get('CONN_MAX_AGE', 0)
+    if max_age:
+        options['pool_recycle'] = max_age
+    if db_settings.get('CONN_HEALTH_CHECKS'):
+        options['pool_pre_ping'] = True
+
+    db_options = db_settings.get('OPTIONS', {})
+    is_sqlite = db_settings['ENGINE'] == 'django.db.backends.sqlite3'
+    if is_sqlite:
+        connect_args = {k: v for k, v in db_options.items() if k in SQLITE_CONNECT_ARGS}
+    elif db_settings['ENGINE'] == 'django.db.backends.postgresql_psycopg2':
+        connect_args = {k: v for k, v in db_options.items() if k not in POSTGRESQL_DJANGO_ONLY_OPTIONS}
+    else:
+        connect_args = {}  # mssql options are in the connection URL
+    if connect_args:
+        options['connect_args'] = connect_args
+    if not is_sqlite:
+        options['pool_size'] = SA_POOL_SIZE_DEFAULT
+        options['max_overflow'] = SA_MAX_OVERFLOW_DEFAULT
+
+    options.update(getattr(settings, 'SQLALCHEMY_ENGINE_OPTIONS', {}))
+    return options
+
+
+_engine = None
+_session_factory = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> Engine:
+    """Returns default database engine, creates it on first use."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_engine(derive_sa_connection_string(), **derive_sa_engine_options())
+    return _engine
+
+
+def get_session_factory() -> sessionmaker:
+    """Returns Session factory bound to the default database engine, creates it on first use."""
+    global _session_factory
+    if _session_factory is None:
+        engine = get_engine()
+        with _engine_lock:
+            if _session_factory is None:
+                _session_factory = sessionmaker(bind=engine)
+    return _session_factory
 
-Can use shortcut "with Session.begin() as session:" equivalent to "with Session() as session, session.begin():".
-This creates/closes Session object and begins/commits transaction.
-"""
+
+def _dispose_engine_in_child():
+    """Pooled connections of the parent process must not be used by forked child (e.g. Django-Q worker)."""
+    global _engine_lock
+    _engine_lock = threading.Lock()
+    if _engine is not None:
+        _engine.dispose(close=False)
+
+
+if hasattr(os, 'register_at_fork'):  # not available on Windows
+    os.register_at_fork(after_in_child=_dispose_engine_in_child)
+
+
+def __getattr__(name: str):
+    """
+    Lazy module attributes, created on first use:
+
+    engine - default database engine.
+
+    Session - SqlAlchemy Session objects creator, bound to configured database connection.
+    Can use shortcut "with Session.begin() as session:" equivalent to "with Session() as session, session.begin():".
+    This creates/closes Session object and begins/commits transaction.
+    """
+    if name == 'engine':
+        return get_engine()
+    if name == 'Session':
+        return get_session_factory()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def _serialize_debug_info(entity: Type[DeclarativeBase], info: Any, attr_name: str) -> dict[str, str]:
+    """Returns values of the entity's debug info attributes: full, compacted and minimized if defined."""
+    data = debug_info_serializer.flatten(info)
+    values = {attr_name: debug_info_serializer.encode(data)}
+    if hasattr(entity, attr_name + ATTRIBUTE_SUFFIX_COMPACT):
+        values[attr_name + ATTRIBUTE_SUFFIX_COMPACT] = debug_info_serializer.compact(data)
+    if hasattr(entity, attr_name + ATTRIBUTE_SUFFIX_MINIMIZED):
+        values[attr_name + ATTRIBUTE_SUFFIX_MINIMIZED] = debug_info_serializer.compact(data, remove_protected=True)
+    return values
+
+
+_DEBUG_INFO_PENDING = object();  """outcome of the debug info save not written yet"""
+
+
+def _set_waiter(waiter: asyncio.Future, ex: BaseException | None) -> None:
+    if not waiter.done():
+        if ex is None:
+            waiter.set_result(None)
+        else:
+            waiter.set_exception(ex)
+
+
+class DebugInfoWriter:
+    """
+    Saves debug info off the event loop: serializes it on a bounded thread pool, coalesces pending saves
+    to the same entity attribute (only the last one is written) and flushes them in batches,
+    with one bulk UPDATE statement per entity class and attribute.
+    """
+
+    def __init__(
+            self,
+            session_factory: sessionmaker | None = None,
+            workers: int = DEBUG_INFO_WORKERS,
+            batch_size: int = DEBUG_INFO_BATCH_SIZE
+    ):
+        """
+        @param session_factory: SqlAlchemy session factory, default database Session if None
+        @param workers: number of threads serializing and writing debug info
+        @param batch_size: max number of entities updated by a single batch
+        """
+        if workers <= 0 or batch_size <= 0:
+            raise ValueError('workers and batch_size must be positive integers')
+        self.session_factory = session_factory
+        self.workers = workers
+        self.batch_size = batch_size
+
+        self.written = 0;       """number of entities updated"""
+        self.coalesced = 0;     """number of saves superseded by later ones before written"""
+        self.batches = 0;       """number of batches written"""
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='save_debug_info')
+        self._lock = threading.Lock()
+        self._pending: dict[tuple, list] = {};  """(entity, attr_name, ident) => [sequence, values, waiters, outcome]"""
+        self._latest: dict[tuple, list] = {}
+        """(entity, attr_name, ident) => [latest sequence, saves in progress, waiters of superseded saves, entry]"""
+        self._sequence = itertools.count()
+        self._flushing = False
+
+    def __str__(self):
+        return f'DebugInfoWriter(written={self.written}, coalesced={self.coalesced}, batches={self.batches})'
+
+    def reset_after_fork(self) -> None:
+        """Threads and pending saves of the parent process are not inherited by forked child."""
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='save_debug_info')
+        self._lock = threading.Lock()
+        self._pending.clear()
+        self._latest.clear()
+        self._flushing = False
+
+    async def save(self, entity: Type[DeclarativeBase], ident: Any | tuple[Any, ...], info: Any, attr_name: str):
+        """
+        Saves debug info, see save_debug_info. Returns when the batch containing the save is written;
+        the save superseded by a later one to the same entity returns when the later one is written.
+        """
+        sequence = next(self._sequence)
+        key = (entity, attr_name, ident if isinstance(ident, tuple) else (ident,))
+        with self._lock:
+            latest = self._latest.setdefault(key, [sequence, 0, [], None])
+            latest[0] = sequence
+            latest[1] += 1
+
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        try:
+            values = await loop.run_in_executor(self._executor, _serialize_debug_info, entity, info, attr_name)
+        except BaseException as e:
+            with self._lock:
+                if sequence == latest[0]:
+                    # saves superseded by this one wait for it in vain
+                    for orphan in latest[2]:
+                        orphan.get_loop().call_soon_threadsafe(_set_waiter, orphan, e)
+                    latest[2].clear()
+                self._release_latest(key, latest)
+            raise
+
+        start_flushing = False
+        with self._lock:
+            entry = latest[3]
+            if sequence < latest[0]:
+                # the later save may be written already, the older info must not overwrite it
+                self.coalesced += 1
+                if entry is None or entry[0] < sequence:
+                    latest[2].append(waiter)
+                elif entry[3] is _DEBUG_INFO_PENDING:
+                    entry[2].append(waiter)
+                else:
+                    _set_waiter(waiter, entry[3])
+            else:
+                entry = self._pending.get(key)
+                if entry is None:
+                    entry = self._pending[key] = [sequence, values, [waiter], _DEBUG_INFO_PENDING]
+                else:
+                    self.coalesced += 1
+                    entry[0], entry[1] = sequence, values
+                    entry[2].append(waiter)
+                entry[2].extend(latest[2])
+                latest[2].clear()
+                latest[3] = entry
+                start_flushing = not self._flushing
+                self._flushing = True
+            self._release_latest(key, latest)
+        if start_flushing:
+            self._executor.submit(self._flush)
+        await waiter
+
+    def _release_latest(self, key: tuple, latest: list) -> None:
+        """Forgets the latest save of the key when no save to it is in progress, must be called under lock."""
+        latest[1] -= 1
+        if not latest[1] and self._latest.get(key) is latest:
+            del self._latest[key]
+
+    def _flush(self) -> None:
+        """Writes pending saves batch by batch until none left, saves added meanwhile join next batches."""
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._flushing = False
+                    return
+                keys = list(itertools.islice(self._pending, self.batch_size))
+                batch = {key: self._pending.pop(key) for key in keys}
+
+            ex = None
+            try:
+                self._write(batch)
+            except Exception as e:
+                log.exception('cannot save debug info')
+                ex = e
+            with self._lock:
+                # superseded saves may join the entry until its outcome is set
+                waiters = []
+                for entry in batch.values():
+                    entry[3] = ex
+                    waiters.extend(entry[2])
+            for waiter in waiters:
+                waiter.get_loop().call_soon_threadsafe(_set_waiter, waiter, ex)
+
+    def _write(self, batch: dict[tuple, list]) -> None:
+        groups: dict[tuple, list[dict]] = {}
+        for (entity, attr_name, ident), (_, values, _, _) in batch.items():
+            params = {f'_pk{num}': value for num, value in enumerate(ident)}
+            params.update({f'_v_{name}': value for name, value in values.items()})
+            groups.setdefault((entity, attr_name, tuple(values)), []).append(params)
+
+        written = 0
+        session_factory = self.session_factory or get_session_factory()
+        with session_factory.begin() as s:
+            for (entity, attr_name, names), rows in groups.items():
+                mapper = sa_inspect(entity)
+                stmt = update(mapper.local_table).where(and_(
+                    *(column == bindparam(f'_pk{num}') for num, column in enumerate(mapper.primary_key))
+                )).values({mapper.columns[name]: bindparam(f'_v_{name}') for name in names})
+                result = s.execute(stmt, rows)
+                if 0 <= result.rowcount < len(rows):
+                    log.warning(f'{len(rows) - result.rowcount} of {len(rows)} "{entity.__name__}" entities not found')
+                written += result.rowcount if result.rowcount >= 0 else len(rows)
+        # counted once the transaction is committed
+        self.written += written
+        self.batches += 1
+
+
+debug_info_writer = DebugInfoWriter()
+"""Writer of debug info saved by save_debug_info."""
+
+if hasattr(os, 'register_at_fork'):  # not available on Windows
+    os.register_at_fork(after_in_child=debug_info_writer.reset_after_fork)
 
 
 async def save_debug_info(
@@ -103,16 +539,430 @@ async def save_debug_info(
 ) -> None:
     """
     Saves json-pickled info into certain attribute of the given database entity.
+    Serialized by debug_info_serializer, so large objects are truncated to its limits.
+    If the entity has attributes named with ATTRIBUTE_SUFFIX_COMPACT/ATTRIBUTE_SUFFIX_MINIMIZED suffix
+    (e.g. debug_info_compact, debug_info_minimized), compacted forms are precomputed and saved there too,
+    equal to debug_info_compact/debug_info_minimize template filters output, so listings need no parsing.
+    Serialization and database update are performed by debug_info_writer on its threads without blocking
+    the event loop; concurrent saves to the same entity are coalesced and written in batches.
 
     @param entity: entity class to save debug info to
     @param ident: key of entity
     @param info: debug info to save
     @param attr_name: attribute name of entity to save to
     """
-    with Session.begin() as s:
-        obj = s.get(entity, ident)
-        if not obj:
-            log.warning(f'entity "{entity.__class__}" with ident "{ident}" not found')
+    await debug_info_writer.save(entity, ident, info, attr_name)
+
+
+class BulkResult:
+    """Outcome of bulk operation: number of rows processed and elapsed time."""
+
+    def __init__(self, rows: int, seconds: float):
+        self.rows = rows
+        self.seconds = seconds
+
+    def __str__(self):
+        return f'{self.rows} rows in {self.seconds:.3f} s ({self.rows_per_second:.0f} rows/s)'
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds > 0 else float('inf')
+
+
+def _as_table(table: Table | Type[DeclarativeBase] | Type[models.Model]) -> Table:
+    if isinstance(table, Table):
+        return table
+    if issubclass(table, models.Model):
+        return sa_table(table)
+    return table.__table__
+
+
+def _split_columns(
+        table: Table, rows: Iterable[Mapping | Sequence], columns: Sequence[str] | None
+) -> tuple[list[Column], Iterator[Mapping | Sequence]]:
+    """
+    Returns columns (keys of the first mapping row or all table columns by default) and rows iterator.
+    Columns are given by keys (attnames for sa_table mirrors), which may differ from their names in the database:
+    rows are looked up by column.key, SQL is built with column.name.
+    """
+    rows = iter(rows)
+    if columns is not None:
+        return [table.c[x] for x in columns], rows
+    first = next(rows, None)
+    if first is None:
+        return [], iter(())
+    columns = [table.c[x] for x in first] if isinstance(first, Mapping) else list(table.columns)
+    return columns, itertools.chain((first,), rows)
+
+
+def _omitted_defaults(table: Table, columns: Sequence[Column]) -> list[Column]:
+    """
+    Returns columns omitted from rows having Python-side scalar or callable default: SqlAlchemy insert fills them,
+    COPY and raw DB-API inserts must get them from _row_converter.
+    """
+    return [
+        x for x in table.columns
+        if x not in columns and x.default is not None and (x.default.is_scalar or x.default.is_callable)
+    ]
+
+
+def _row_converter(
+        columns: Sequence[Column], defaults: Sequence[Column], dialect
+) -> Callable[[Mapping | Sequence], tuple]:
+    """
+    Returns function converting row to tuple of DB-API values of columns followed by defaults (see _omitted_defaults),
+    processed by SqlAlchemy column types.
+    """
+    keys = [x.key for x in columns]
+    processors = [x.type.bind_processor(dialect) for x in (*columns, *defaults)]
+    scalars = [x.default.arg if x.default.is_scalar else None for x in defaults]
+    callables = [x.default.arg if x.default.is_callable else None for x in defaults]
+    if not any(processors) and not defaults:
+        return lambda row: tuple(row[x] for x in keys) if isinstance(row, Mapping) else tuple(row)
+
+    def _convert(row: Mapping | Sequence) -> tuple:
+        values = [row[x] for x in keys] if isinstance(row, Mapping) else list(row)
+        values.extend(c(None) if c else v for c, v in zip(callables, scalars))  # callable defaults take context
+        return tuple(p(v) if p else v for p, v in zip(processors, values))
+
+    return _convert
+
+
+def bulk_upsert(
+        table: Table | Type[DeclarativeBase] | Type[models.Model],
+        rows: Iterable[Mapping | Sequence],
+        conflict_keys: Sequence[str],
+        update_columns: Sequence[str] | None = None,
+        columns: Sequence[str] | None = None,
+        batch_size: int = BULK_BATCH_SIZE,
+        engine: Engine | None = None
+) -> BulkResult:
+    """
+    Inserts rows, updating existing ones on conflict by unique keys: ON CONFLICT DO UPDATE for PostgreSQL and SQLite,
+    ON DUPLICATE KEY UPDATE for MySQL. Rows are consumed lazily and sent by batches, one transaction per batch.
+
+    @param table: table, entity class or Django model (mirrored by sa_table)
+    @param rows: mappings column => value, or sequences of values in columns order
+    @param conflict_keys: columns of the unique constraint identifying existing rows
+    @param update_columns: columns to update on conflict, all except conflict_keys by default; empty - do nothing
+    @param columns: columns of rows, keys of the first row or all table columns by default
+    @param batch_size: number of rows sent by a single statement execution
+    @param engine: database engine, default engine if None
+    """
+    table = _as_table(table)
+    engine = engine or get_engine()
+    columns, rows = _split_columns(table, rows, columns)
+    keys = [x.key for x in columns]
+    conflict_columns = [table.c[x] for x in conflict_keys]
+    if update_columns is None:
+        update_columns = [x for x in keys if x not in conflict_keys]
+    update_columns = [table.c[x] for x in update_columns]
+
+    dialect = engine.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        stmt = (pg_insert if dialect == 'postgresql' else sqlite_insert)(table)
+        if update_columns:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=conflict_columns, set_={x: stmt.excluded[x.key] for x in update_columns}
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=conflict_columns)
+    elif dialect in ('mysql', 'mariadb'):
+        stmt = mysql_insert(table)
+        stmt = stmt.on_duplicate_key_update(
+            {x: stmt.inserted[x.key] for x in update_columns or conflict_columns[:1]}
+        )
+    else:
+        raise NotImplementedError(f'bulk_upsert is not implemented for {dialect} database')
+
+    start = time.perf_counter()
+    count = 0
+    for block in iter_blocks(rows, batch_size):
+        params = [row if isinstance(row, Mapping) else dict(zip(keys, row)) for row in block]
+        with engine.begin() as conn:
+            conn.execute(stmt, params)
+        count += len(params)
+    result = BulkResult(count, time.perf_counter() - start)
+    log.info(f'bulk_upsert {table.name}: {result}')
+    return result
+
+
+class _CountingIterator:
+    def __init__(self, iterable: Iterable):
+        self._iterator = iter(iterable)
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = next(self._iterator)
+        self.count += 1
+        return item
+
+
+class _ChunksReader:
+    """File-like object reading from iterator of bytes chunks, for psycopg2 copy_expert."""
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = chunks
+        self._buffer = b''
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+_COPY_TEXT_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def _copy_text_value(value: Any) -> str:
+    """Formats value for PostgreSQL COPY text format: NULL as \\N, bytea in hex format, scalars by str."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\\\x' + bytes(value).hex()
+    if isinstance(value, (list, tuple, dict, set, frozenset)):
+        raise TypeError(f'{type(value).__name__} value is not supported by COPY, use bulk_upsert instead')
+    return str(value).translate(_COPY_TEXT_ESCAPES)
+
+
+def _iter_copy_text(rows: Iterable[Mapping | Sequence], convert: Callable[[Any], tuple]) -> Iterator[bytes]:
+    """Encodes rows in PostgreSQL COPY text format, by chunks of about COPY_CHUNK_SIZE."""
+    lines = []
+    size = 0
+    for row in rows:
+        line = '\t'.join(_copy_text_value(x) for x in convert(row)) + '\n'
+        lines.append(line)
+        size += len(line)
+        if size >= COPY_CHUNK_SIZE:
+            yield ''.join(lines).encode()
+            lines.clear()
+            size = 0
+    if lines:
+        yield ''.join(lines).encode()
+
+
+def copy_rows(
+        table: Table | Type[DeclarativeBase] | Type[models.Model],
+        rows: Iterable[Mapping | Sequence],
+        columns: Sequence[str] | None = None,
+        engine: Engine | None = None
+) -> BulkResult:
+    """
+    Inserts rows into PostgreSQL table with COPY FROM STDIN in a single transaction,
+    streaming rows from the iterator without materializing them.
+
+    @param table: table, entity class or Django model (mirrored by sa_table)
+    @param rows: mappings column => value, or sequences of values in columns order
+    @param columns: columns of rows, keys of the first row or all table columns by default
+    @param engine: database engine, default engine if None
+    """
+    table = _as_table(table)
+    engine = engine or get_engine()
+    if engine.dialect.name != 'postgresql':
+        raise NotImplementedError(f'COPY is not supported by {engine.dialect.name} database')
+    columns, rows = _split_columns(table, rows, columns)
+    defaults = _omitted_defaults(table, columns)
+    preparer = engine.dialect.identifier_preparer
+    sql = (
+        f'COPY {preparer.format_table(table)} ({", ".join(preparer.quote(x.name) for x in (*columns, *defaults))}) '
+        f'FROM STDIN WITH (FORMAT text)'
+    )
+
+    convert = _row_converter(columns, defaults, engine.dialect)
+    start = time.perf_counter()
+    counted = _CountingIterator(rows)
+    with engine.begin() as conn:
+        cursor = conn.connection.cursor()
+        try:
+            if hasattr(cursor, 'copy_expert'):  # psycopg2
+                cursor.copy_expert(sql, _ChunksReader(_iter_copy_text(counted, convert)), size=COPY_CHUNK_SIZE)
+            else:  # psycopg 3
+                with cursor.copy(sql) as copy:
+                    for chunk in _iter_copy_text(counted, convert):
+                        copy.write(chunk)
+        finally:
+            cursor.close()
+    result = BulkResult(counted.count, time.perf_counter() - start)
+    log.info(f'copy_rows {table.name}: {result}')
+    return result
+
+
+def bulk_insert(
+        table: Table | Type[DeclarativeBase] | Type[models.Model],
+        rows: Iterable[Mapping | Sequence],
+        columns: Sequence[str] | None = None,
+        batch_size: int = BULK_BATCH_SIZE,
+        engine: Engine | None = None
+) -> BulkResult:
+    """
+    Inserts rows by the fastest way supported by the database: COPY for PostgreSQL (see copy_rows),
+    DB-API executemany by batches in a single transaction for SQLite, SqlAlchemy executemany for others.
+
+    @param table: table, entity class or Django model (mirrored by sa_table)
+    @param rows: mappings column => value, or sequences of values in columns order
+    @param columns: columns of rows, keys of the first row or all table columns by default
+    @param batch_size: number of rows sent by a single executemany call
+    @param engine: database engine, default engine if None
+    """
+    table = _as_table(table)
+    engine = engine or get_engine()
+    if engine.dialect.name == 'postgresql':
+        return copy_rows(table, rows, columns=columns, engine=engine)
+
+    columns, rows = _split_columns(table, rows, columns)
+    start = time.perf_counter()
+    count = 0
+    with engine.begin() as conn:
+        if engine.dialect.name == 'sqlite':
+            defaults = _omitted_defaults(table, columns)
+            names = [engine.dialect.identifier_preparer.quote(x.name) for x in (*columns, *defaults)]
+            sql = (
+                f'INSERT INTO {engine.dialect.identifier_preparer.format_table(table)} ({", ".join(names)}) '
+                f'VALUES ({", ".join("?" * len(names))})'
+            )
+            convert = _row_converter(columns, defaults, engine.dialect)
+            cursor = conn.connection.cursor()
+            try:
+                for block in iter_blocks(rows, batch_size):
+                    cursor.executemany(sql, [convert(row) for row in block])
+                    count += len(block)
+            finally:
+                cursor.close()
+        else:
+            stmt = insert(table)
+            keys = [x.key for x in columns]
+            for block in iter_blocks(rows, batch_size):
+                conn.execute(stmt, [row if isinstance(row, Mapping) else dict(zip(keys, row)) for row in block])
+                count += len(block)
+    result = BulkResult(count, time.perf_counter() - start)
+    log.info(f'bulk_insert {table.name}: {result}')
+    return result
+
+
+def _keyset_after(keys: Sequence[ColumnElement], values: Sequence) -> ColumnElement:
+    """Returns condition (keys) > (values) expanded to AND/OR, since not every database compares row values."""
+    return or_(*(
+        and_(*(key == value for key, value in zip(keys[:num], values[:num])), keys[num] > values[num])
+        for num in range(len(keys))
+    ))
+
+
+def _iter_keyset_pages(
+        stmt: Select, batch_size: int, keys: Sequence[ColumnElement] | None, engine: Engine
+) -> Iterator[Sequence[Row | tuple]]:
+    if not keys:
+        froms = stmt.get_final_froms()
+        if len(froms) != 1 or not getattr(froms[0], 'primary_key', None):
+            raise ValueError('keys are required for keyset pagination of a statement not selecting from a single table')
+        keys = list(froms[0].primary_key.columns)
+
+    selected = list(stmt.selected_columns)
+    width = len(selected)
+    extra, positions = [], []
+    for key in keys:
+        position = next((num for num, x in enumerate(selected) if x.compare(key)), None)
+        if position is None:
+            position = width + len(extra)
+            extra.append(key)
+        positions.append(position)
+
+    page_stmt = stmt.add_columns(*extra).order_by(None).order_by(*keys).limit(batch_size)
+    last = None
+    while True:
+        with engine.connect() as conn:
+            rows = conn.execute(page_stmt if last is None else page_stmt.where(_keyset_after(keys, last))).all()
+        if not rows:
             return
-        json_info = jsonpickle_dumps(info)
-        setattr(obj, attr_name, json_info)
+        last = [rows[-1][x] for x in positions]
+        yield [x[:width] for x in rows] if extra else rows
+        if len(rows) < batch_size:
+            return
+
+
+def stream_query(
+        stmt: Select,
+        batch_size: int = STREAM_BATCH_SIZE,
+        keys: Sequence[ColumnElement] | None = None,
+        columns: bool = False,
+        engine: Engine | None = None
+) -> Iterator[Sequence[Row | tuple]] | Iterator[dict[str, list]]:
+    """
+    Executes select statement yielding results by batches, so memory usage does not depend on the result size.
+    Databases supporting server-side cursors (PostgreSQL, MySQL) stream the single query result, others (SQLite,
+    MSSQL) are read page by page with keyset pagination: ordered by keys, each page starting after the last keys
+    of the previous one, each page in its own short transaction.
+    Usage:
+        for batch in stream_query(select(sa_table(TaskHandle)), columns=True):
+            process(batch['task_id'], batch['created_at'])
+
+    @param stmt: select statement
+    @param batch_size: number of rows in a batch
+    @param keys: unique non-null columns ordering keyset pagination (statement order is replaced),
+        primary key of the single selected table by default; not used with server-side cursors
+    @param columns: yield batches as column buffers - column name => list of values, instead of rows
+    @param engine: SqlAlchemy engine, default database engine if None
+    """
+    if batch_size <= 0:
+        raise ValueError('batch_size must be positive integer')
+    engine = engine or get_engine()
+
+    def _batches() -> Iterator[Sequence[Row | tuple]]:
+        if engine.dialect.supports_server_side_cursors:
+            with engine.connect() as conn:
+                yield from conn.execution_options(yield_per=batch_size).execute(stmt).partitions()
+        else:
+            yield from _iter_keyset_pages(stmt, batch_size, keys, engine)
+
+    if not columns:
+        yield from _batches()
+        return
+    names = list(stmt.selected_columns.keys())
+    for batch in _batches():
+        yield {name: list(values) for name, values in zip(names, zip(*batch))}
+
+
+def iter_query_csv(
+        stmt: Select,
+        headers: Iterable[str] | None = None,
+        batch_size: int = STREAM_BATCH_SIZE,
+        keys: Sequence[ColumnElement] | None = None,
+        engine: Engine | None = None,
+        **kwargs
+) -> Iterator[bytes]:
+    """
+    Generates CSV with rows of the select statement (see misc.iter_csv), streamed by stream_query.
+    @param headers: headers, column names by default
+    @param kwargs: iter_csv arguments (chunk_size, dialect, encoding, gzip...)
+    """
+    rows = itertools.chain.from_iterable(stream_query(stmt, batch_size, keys=keys, engine=engine))
+    if headers is None:
+        headers = list(stmt.selected_columns.keys())
+    return iter_csv(rows, headers=headers, values=lambda x: x, **kwargs)
+
+
+def iter_query_jsonl(
+        stmt: Select,
+        batch_size: int = STREAM_BATCH_SIZE,
+        keys: Sequence[ColumnElement] | None = None,
+        engine: Engine | None = None,
+        **kwargs
+) -> Iterator[bytes]:
+    """
+    Generates JSON Lines with rows of the select statement as objects column name => value (see misc.iter_jsonl),
+    streamed by stream_query.
+    @param kwargs: iter_jsonl arguments (chunk_size, gzip)
+    """
+    names = list(stmt.selected_columns.keys())
+    rows = itertools.chain.from_iterable(stream_query(stmt, batch_size, keys=keys, engine=engine))
+    return iter_jsonl(rows, values=lambda x: dict(zip(names, x)), **kwargs)
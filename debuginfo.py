@@ -0,0 +1,200 @@
+"""
+Bounded serializer of debug info objects (see dba.save_debug_info).
+
+Objects are flattened by jsonpickle once, limited by depth, number of items of every container and approximate
+total size of the values, with truncation markers left in place of dropped data, then encoded by simplejson.
+The limits are applied while flattening, so dropped items and objects beyond the size budget are not walked.
+The output is compatible with misc.jsonpickle_dumps and misc.compact_debug_info, and the compacted form can be
+produced from the same flattened data without parsing the JSON back.
+
+Usage:
+    serializer = DebugInfoSerializer(max_depth=8, max_items=100, max_bytes=64*1024)
+    with open('info.json', 'w', encoding='utf-8') as f:
+        serializer.write(obj, f)
+    full, compacted = serializer.dumps_with_compact(obj)
+"""
+
+import decimal
+import itertools
+from typing import Any, TextIO
+import simplejson
+import jsonpickle
+
+# local imports
+from .misc import JSONPICKLE_ENCODER_OPTIONS, json_dumps, _compact_pickled_data
+
+DEBUG_INFO_MAX_DEPTH = 16;              """default max depth of objects nesting, deeper objects are replaced by repr"""
+DEBUG_INFO_MAX_ITEMS = 1000;            """default max number of items of a single list or dict"""
+DEBUG_INFO_MAX_BYTES = 1024*1024;       """default approximate max total size of keys and values, in bytes"""
+DEBUG_INFO_TRUNCATED_KEY = '...';       """key of the truncation marker added to dict"""
+
+
+class DebugInfoSerializer:
+    def __init__(
+            self,
+            max_depth: int | None = DEBUG_INFO_MAX_DEPTH,
+            max_items: int | None = DEBUG_INFO_MAX_ITEMS,
+            max_bytes: int | None = DEBUG_INFO_MAX_BYTES
+    ):
+        """
+        @param max_depth: max depth of objects nesting, None for unlimited
+        @param max_items: max number of items of a single list or dict, None for unlimited
+        @param max_bytes: approximate max total size of keys and values, in bytes; None for unlimited
+        """
+        if max_items is not None and max_items <= 0 or max_bytes is not None and max_bytes <= 0:
+            raise ValueError('max_items and max_bytes must be positive integers')
+        self.max_depth = max_depth
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._encoder = simplejson.JSONEncoder(**JSONPICKLE_ENCODER_OPTIONS)
+
+    def __str__(self):
+        return (
+            f'DebugInfoSerializer(max_depth={self.max_depth}, max_items={self.max_items}, max_bytes={self.max_bytes})'
+        )
+
+    def flatten(self, obj: Any) -> Any:
+        """Returns JSON-compatible representation of the object, limited and with sorted keys."""
+        pickler = _LimitingPickler(self.max_items, self.max_bytes, max_depth=self.max_depth, use_decimal=True)
+        return _Limiter(self.max_items, self.max_bytes).limit(pickler.flatten(obj))
+
+    def write(self, obj: Any, fp: TextIO) -> None:
+        """Streams serialized object to the text file-like object (file, io.StringIO, database buffer, etc.)."""
+        fp.writelines(self._encoder.iterencode(self.flatten(obj)))
+
+    def dumps(self, obj: Any) -> str:
+        """Returns serialized object."""
+        return self._encoder.encode(self.flatten(obj))
+
+    def encode(self, data: Any) -> str:
+        """Returns serialized flattened data."""
+        return self._encoder.encode(data)
+
+    @staticmethod
+    def compact(data: Any, remove_protected: bool = False) -> str:
+        """Returns flattened data in the form equal to misc.compact_debug_info applied to the serialized one."""
+        return json_dumps(_compact_pickled_data(data, remove_protected=remove_protected))
+
+    def dumps_with_compact(self, obj: Any, remove_protected: bool = False) -> tuple[str, str]:
+        """
+        Serializes the object in full and compacted forms.
+        @param obj: object to serialize
+        @param remove_protected: remove items with keys starting with '_' from the compacted form
+        @return: full form and form equal to misc.compact_debug_info applied to the full one
+        """
+        data = self.flatten(obj)
+        return self.encode(data), self.compact(data, remove_protected=remove_protected)
+
+
+class _Dropped:
+    """Placeholder of container items dropped by _LimitingPickler, the last item of the flattened container."""
+    __slots__ = ('count',)
+
+    def __init__(self, count: int):
+        self.count = count
+
+
+_SKIPPED = object();  """placeholder of data not flattened because the size budget was spent"""
+
+
+class _LimitingPickler(jsonpickle.Pickler):
+    """
+    Pickler not walking data _Limiter drops anyway: containers are cut to max_items before flattening, and once
+    the size budget is spent, the rest is replaced by _SKIPPED, which _Limiter treats as the end of the budget.
+    """
+
+    def __init__(self, max_items: int | None, max_bytes: int | None, **kwargs):
+        super().__init__(**kwargs)
+        self._max_items = max_items
+        self._remaining = max_bytes
+        self._cut: list = [];  """cut copies of containers, kept alive as jsonpickle refers to objects by id"""
+
+    def _flatten(self, obj: Any) -> Any:
+        if self._remaining is not None:
+            if self._remaining <= 0:
+                return _SKIPPED
+            if isinstance(obj, str):
+                self._remaining -= len(obj)
+            elif obj is None or isinstance(obj, int | float | decimal.Decimal):
+                self._remaining -= 8  # containers and objects are not counted, as by _Limiter
+
+        if self._max_items is None:
+            return super()._flatten(obj)
+        if type(obj) in (list, tuple) and len(obj) > self._max_items:
+            cut = obj[:self._max_items]
+        elif type(obj) in (set, frozenset) and len(obj) > self._max_items:
+            cut = type(obj)(itertools.islice(obj, self._max_items))
+        elif type(obj) is dict and len(obj) > self._max_items:
+            cut = dict(itertools.islice(obj.items(), self._max_items))
+        else:
+            return super()._flatten(obj)
+
+        self._cut.append(cut)
+        data = super()._flatten(cut)
+        dropped = _Dropped(len(obj) - self._max_items)
+        if isinstance(cut, dict):
+            data[DEBUG_INFO_TRUNCATED_KEY] = dropped
+        elif isinstance(data, list):
+            data.append(dropped)
+        elif isinstance(data, dict) and len(data) == 1 and isinstance(next(iter(data.values())), list):
+            next(iter(data.values())).append(dropped)  # {'py/tuple': [...]} or {'py/set': [...]}
+        return data
+
+
+class _Limiter:
+    """
+    Copies flattened data keeping the limits: converts tuples to lists as the encoder does, takes dict items
+    in the order flattened (as _LimitingPickler does) and sorts kept keys.
+    """
+    def __init__(self, max_items: int | None, max_bytes: int | None):
+        self.max_items = max_items
+        self.remaining = max_bytes
+
+    def _spend(self, value: Any) -> Any:
+        if self.remaining is None:
+            return value
+        if isinstance(value, str):
+            size = len(value.encode())
+            if size > self.remaining:
+                # keep the prefix fitting the budget, at least a few characters to recognize the value
+                keep = max(self.remaining, 16)
+                self.remaining = 0
+                if len(value) <= keep:
+                    return value
+                return f'{value[:keep]}... [{len(value) - keep} more chars truncated]'
+            self.remaining -= size
+        else:
+            self.remaining -= 8
+        return value
+
+    def _exhausted(self, value: Any = None) -> bool:
+        if value is _SKIPPED:
+            self.remaining = 0
+            return True
+        return self.remaining is not None and self.remaining <= 0
+
+    def limit(self, data: Any) -> Any:
+        if isinstance(data, list | tuple):
+            # items dropped by the pickler are counted too, _Dropped takes the place of one of them
+            extra = data[-1].count - 1 if data and isinstance(data[-1], _Dropped) else 0
+            result = []
+            for num, value in enumerate(data):
+                if self._exhausted(value) or self.max_items is not None and num >= self.max_items:
+                    result.append(f'... {len(data) - num + extra} more items truncated')
+                    break
+                result.append(self.limit(value))
+            return result
+
+        if isinstance(data, dict):
+            dropped = data.get(DEBUG_INFO_TRUNCATED_KEY)
+            extra = dropped.count - 1 if isinstance(dropped, _Dropped) else 0
+            result = {}
+            for num, key in enumerate(data):
+                if self._exhausted(data[key]) or self.max_items is not None and num >= self.max_items:
+                    result[DEBUG_INFO_TRUNCATED_KEY] = f'{len(data) - num + extra} more keys truncated'
+                    break
+                self._spend(key)
+                result[key] = self.limit(data[key])
+            return dict(sorted(result.items()))
+
+        return self._spend(data)
@@ -0,0 +1,271 @@
+"""
+On-disk cache of HTTP GET responses for misc.http_request.
+
+Fresh responses (younger than ttl) are returned without network access. Stale ones are revalidated
+with conditional request (If-None-Match/If-Modified-Since), so unchanged content costs only 304 response.
+Bodies are stored content-addressed (by sha256), total size of bodies is limited by evicting least recently
+used entries. Responses are cached per URL and Authorization header; responses with Vary header are returned
+only for requests with the same values of the listed headers, Vary: * responses are not cached.
+Responses with Cache-Control: no-store or private are not cached, no-cache ones are always revalidated.
+
+Usage:
+    cache = HttpCache('/var/cache/myapp/http', ttl=600, max_size=512*1024*1024)
+    resp = http_request('GET', url, cache=cache)
+"""
+
+import os
+import time
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+log = logging.getLogger(__name__)
+
+HTTP_CACHE_TTL_DEFAULT = 300.0;                 """default interval the response is considered fresh, in seconds"""
+HTTP_CACHE_MAX_SIZE_DEFAULT = 256*1024*1024;    """default max total size of cached bodies, in bytes"""
+HTTP_CACHE_SKIP_HEADERS = ('content-encoding', 'transfer-encoding', 'content-length');  """not valid for stored body"""
+
+
+class HttpCache:
+    def __init__(
+            self, directory: str, ttl: float = HTTP_CACHE_TTL_DEFAULT, max_size: int = HTTP_CACHE_MAX_SIZE_DEFAULT
+    ):
+        """
+        @param directory: directory to keep cache in, created if not exists
+        @param ttl: interval after which cached response must be revalidated, in seconds
+        @param max_size: max total size of cached bodies, in bytes
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+
+        self.hits = 0;              """responses returned from cache without network access"""
+        self.misses = 0;            """responses received from network"""
+        self.revalidations = 0;     """stale responses confirmed by 304 Not Modified"""
+        self.evictions = 0;         """entries evicted to keep max_size"""
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, dict] = OrderedDict();  """cache key => entry, least recently used first"""
+        self._body_refs: dict[str, int] = {};  """body hash => number of entries referencing it"""
+        self._size = 0
+        os.makedirs(os.path.join(directory, 'entries'), exist_ok=True)
+        os.makedirs(os.path.join(directory, 'bodies'), exist_ok=True)
+        self._load()
+
+    def __str__(self):
+        return f'HttpCache(hits={self.hits}, misses={self.misses}, revalidations={self.revalidations})'
+
+    @staticmethod
+    def _key(url: str, request_headers: Mapping[str, str] | None = None) -> str:
+        """Cache key of the URL, responses to differently authorized requests are kept apart."""
+        authorization = CaseInsensitiveDict(request_headers or {}).get('Authorization')
+        return hashlib.sha256(f'{url}\n{authorization or ""}'.encode()).hexdigest()
+
+    @staticmethod
+    def _cache_control(resp: requests.Response) -> set[str]:
+        """Returns names of Cache-Control directives of the response, lowercased."""
+        return {x.split('=', 1)[0].strip().lower() for x in resp.headers.get('Cache-Control', '').split(',')}
+
+    @staticmethod
+    def _vary_matches(entry: dict, request_headers: Mapping[str, str] | None) -> bool:
+        """Checks the request has the same values of headers listed in Vary of the cached response."""
+        if not entry.get('vary'):
+            return True
+        headers = CaseInsensitiveDict(request_headers or {})
+        return all(headers.get(name) == value for name, value in entry['vary'].items())
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.directory, 'entries', f'{key}.json')
+
+    def _body_path(self, body_hash: str) -> str:
+        return os.path.join(self.directory, 'bodies', body_hash[:2], body_hash)
+
+    def _load(self):
+        """Restores index from entries directory, least recently stored first."""
+        entries = []
+        with os.scandir(os.path.join(self.directory, 'entries')) as it:
+            for dir_entry in it:
+                if dir_entry.name.endswith('.json'):
+                    try:
+                        with open(dir_entry.path, encoding='utf-8') as f:
+                            entries.append(json.load(f))
+                    except (OSError, ValueError):
+                        log.warning(f'cannot load http cache entry: {dir_entry.path}')
+        for entry in sorted(entries, key=lambda x: x['stored_at']):
+            self._add(entry.get('key') or self._key(entry['url']), entry)
+        self._evict()
+
+    def _add(self, key: str, entry: dict):
+        self._entries[key] = entry
+        refs = self._body_refs.get(entry['body'], 0)
+        if not refs:
+            self._size += entry['size']
+        self._body_refs[entry['body']] = refs + 1
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        refs = self._body_refs[entry['body']] - 1
+        if refs:
+            self._body_refs[entry['body']] = refs
+        else:
+            del self._body_refs[entry['body']]
+            self._size -= entry['size']
+            self._unlink(self._body_path(entry['body']))
+
+    def _evict(self):
+        while self._size > self.max_size and self._entries:
+            key = next(iter(self._entries))
+            self._remove(key)
+            self._unlink(self._entry_path(key))
+            self.evictions += 1
+
+    @staticmethod
+    def _unlink(path: str):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _write_atomic(path: str, data: bytes):
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _read_body(self, entry: dict) -> bytes:
+        """Reads the whole body: requests.Response content must be bytes, so mapping the file would gain nothing."""
+        if not entry['size']:
+            return b''
+        with open(self._body_path(entry['body']), 'rb') as f:
+            return f.read()
+
+    def _lookup(self, url: str, request_headers: Mapping[str, str] | None) -> dict | None:
+        key = self._key(url, request_headers)
+        entry = self._entries.get(key)
+        if not entry or not self._vary_matches(entry, request_headers):
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _response(self, url: str, entry: dict) -> requests.Response | None:
+        try:
+            content = self._read_body(entry)
+        except OSError:
+            log.warning(f'cannot read cached body for {url}, entry dropped')
+            key = entry.get('key') or self._key(entry['url'])
+            if self._entries.get(key) is entry:
+                self._remove(key)
+                self._unlink(self._entry_path(key))
+            return None
+        resp = requests.Response()
+        resp.status_code = entry['status']
+        resp.headers = CaseInsensitiveDict(entry['headers'])
+        resp.encoding = get_encoding_from_headers(resp.headers)
+        resp.url = url
+        resp._content = content
+        resp.from_cache = True
+        return resp
+
+    def fresh_response(self, url: str, request_headers: Mapping[str, str] | None = None) -> requests.Response | None:
+        """Returns cached response if it is still fresh, None otherwise."""
+        with self._lock:
+            entry = self._lookup(url, request_headers)
+            if not entry or entry.get('no_cache') or time.time() - entry['stored_at'] > self.ttl:
+                return None
+            resp = self._response(url, entry)
+            if resp is not None:
+                self.hits += 1
+            return resp
+
+    def conditional_headers(self, url: str, request_headers: Mapping[str, str] | None = None) -> dict[str, str]:
+        """Returns headers to revalidate cached response, empty dict if nothing cached."""
+        with self._lock:
+            entry = self._entries.get(self._key(url, request_headers))
+            if entry and not self._vary_matches(entry, request_headers):
+                entry = None
+        headers = {}
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def update(
+            self, url: str, resp: requests.Response, request_headers: Mapping[str, str] | None = None
+    ) -> requests.Response:
+        """
+        Processes response received from network for the conditional request.
+        @return: cached response if revalidated with 304, given response otherwise; 304 response is returned
+            if the cached entry is gone meanwhile, the request must be repeated unconditionally then
+        """
+        if resp.status_code == 304:
+            with self._lock:
+                entry = self._lookup(url, request_headers)
+                if entry:
+                    entry['stored_at'] = time.time()
+                    entry['etag'] = resp.headers.get('ETag') or entry['etag']
+                    self._write_atomic(self._entry_path(self._key(url, request_headers)), json.dumps(entry).encode())
+                    cached = self._response(url, entry)
+                    if cached is not None:
+                        self.revalidations += 1
+                        return cached
+
+        with self._lock:
+            self.misses += 1
+        if resp.status_code == 200:
+            self.store(url, resp, request_headers)
+        return resp
+
+    def store(self, url: str, resp: requests.Response, request_headers: Mapping[str, str] | None = None):
+        """Stores response body and headers, except responses with Vary: * or Cache-Control: no-store/private."""
+        vary = [x.strip().lower() for x in resp.headers.get('Vary', '').split(',') if x.strip()]
+        cache_control = self._cache_control(resp)
+        if '*' in vary or 'no-store' in cache_control or 'private' in cache_control:
+            return
+        headers = CaseInsensitiveDict(request_headers or {})
+        key = self._key(url, request_headers)
+        content = resp.content
+        body_hash = hashlib.sha256(content).hexdigest()
+        entry = {
+            'url': url,
+            'status': resp.status_code,
+            'headers': {k: v for k, v in resp.headers.items() if k.lower() not in HTTP_CACHE_SKIP_HEADERS},
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+            'body': body_hash,
+            'size': len(content),
+            'stored_at': time.time(),
+            'key': key,
+            'vary': {x: headers.get(x) for x in vary},
+            'no_cache': 'no-cache' in cache_control,
+        }
+        body_path = self._body_path(body_hash)
+
+        with self._lock:
+            if body_hash not in self._body_refs:
+                os.makedirs(os.path.dirname(body_path), exist_ok=True)
+                self._write_atomic(body_path, content)
+            self._write_atomic(self._entry_path(key), json.dumps(entry).encode())
+            if key in self._entries:
+                self._remove_keep_body(key, body_hash)
+            self._add(key, entry)
+            self._evict()
+
+    def _remove_keep_body(self, key: str, body_hash: str):
+        """Removes entry replaced with the new one, keeps the body file if the new entry references it."""
+        old_body = self._entries[key]['body']
+        if old_body == body_hash:
+            entry = self._entries.pop(key)
+            self._body_refs[old_body] -= 1
+            if not self._body_refs[old_body]:
+                del self._body_refs[old_body]
+                self._size -= entry['size']
+        else:
+            self._remove(key)
@@ -43,7 +43,7 @@ class DatabaseLogHandler(logging.Handler):
                 msg=self.format(record) if DB_LOGGER_ENABLE_FORMATTER else record.getMessage(),
                 trace=_default_formatter.formatException(record.exc_info) if record.exc_info else '',
                 task_id=getattr(record, 'task_id', ''),
-                username=getattr(record, 'username', ''),
+                username=str(getattr(record, 'username', '')),
             ))
 
     def format(self, record):
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('helpers', '0006_alter_taskhandle_max_tries_alter_taskhandle_next_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='taskhandle',
+            index=models.Index(fields=['created_at'], name='idx_task_handle_created_at'),
+        ),
+    ]
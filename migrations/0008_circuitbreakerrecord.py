@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('helpers', '0007_taskhandle_created_at_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CircuitBreakerRecord',
+            fields=[
+                ('name', models.CharField(editable=False, help_text='circuit unique name', max_length=512, primary_key=True, serialize=False)),
+                ('state', models.CharField(help_text='circuit state: closed, open or half-open', max_length=16)),
+                ('opened_at', models.DateTimeField(blank=True, help_text='circuit last opened at', null=True)),
+                ('modified', models.DateTimeField(auto_now=True, help_text='database record last modified at')),
+            ],
+        ),
+    ]
@@ -4,18 +4,50 @@ import sys
 import traceback
 import simplejson
 import datetime
+import decimal
 import requests
-import time
-import random
 import logging
 import typing
 import functools
 import csv
+import codecs
+import time
+import threading
+import hashlib
+import zlib
+import itertools
+import dataclasses
+import urllib.parse
+import http.cookiejar
 import jsonpickle
 from typing import Any
-from collections.abc import Iterable, Callable
-from requests.exceptions import ConnectionError
-from urllib3.exceptions import ProtocolError, MaxRetryError, NewConnectionError
+from collections import deque, Counter, OrderedDict
+from collections.abc import Iterable, Iterator, Callable, Mapping, Sequence
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if typing.TYPE_CHECKING:
+    from .httpcache import HttpCache
+
+HTTP_POOL_MAXSIZE = 10;  """number of keep-alive connections kept per host"""
+HTTP_SESSIONS_MAX = 256;  """max number of shared HTTP sessions (hosts) kept by get_http_session"""
+HTTP_RETRY_STATUSES_DEFAULT = (429, 500, 502, 503, 504);  """response status codes retried by http_request"""
+HTTP_MANY_CONCURRENCY_DEFAULT = 8;  """default number of concurrent requests of http_request_many"""
+HTTP_MANY_PER_HOST_DEFAULT = 4;  """default number of concurrent requests to a single host of http_request_many"""
+HTTP_MANY_BUFFER_FACTOR = 4;  """http_request_many reads ahead up to concurrency*HTTP_MANY_BUFFER_FACTOR requests"""
+MAP_BLOCKS_WORKERS_DEFAULT = 4;  """default number of workers of map_blocks"""
+MAP_BLOCKS_BUFFER_FACTOR = 2;  """map_blocks keeps up to workers*MAP_BLOCKS_BUFFER_FACTOR blocks in flight"""
+CSV_CHUNK_SIZE_DEFAULT = 64*1024;  """default approximate size of chunks yielded by iter_csv and iter_jsonl"""
+QUERYSET_ITERATOR_CHUNK_SIZE = 2000;  """default number of rows fetched at a time by iter_queryset_csv"""
+JSON_BACKEND_DEFAULT = 'orjson';  """JSON backend used if settings.JSON_BACKEND is not defined, see json_backend"""
+JSONPICKLE_ENCODER_OPTIONS = {'use_decimal': True, 'sort_keys': True, 'ensure_ascii': False, 'indent': 4}
+"""simplejson options of jsonpickle_dumps output"""
 
 
 def _json_serial(obj):
@@ -25,19 +57,134 @@ def _json_serial(obj):
     raise TypeError(f'Type {type(obj)} not serializable')
 
 
-def json_dumps(obj) -> str:
+def _orjson_default(obj):
+    """orjson serializer for Decimal: exact representation via raw JSON fragment (orjson>=3.9.15)."""
+    if isinstance(obj, decimal.Decimal) and hasattr(orjson, 'Fragment'):
+        return orjson.Fragment(str(obj))
+    raise TypeError(f'Type {type(obj)} not serializable')
+
+
+def _simplejson_dumps(obj, compact: bool) -> str:
+    if compact:
+        return simplejson.dumps(obj, separators=(',', ':'), ensure_ascii=False, use_decimal=True, default=_json_serial)
     return simplejson.dumps(obj, indent=True, ensure_ascii=False, use_decimal=True, default=_json_serial)
 
 
-def json_loads(data: str):
-    return simplejson.loads(data, use_decimal=True)
+class JsonBackend:
+    """
+    JSON implementation of json_dumps, json_dumps_bytes and json_loads, registered by json_backend_register.
+    Must keep Decimal precision and support datetime and date, as SimplejsonBackend does.
+    """
+    def dumps(self, obj, compact: bool) -> str:
+        raise NotImplementedError
+
+    def dumps_bytes(self, obj, compact: bool) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, data: str | bytes, use_decimal: bool):
+        raise NotImplementedError
+
+
+class SimplejsonBackend(JsonBackend):
+    def dumps(self, obj, compact: bool) -> str:
+        return _simplejson_dumps(obj, compact)
+
+    def dumps_bytes(self, obj, compact: bool) -> bytes:
+        return _simplejson_dumps(obj, compact).encode()
+
+    def loads(self, data: str | bytes, use_decimal: bool):
+        return simplejson.loads(data, use_decimal=use_decimal)
+
+
+class OrjsonBackend(SimplejsonBackend):
+    """
+    orjson if installed, falls back to simplejson if not, and for what orjson cannot do: parsing numbers as Decimal,
+    Decimal with orjson older than 3.9.15, integers beyond 64 bits. Indents by 2 spaces.
+    """
+    def dumps(self, obj, compact: bool) -> str:
+        return self.dumps_bytes(obj, compact).decode() if orjson else super().dumps(obj, compact)
+
+    def dumps_bytes(self, obj, compact: bool) -> bytes:
+        if orjson:
+            option = orjson.OPT_NON_STR_KEYS if compact else orjson.OPT_NON_STR_KEYS | orjson.OPT_INDENT_2
+            try:
+                return orjson.dumps(obj, default=_orjson_default, option=option)
+            except TypeError:
+                pass
+        return super().dumps_bytes(obj, compact)
+
+    def loads(self, data: str | bytes, use_decimal: bool):
+        if not use_decimal and orjson:
+            return orjson.loads(data)
+        return super().loads(data, use_decimal)
+
+
+_json_backends: dict[str, JsonBackend] = {'simplejson': SimplejsonBackend(), 'orjson': OrjsonBackend()}
+"""name => JSON backend, see json_backend_register"""
+_json_backend: JsonBackend | None = None;  """backend in use, selected on first use"""
+
+
+def json_backend_register(name: str, backend: JsonBackend) -> None:
+    """Registers JSON backend, selectable by settings.JSON_BACKEND or json_backend_select."""
+    _json_backends[name] = backend
+
+
+def json_backend_select(name: str | None) -> None:
+    """
+    Selects JSON backend used by json_dumps, json_dumps_bytes and json_loads.
+    @param name: name of the registered backend; None - select by settings on next use
+    """
+    global _json_backend
+    if name is not None and name not in _json_backends:
+        raise ValueError(f'unknown JSON backend: {name}')
+    _json_backend = _json_backends[name] if name is not None else None
+
+
+def json_backend() -> JsonBackend:
+    """Returns JSON backend in use: selected by json_backend_select, or settings.JSON_BACKEND on first use."""
+    backend = _json_backend
+    if backend is None:
+        from django.conf import settings
+        name = getattr(settings, 'JSON_BACKEND', JSON_BACKEND_DEFAULT) if settings.configured else JSON_BACKEND_DEFAULT
+        json_backend_select(name)
+        backend = _json_backend
+    return backend
+
+
+def json_dumps_bytes(obj, compact: bool = True) -> bytes:
+    """
+    Serializes to UTF-8 encoded JSON by the selected backend (see json_backend), without intermediate str if possible.
+    @param obj: object to serialize; Decimal, datetime and date supported
+    @param compact: no indentation and no spaces after separators, for machine consumers
+    """
+    return json_backend().dumps_bytes(obj, compact)
+
+
+def json_dumps(obj, compact: bool = False) -> str:
+    """
+    Serializes to JSON keeping Decimal precision by the selected backend (see json_backend). Indented for humans
+    by default.
+    @param obj: object to serialize; Decimal, datetime and date supported
+    @param compact: no indentation and no spaces after separators, for machine consumers (see json_dumps_bytes)
+    """
+    return json_backend().dumps(obj, compact)
+
+
+def json_loads(data: str | bytes, use_decimal: bool = True):
+    """
+    Parses JSON by the selected backend (see json_backend).
+    @param data: JSON as str or UTF-8 encoded bytes
+    @param use_decimal: parse non-integer numbers as Decimal, float if False
+    """
+    return json_backend().loads(data, use_decimal)
+
+
+_jsonpickle_encoder = simplejson.JSONEncoder(**JSONPICKLE_ENCODER_OPTIONS)
 
 
 def jsonpickle_dumps(self) -> str:
-    jsonpickle.set_encoder_options('simplejson', use_decimal=True, sort_keys=True, ensure_ascii=False, indent=4)
-    jsonpickle.set_preferred_backend('simplejson')
-    json_str = jsonpickle.dumps(self, use_decimal=True)
-    return json_str
+    """Serializes object with jsonpickle, unlimited; see debuginfo.DebugInfoSerializer for the bounded one."""
+    return _jsonpickle_encoder.encode(jsonpickle.Pickler(use_decimal=True).flatten(self))
 
 
 def get_download_path() -> str:
@@ -53,20 +200,213 @@ def get_download_path() -> str:
         return os.path.join(os.path.expanduser('~'), 'downloads')
 
 
-def http_request(method: str, url: str, retries: int = 5, random_retry_pause: float = 0, **kwargs):
-    while True:
-        try:
-            resp = requests.request(method, url, **kwargs)
-            if resp.status_code == 200 or retries <= 0:
-                if resp.status_code != 200:
-                    raise RuntimeError(f'status_code={resp.status_code}')
-                return resp
-        except (ConnectionResetError, ProtocolError, ConnectionError, MaxRetryError, NewConnectionError, TimeoutError):
-            if retries <= 0:
-                raise
-        if random_retry_pause > 0:
-            time.sleep(random.uniform(random_retry_pause/2.0, random_retry_pause))
-        retries -= 1
+_http_sessions: OrderedDict[tuple, requests.Session] = OrderedDict();  """least recently used first"""
+_http_sessions_lock = threading.Lock()
+
+
+def get_http_session(
+        url: str, retries: int = 5, random_retry_pause: float = 0,
+        retry_statuses: Iterable[int] = HTTP_RETRY_STATUSES_DEFAULT, pool_maxsize: int = HTTP_POOL_MAXSIZE
+) -> requests.Session:
+    """
+    Returns shared HTTP session for the host of given URL, keeping connections alive between requests.
+    Sessions are cached per host and retry configuration, the retries are performed by urllib3.
+    Up to HTTP_SESSIONS_MAX recently used sessions are kept, evicted ones are closed.
+    The session does not keep cookies, pass them with every request.
+
+    @param url: URL to get session for, only scheme and host matter
+    @param retries: number of retries on connection errors, read errors and retry_statuses
+    @param random_retry_pause: base pause between retries, grows exponentially (urllib3 backoff_factor*2)
+    @param retry_statuses: response status codes to retry
+    @param pool_maxsize: number of keep-alive connections kept for the host, i.e. max concurrent requests
+    """
+    parsed = urllib.parse.urlsplit(url)
+    key = (parsed.scheme, parsed.netloc, retries, random_retry_pause, tuple(retry_statuses), pool_maxsize)
+    with _http_sessions_lock:
+        session = _http_sessions.get(key)
+        if session is not None:
+            _http_sessions.move_to_end(key)
+            return session
+
+        max_retries = Retry(
+            total=retries, backoff_factor=random_retry_pause / 2, status_forcelist=retry_statuses,
+            allowed_methods=None, raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=max_retries)
+        session = requests.Session()
+        # shared by all callers, so stateless as requests.request: cookies of responses are not kept
+        session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        session.mount(f'{parsed.scheme}://', adapter)
+        _http_sessions[key] = session
+        while len(_http_sessions) > HTTP_SESSIONS_MAX:
+            _, evicted = _http_sessions.popitem(last=False)
+            evicted.close()
+    return session
+
+
+def _reset_http_sessions():
+    """Connections of the parent process must not be shared with forked child."""
+    global _http_sessions_lock
+    _http_sessions_lock = threading.Lock()
+    _http_sessions.clear()
+
+
+if hasattr(os, 'register_at_fork'):  # not available on Windows
+    os.register_at_fork(after_in_child=_reset_http_sessions)
+
+
+def http_request(
+        method: str, url: str, retries: int = 5, random_retry_pause: float = 0,
+        ok_statuses: Iterable[int] = (200, ), retry_statuses: Iterable[int] = HTTP_RETRY_STATUSES_DEFAULT,
+        cache: 'HttpCache' = None, **kwargs
+) -> requests.Response:
+    """
+    Performs HTTP request via shared keep-alive session (see get_http_session) with retries.
+
+    @param method: HTTP method
+    @param url: URL to request
+    @param retries: number of retries on connection errors and retry_statuses
+    @param random_retry_pause: base pause between retries, in seconds
+    @param ok_statuses: response status codes considered successful, RuntimeError raised for others
+    @param retry_statuses: response status codes to retry
+    @param cache: if given, GET responses are cached and revalidated with conditional requests (see httpcache);
+        requests with auth or cookies arguments are not cached
+    @param kwargs: other arguments for requests.Session.request
+    @return: response
+    """
+    cache_url = None
+    conditional_headers = None
+    request_headers = kwargs.get('headers') or {}
+    if cache is not None and method.upper() == 'GET' and not kwargs.get('auth') and not kwargs.get('cookies'):
+        cache_url = requests.Request(method, url, params=kwargs.get('params')).prepare().url
+        cached = cache.fresh_response(cache_url, request_headers)
+        if cached is not None:
+            return cached
+        conditional_headers = cache.conditional_headers(cache_url, request_headers)
+        if conditional_headers:
+            kwargs['headers'] = {**request_headers, **conditional_headers}
+
+    session = get_http_session(
+        url, retries=retries, random_retry_pause=random_retry_pause, retry_statuses=retry_statuses
+    )
+    resp = session.request(method, url, **kwargs)
+    if cache_url:
+        resp = cache.update(cache_url, resp, request_headers)
+        if resp.status_code == 304 and conditional_headers:
+            # cached body gone after conditional headers were sent: repeat the request unconditionally
+            kwargs['headers'] = request_headers
+            resp = cache.update(cache_url, session.request(method, url, **kwargs), request_headers)
+    if resp.status_code not in ok_statuses:
+        raise RuntimeError(f'status_code={resp.status_code}')
+    return resp
+
+
+class _HostRateLimiter:
+    """Spaces requests to a single host evenly according to the given rate, used by the dispatcher thread only."""
+
+    def __init__(self, rate: float):
+        self._interval = 1.0 / rate
+        self.next_at = 0.0;  """monotonic time the next request is allowed at"""
+
+    def acquire(self, now: float) -> None:
+        self.next_at = max(now, self.next_at) + self._interval
+
+
+def http_request_many(
+        http_requests: Iterable[tuple[str, str] | dict],
+        concurrency: int = HTTP_MANY_CONCURRENCY_DEFAULT,
+        per_host: int = HTTP_MANY_PER_HOST_DEFAULT,
+        rate: float = None,
+        **kwargs
+) -> Iterator[tuple[int, requests.Response | Exception]]:
+    """
+    Performs many HTTP requests concurrently on a thread pool over shared keep-alive sessions (see http_request).
+    The input is consumed lazily, results are yielded as soon as completed, in completion order.
+
+    @param http_requests: (method, url) tuples or dicts with 'method', 'url' and other http_request arguments
+    @param concurrency: max number of concurrent requests
+    @param per_host: max number of concurrent requests to a single host
+    @param rate: max number of requests per second to a single host; None - unlimited
+    @param kwargs: common http_request arguments (retries, random_retry_pause, ok_statuses, timeout...)
+    @return: generator of (index of the request in the input, response or exception raised)
+    """
+    if concurrency <= 0 or per_host <= 0:
+        raise ValueError('concurrency and per_host must be positive integers')
+    if rate is not None and rate <= 0:
+        raise ValueError('rate must be positive float or None')
+
+    limiters: dict[str, _HostRateLimiter] = {}
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='http_request_many')
+    futures: dict[Future, tuple[int, str]] = {}
+    in_flight = Counter()
+    waiting: dict[str, deque] = {};  """requests read ahead, waiting for their host's free capacity"""
+    num_waiting = 0
+    items = enumerate(http_requests)
+    exhausted = False
+
+    def _can_submit(host: str, now: float) -> bool:
+        return len(futures) < concurrency and in_flight[host] < per_host and (not rate or limiters[host].next_at <= now)
+
+    def _submit(index: int, host: str, request: dict, now: float):
+        in_flight[host] += 1
+        if rate:
+            limiters[host].acquire(now)
+        futures[executor.submit(http_request, **request)] = (index, host)
+
+    try:
+        while True:
+            # submit requests read ahead before, if their hosts got free capacity;
+            # rate limited requests wait here in the dispatcher, not occupying workers
+            now = time.monotonic()
+            for host in list(waiting):
+                queue = waiting[host]
+                while queue and _can_submit(host, now):
+                    _submit(*queue.popleft(), now)
+                    num_waiting -= 1
+                if not queue:
+                    del waiting[host]
+
+            # read ahead new requests
+            while not exhausted and len(futures) < concurrency and num_waiting < concurrency*HTTP_MANY_BUFFER_FACTOR:
+                try:
+                    index, item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if not isinstance(item, dict):
+                    item = {'method': item[0], 'url': item[1]}
+                request = {**kwargs, **item}
+                host = urllib.parse.urlsplit(request['url']).netloc
+                if rate and host not in limiters:
+                    limiters[host] = _HostRateLimiter(rate)
+                if host not in waiting and _can_submit(host, now):
+                    _submit(index, host, request, now)
+                else:
+                    waiting.setdefault(host, deque()).append((index, host, request))
+                    num_waiting += 1
+
+            # wake up when the earliest rate limited host is allowed, if it is not waiting for free capacity
+            timeout = None
+            if rate and len(futures) < concurrency:
+                due = [limiters[x].next_at for x in waiting if in_flight[x] < per_host]
+                if due:
+                    timeout = max(0.0, min(due) - time.monotonic())
+
+            if not futures:
+                if timeout is None:
+                    break
+                time.sleep(timeout)
+                continue
+
+            done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, host = futures.pop(future)
+                in_flight[host] -= 1
+                ex = future.exception()
+                yield index, ex if ex else future.result()
+
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
 def exception_descr(ex, tb=None):
@@ -151,62 +491,328 @@ class FrozenClass(object):
         self.__frozen = False
 
 
-def todict(obj, class_key=None):
+def _frozen_slots_setattr(self, key, value):
+    if not self._unfrozen:
+        raise dataclasses.FrozenInstanceError(f'{self} is immutable, cannot assign to field {key!r}')
+    object.__setattr__(self, key, value)
+
+
+def _frozen_slots_delattr(self, key):
+    if not self._unfrozen:
+        raise dataclasses.FrozenInstanceError(f'{self} is immutable, cannot delete field {key!r}')
+    object.__delattr__(self, key)
+
+
+def _frozen_slots_freeze(self):
+    object.__setattr__(self, '_unfrozen', False)
+
+
+def _frozen_slots_unfreeze(self):
+    object.__setattr__(self, '_unfrozen', True)
+
+
+def _frozen_slots_noop(self):
+    pass
+
+
+def _frozen_slots_cannot_unfreeze(self):
+    raise TypeError(f'{type(self).__name__} has __slots__, attributes cannot be added to its instances')
+
+
+def frozen_slots(_cls=None, *, immutable: bool = False, eq: bool = True, **kwargs):
     """
-    Generic object to dict converter. Recursively convert.
-    Useful for testing and asserting objects with expectation.
-    Source: https://gist.github.com/sairamkrish/ab68be93b53b34c98e24908c67dfda0d
+    Class decorator, compact and fast replacement of FrozenClass for small value objects.
+    Generates dataclass with __slots__ from annotated fields, instances have no __dict__ and attributes
+    not declared cannot be added (AttributeError), as to frozen FrozenClass instances. Unlike FrozenClass,
+    they are always frozen: freeze() does nothing, unfreeze() raises TypeError (except for immutable ones).
+    Usage:
+        @frozen_slots
+        class Point:
+            x: int
+            y: int = 0
+
+    @param immutable: forbid changing fields after __init__ too, until unfreeze() is called; generates __hash__
+    @param eq: generate __eq__ comparing fields
+    @param kwargs: other dataclass parameters (repr, order, kw_only...)
     """
-    if isinstance(obj, dict):
+    def decorator(cls):
+        if immutable:
+            cls.__annotations__ = {**cls.__dict__.get('__annotations__', {}), '_unfrozen': bool}
+            cls._unfrozen = dataclasses.field(default=False, init=False, repr=False, compare=False)
+        cls = dataclasses.dataclass(cls, slots=True, eq=eq, frozen=immutable, **kwargs)
+        if immutable:
+            cls.__setattr__ = _frozen_slots_setattr
+            cls.__delattr__ = _frozen_slots_delattr
+            cls.freeze = _frozen_slots_freeze
+            cls.unfreeze = _frozen_slots_unfreeze
+        else:
+            # set of attributes is fixed by __slots__, instances are always frozen in FrozenClass sense
+            cls.freeze = _frozen_slots_noop
+            cls.unfreeze = _frozen_slots_cannot_unfreeze
+        return cls
+
+    if _cls is None:
+        return decorator
+    else:
+        return decorator(_cls)
+
+
+_todict_converters: dict[type, Callable[[Any, Callable[[Any], Any]], Any]] = {}
+"""class => custom converter registered by todict_register"""
+_todict_plans: dict[type, Callable[['_ToDict', Any], Any]] = {}
+"""class => conversion plan compiled on first use"""
+_todict_scalars: set[type] = {str, int, float, bool, type(None), decimal.Decimal, datetime.date}
+"""classes todict returns as is, checked inline to avoid plan call per value"""
+_todict_lock = threading.Lock()
+
+
+def todict_register(cls: type, converter: Callable[[Any, Callable[[Any], Any]], Any]) -> None:
+    """
+    Registers custom todict conversion for the class and its subclasses.
+    @param cls: class to convert with the converter
+    @param converter: callable(obj, convert) returning converted object, convert converts nested values
+    """
+    with _todict_lock:
+        _todict_converters[cls] = converter
+        _todict_scalars.difference_update([x for x in _todict_scalars if issubclass(x, cls)])
+        _todict_plans.clear()
+
+
+class _ToDict:
+    __slots__ = ('class_key', '_active')
+
+    def __init__(self, class_key: str | None):
+        self.class_key = class_key
+        self._active: set[int] = set();  """ids of containers being converted, to detect cycles"""
+
+    def convert(self, obj: Any) -> Any:
+        cls = type(obj)
+        if cls in _todict_scalars:
+            return obj
+        plan = _todict_plans.get(cls)
+        if plan is None:
+            plan = _todict_plans[cls] = _todict_compile(cls, obj)
+        return plan(self, obj)
+
+    def enter(self, obj: Any) -> None:
+        obj_id = id(obj)
+        if obj_id in self._active:
+            raise ValueError(f'todict: circular reference to {type(obj).__name__} object')
+        self._active.add(obj_id)
+
+    def leave(self, obj: Any) -> None:
+        self._active.discard(id(obj))
+
+
+def _todict_scalar(_converter: _ToDict, obj: Any) -> Any:
+    return obj
+
+
+def _todict_datetime(_converter: _ToDict, obj: datetime.datetime) -> str:
+    return obj.strftime("%Y-%m-%d %H:%M:%S%z")
+
+
+def _todict_ast(_converter: _ToDict, obj: Any) -> Any:
+    # noinspection PyProtectedMember
+    return _ToDict(None).convert(obj._ast())
+
+
+def _todict_dict(converter: _ToDict, obj: dict) -> dict:
+    converter.enter(obj)
+    convert = converter.convert
+    data = {k: v if type(v) in _todict_scalars else convert(v) for k, v in obj.items()}
+    converter.leave(obj)
+    return data
+
+
+def _todict_iterable(converter: _ToDict, obj: Iterable) -> list:
+    converter.enter(obj)
+    convert = converter.convert
+    data = [v if type(v) in _todict_scalars else convert(v) for v in obj]
+    converter.leave(obj)
+    return data
+
+
+def _todict_object_plan(cls: type, names: tuple[str, ...], has_dict: bool) -> Callable[[_ToDict, Any], dict]:
+    """
+    Compiles conversion of the object to dict of its public non-callable attributes.
+    @param names: public attributes to take by name (dataclass fields, slots)
+    @param has_dict: take public attributes from instance __dict__ as well
+    """
+    class_name = cls.__name__
+    missing = object()
+
+    def _plan(converter: _ToDict, obj: Any) -> dict:
+        converter.enter(obj)
+        convert = converter.convert
         data = {}
-        for (k, v) in obj.items():
-            data[k] = todict(v, class_key)
+        for key in names:
+            value = getattr(obj, key, missing)
+            if type(value) in _todict_scalars:
+                data[key] = value
+            elif value is not missing and not callable(value):
+                data[key] = convert(value)
+        if has_dict:
+            for key, value in obj.__dict__.items():
+                if key[:1] == '_':
+                    continue
+                if type(value) in _todict_scalars:
+                    data[key] = value
+                elif not callable(value):
+                    data[key] = convert(value)
+        if converter.class_key is not None:
+            data[converter.class_key] = class_name
+        converter.leave(obj)
         return data
 
-    elif hasattr(obj, '_ast'):
-        # noinspection PyProtectedMember
-        return todict(obj._ast())
+    return _plan
 
-    elif hasattr(obj, '__iter__') and not isinstance(obj, str):
-        return [todict(v, class_key) for v in obj]
 
-    elif hasattr(obj, '__dict__'):
-        data = dict([
-            (key, todict(value, class_key)) for key, value in obj.__dict__.items()
-            if not callable(value) and not key.startswith('_')
-        ])
-        if class_key is not None and hasattr(obj, "__class__"):
-            data[class_key] = obj.__class__.__name__
-        return data
+def _slot_names(cls: type) -> list[str]:
+    names = []
+    for base in reversed(cls.__mro__):
+        slots = vars(base).get('__slots__', ())
+        names.extend((slots,) if isinstance(slots, str) else slots)
+    return names
+
 
-    elif isinstance(obj, datetime.datetime):
-        return obj.strftime("%Y-%m-%d %H:%M:%S%z")
+def _todict_compile(cls: type, obj: Any) -> Callable[[_ToDict, Any], Any]:
+    """Returns conversion plan for the class, following the order of checks of the original todict."""
+    for base in cls.__mro__:
+        converter = _todict_converters.get(base)
+        if converter is not None:
+            return lambda _converter, _obj: converter(_obj, _converter.convert)
 
+    if isinstance(obj, dict):
+        return _todict_dict
+    if hasattr(obj, '_ast'):
+        return _todict_ast
+    if hasattr(obj, '__iter__') and not isinstance(obj, str):
+        return _todict_iterable
+
+    has_dict = hasattr(obj, '__dict__')
+    if dataclasses.is_dataclass(cls) and not has_dict:
+        names = tuple(f.name for f in dataclasses.fields(cls) if not f.name.startswith('_'))
     else:
-        return obj
+        names = tuple(x for x in _slot_names(cls) if not x.startswith('_'))
+    if names or has_dict:
+        return _todict_object_plan(cls, names, has_dict)
+
+    if isinstance(obj, datetime.datetime):
+        return _todict_datetime
+    return _todict_scalar
+
+
+def todict(obj, class_key=None):
+    """
+    Generic object to dict converter. Recursively convert.
+    Useful for testing and asserting objects with expectation.
+    Conversion plan of every class is compiled on first use; dataclasses and classes with __slots__ are supported,
+    custom conversions can be registered by todict_register. Raises ValueError on circular references.
+    Source: https://gist.github.com/sairamkrish/ab68be93b53b34c98e24908c67dfda0d
+    """
+    return _ToDict(class_key).convert(obj)
 
 
 def notimplemented_error(*args):
     raise NotImplementedError(*args)
 
 
-def iter_blocks(objects: list, size: int):
+def iter_blocks(objects: Iterable, size: int, zero_copy: bool = False) -> Iterator:
     """
     Create iterable for blocks of given size.
+    Sized sequences (lists, tuples, querysets...) are sliced, other iterables and generators are consumed lazily
+    into lists, so memory stays flat on huge inputs.
 
-    @param objects: the list of objects
+    @param objects: the list of objects or any iterable
     @param size: size of a single block
+    @param zero_copy: yield memoryview slices for buffer types (bytes, bytearray, array.array, memoryview...)
     @return: generator of slices
     """
-    offset = 0
-    while offset < len(objects):
-        yield objects[offset:offset+size]
-        offset += size
+    if size <= 0:
+        raise ValueError('size must be positive integer')
+
+    if zero_copy and not isinstance(objects, str | Iterator):
+        try:
+            objects = memoryview(objects)
+        except TypeError:
+            pass
+
+    if hasattr(objects, '__len__') and hasattr(objects, '__getitem__') and not isinstance(objects, Mapping):
+        offset = 0
+        while offset < len(objects):
+            yield objects[offset:offset+size]
+            offset += size
+        return
+
+    iterator = iter(objects)
+    while block := list(itertools.islice(iterator, size)):
+        yield block
+
+
+def map_blocks(
+        func: Callable[[Any], Any],
+        iterable: Iterable,
+        size: int,
+        workers: int = MAP_BLOCKS_WORKERS_DEFAULT,
+        executor: str | Executor = 'thread',
+        ordered: bool = True
+) -> Iterator:
+    """
+    Processes blocks of the iterable (see iter_blocks) on a thread or process pool.
+    The input is consumed lazily, at most workers*MAP_BLOCKS_BUFFER_FACTOR blocks are in flight at a time.
+    Blocks of buffer types are zero-copy memoryview slices on a thread pool; a process pool gets copies,
+    func and blocks must be picklable then.
+
+    @param func: callable processing a single block
+    @param iterable: objects to split into blocks
+    @param size: size of a single block
+    @param workers: number of workers of the pool created
+    @param executor: 'thread', 'process' or existing executor to use (it is not shut down)
+    @param ordered: yield results in the order of blocks; if False - in completion order
+    @return: generator of func results
+    """
+    if workers <= 0:
+        raise ValueError('workers must be positive integer')
+    if isinstance(executor, Executor):
+        pool = executor
+    elif executor == 'thread':
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='map_blocks')
+    elif executor == 'process':
+        pool = ProcessPoolExecutor(max_workers=workers)
+    else:
+        raise ValueError(f'unknown executor: {executor}')
+
+    max_in_flight = workers*MAP_BLOCKS_BUFFER_FACTOR
+    in_flight: deque[Future] = deque()
+    blocks = iter_blocks(iterable, size, zero_copy=not isinstance(pool, ProcessPoolExecutor))
+
+    def _completed() -> Iterator:
+        if ordered:
+            yield in_flight.popleft().result()
+        else:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                in_flight.remove(future)
+                yield future.result()
+
+    try:
+        for block in blocks:
+            if len(in_flight) >= max_in_flight:
+                yield from _completed()
+            in_flight.append(pool.submit(func, block))
+        while in_flight:
+            yield from _completed()
+    finally:
+        for future in in_flight:
+            future.cancel()
+        if pool is not executor:
+            pool.shutdown(wait=True)
 
 
 def in_memory_csv(objects: Iterable, headers: Iterable[str], values: Callable[[object], Iterable]) -> io.StringIO:
     """
-    Create in-memory CSV with given objects.
+    Create in-memory CSV with given objects. See iter_csv for large datasets.
 
     @param objects: all objects to put in CSV
     @param headers: headers
@@ -221,6 +827,117 @@ def in_memory_csv(objects: Iterable, headers: Iterable[str], values: Callable[[o
     return mem_csv
 
 
+def iter_csv(
+        objects: Iterable,
+        headers: Iterable[str] | None,
+        values: Callable[[object], Iterable],
+        chunk_size: int = CSV_CHUNK_SIZE_DEFAULT,
+        dialect: str | type[csv.Dialect] = 'excel',
+        encoding: str = 'utf-8',
+        gzip: bool = False,
+        **fmtparams
+) -> Iterator[bytes]:
+    """
+    Generates CSV with given objects as encoded chunks, e.g. for StreamingHttpResponse or file.
+    Objects are consumed lazily, so memory usage does not depend on their number.
+
+    @param objects: all objects to put in CSV
+    @param headers: headers, None for no header row
+    @param values: callable to get values from a single object
+    @param chunk_size: approximate size of chunks to yield (before compression)
+    @param dialect: csv dialect
+    @param encoding: encoding of the output
+    @param gzip: compress the output with gzip on the fly
+    @param fmtparams: csv formatting parameters overriding the dialect
+    """
+    if chunk_size <= 0:
+        raise ValueError('chunk_size must be positive integer')
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, dialect=dialect, **fmtparams)
+    encoder = codecs.getincrementalencoder(encoding)()  # one for the stream: BOM of utf-8-sig or utf-16 written once
+    compressor = zlib.compressobj(wbits=31) if gzip else None  # wbits=31: gzip header and trailer
+
+    def _chunk(final: bool = False) -> bytes:
+        data = encoder.encode(buffer.getvalue(), final)
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
+
+    if headers is not None:
+        writer.writerow(headers)
+    for obj in objects:
+        writer.writerow(values(obj))
+        if buffer.tell() >= chunk_size:
+            if chunk := _chunk():
+                yield chunk
+
+    chunk = _chunk(final=True)
+    if compressor:
+        chunk += compressor.flush()
+    if chunk:
+        yield chunk
+
+
+def iter_queryset_csv(
+        queryset,
+        fields: Sequence[str],
+        headers: Iterable[str] | None = None,
+        iterator_chunk_size: int = QUERYSET_ITERATOR_CHUNK_SIZE,
+        **kwargs
+) -> Iterator[bytes]:
+    """
+    Generates CSV with given fields of Django queryset rows (see iter_csv), fetching rows by chunks
+    via queryset.iterator() without caching them.
+
+    @param queryset: Django queryset to export
+    @param fields: field names or lookups to export, as for values_list
+    @param headers: headers, field names by default
+    @param iterator_chunk_size: number of rows fetched from the database at a time
+    @param kwargs: iter_csv arguments (chunk_size, dialect, encoding, gzip...)
+    """
+    rows = queryset.values_list(*fields).iterator(chunk_size=iterator_chunk_size)
+    return iter_csv(rows, headers=list(fields) if headers is None else headers, values=lambda x: x, **kwargs)
+
+
+def iter_jsonl(
+        objects: Iterable,
+        values: Callable[[object], Any] | None = None,
+        chunk_size: int = CSV_CHUNK_SIZE_DEFAULT,
+        gzip: bool = False
+) -> Iterator[bytes]:
+    """
+    Generates JSON Lines (one compact JSON document per line) with given objects as UTF-8 encoded chunks,
+    e.g. for StreamingHttpResponse or file. Objects are consumed lazily, as by iter_csv.
+
+    @param objects: all objects to put in the output
+    @param values: callable to get JSON-compatible value from a single object, the object itself if None
+    @param chunk_size: approximate size of chunks to yield (before compression)
+    @param gzip: compress the output with gzip on the fly
+    """
+    if chunk_size <= 0:
+        raise ValueError('chunk_size must be positive integer')
+    buffer = bytearray()
+    compressor = zlib.compressobj(wbits=31) if gzip else None
+
+    def _chunk() -> bytes:
+        data = bytes(buffer)
+        buffer.clear()
+        return compressor.compress(data) if compressor else data
+
+    for obj in objects:
+        buffer += json_dumps_bytes(values(obj) if values else obj)
+        buffer += b'\n'
+        if len(buffer) >= chunk_size:
+            if chunk := _chunk():
+                yield chunk
+
+    chunk = _chunk()
+    if compressor:
+        chunk += compressor.flush()
+    if chunk:
+        yield chunk
+
+
 def is_integer(value: str) -> bool:
     try:
         float(value)
@@ -297,73 +1014,151 @@ RUSSIAN_ADDRESSES = {
 
 
 MAX_WIDTH_COMPACTED_VALUE = 120;  """Compaction is not performed if resulting string exceeds this size"""
+COMPACT_DEBUG_INFO_CACHE_SIZE = 1024;  """Max number of results kept by compact_debug_info_cached"""
 
 
-def _compact_pickled_data(data: Any, remove_special: bool = True, remove_protected: bool = False) -> Any:
-    """
-    Compacts pickled data for simple visual representations.
-    @param data: dict or list to compact
-    @param remove_special: remove items with jsonpickle special keys
-    @param remove_protected: remove items with keys starting with '_'
-    @return: compacted and filtered data
-    """
+def _value_is_empty(value: Any) -> bool:
+    return value is None or value in ('', 'none', 'null',) or value == [] or value == {}
 
-    def _value_is_empty(_val: Any) -> bool:
-        return _val is None or _val in ('', 'none', 'null',) or _val == [] or _val == {}
 
-    if isinstance(data, list):
-        # compact every element of the list and remove empty elements
-        data = [
-            _compact_pickled_data(x, remove_special=remove_special, remove_protected=remove_protected)
-            for x in data
-        ]
-        data = [x for x in data if not _value_is_empty(x)]
+def _join_short(tokens: Iterable[str]) -> str | None:
+    """Joins tokens with comma, returns None as soon as the result reaches MAX_WIDTH_COMPACTED_VALUE."""
+    parts = []
+    width = -2
+    for token in tokens:
+        width += len(token) + 2
+        if width >= MAX_WIDTH_COMPACTED_VALUE:
+            return None
+        parts.append(token)
+    return ', '.join(parts)
 
-    if isinstance(data, list) and len(data) == 1:
-        # convert list to single value
-        return data[0]
 
-    if isinstance(data, list) and len(data) <= 8 and all(not isinstance(x, dict | list) for x in data):
+def _compact_list(items: list) -> Any:
+    if len(items) == 1:
+        # convert list to single value
+        return items[0]
+    if len(items) <= 8 and not any(isinstance(x, dict | list) for x in items):
         # convert list to comma delimited string if short enough
-        compacted = ', '.join([str(x) for x in data])
-        return compacted if len(compacted) < MAX_WIDTH_COMPACTED_VALUE else data
-
-    if isinstance(data, dict):
-        # compact every element of the dictionary and remove elements with empty or special/protected values
-        compacted = {}
-        for key, value in data.items():
-            value = _compact_pickled_data(value, remove_special=remove_special, remove_protected=remove_protected)
-            if _value_is_empty(value):
-                continue
-            if remove_protected and key.startswith('_'):
-                continue
-            if remove_special and key in ('py/object', 'py/function', 'py/type',):
-                continue
-            compacted[key] = value
-        data = compacted
+        compacted = _join_short(str(x) for x in items)
+        if compacted is not None:
+            return compacted
+    return items
+
 
-    if isinstance(data, dict) and len(data) == 1:
+def _compact_dict(items: dict) -> Any:
+    if len(items) == 1:
         # collapse dict with inner dict if latter has single element
-        key, val = list(data.items())[0]
+        key, val = next(iter(items.items()))
         if isinstance(val, dict) and len(val) == 1:
-            key_inner, val_inner = list(val.items())[0]
-            data = {f'{key}=>{key_inner}': val_inner}
-
-    if isinstance(data, dict) and len(data) <= 8 and all(not isinstance(x, dict | list) for x in data.values()):
-        # convert list to comma delimited string with key=value pairs if short enough
-        tokens = []
-        for key, val in data.items():
-            tokens.append(f'{key}={val}')
-        compacted = ', '.join(tokens)
-        return compacted if len(compacted) < MAX_WIDTH_COMPACTED_VALUE else data
-
-    return data if not _value_is_empty(data) else None
-
+            key_inner, val_inner = next(iter(val.items()))
+            items = {f'{key}=>{key_inner}': val_inner}
+    if len(items) <= 8 and not any(isinstance(x, dict | list) for x in items.values()):
+        # convert dict to comma delimited string with key=value pairs if short enough
+        compacted = _join_short(f'{key}={val}' for key, val in items.items())
+        if compacted is not None:
+            return compacted
+    return items
+
+
+def _compact_pickled_data(
+        data: Any, remove_special: bool = True, remove_protected: bool = False, max_output: int | None = None
+) -> Any:
+    """
+    Compacts pickled data for simple visual representations.
+    Iterative, so the depth of data is not limited by the recursion limit.
+    @param data: dict or list to compact
+    @param remove_special: remove items with jsonpickle special keys
+    @param remove_protected: remove items with keys starting with '_'
+    @param max_output: max number of scalar values in the result, the rest of data is replaced by '...' markers;
+        None for unlimited
+    @return: compacted and filtered data
+    """
+    skip_keys = ('py/object', 'py/function', 'py/type',) if remove_special else ()
+    stack: list[list] = [];  """frames: [source items, position, compacted list or dict]"""
+    node = data
 
-def compact_debug_info(info: str, remove_protected: bool = False) -> str:
+    while True:
+        # descend into containers, compact scalars
+        if isinstance(node, list):
+            stack.append([node, 0, []])
+        elif isinstance(node, dict):
+            stack.append([list(node.items()), 0, {}])
+        else:
+            if _value_is_empty(node):
+                node = None
+            elif max_output is not None:
+                max_output -= 1
+            if not stack:
+                return node
+            frame = stack[-1]
+            if node is not None:
+                if isinstance(frame[2], list):
+                    frame[2].append(node)
+                else:
+                    frame[2][frame[0][frame[1] - 1][0]] = node
+
+        # take next child of the innermost unfinished container, finish containers without children left
+        while True:
+            frame = stack[-1]
+            source, position, compacted = frame
+            is_list = isinstance(compacted, list)
+            while position < len(source) and not is_list:
+                key = source[position][0]
+                if not (remove_protected and key.startswith('_') or key in skip_keys):
+                    break
+                position += 1
+            if position < len(source) and max_output is not None and max_output <= 0:
+                if is_list:
+                    compacted.append('...')
+                else:
+                    compacted['...'] = '...'
+                position = len(source)
+            if position < len(source):
+                frame[1] = position + 1
+                node = source[position] if is_list else source[position][1]
+                break
+
+            stack.pop()
+            value = _compact_list(compacted) if is_list else _compact_dict(compacted)
+            if not stack:
+                return value
+            if not _value_is_empty(value):
+                parent = stack[-1]
+                if isinstance(parent[2], list):
+                    parent[2].append(value)
+                else:
+                    parent[2][parent[0][parent[1] - 1][0]] = value
+
+
+def compact_debug_info(info: str, remove_protected: bool = False, max_output: int | None = None) -> str:
     """Compact and filter json pickled object for simplified visual representation"""
     if not info:
         return ''
     data = json_loads(info)
-    compacted = _compact_pickled_data(data, remove_protected=remove_protected)
+    compacted = _compact_pickled_data(data, remove_protected=remove_protected, max_output=max_output)
     return json_dumps(compacted)
+
+
+_compact_debug_info_cache: OrderedDict[tuple[bytes, bool], str] = OrderedDict()
+_compact_debug_info_cache_lock = threading.Lock()
+
+
+def compact_debug_info_cached(info: str, remove_protected: bool = False) -> str:
+    """
+    Same as compact_debug_info, memoized in LRU cache keyed by the info content hash and the mode,
+    so rendering the same debug info repeatedly does not parse it again.
+    """
+    if not info:
+        return ''
+    key = (hashlib.blake2b(info.encode(), digest_size=16).digest(), remove_protected)
+    with _compact_debug_info_cache_lock:
+        compacted = _compact_debug_info_cache.get(key)
+        if compacted is not None:
+            _compact_debug_info_cache.move_to_end(key)
+            return compacted
+    compacted = compact_debug_info(info, remove_protected=remove_protected)
+    with _compact_debug_info_cache_lock:
+        _compact_debug_info_cache[key] = compacted
+        while len(_compact_debug_info_cache) > COMPACT_DEBUG_INFO_CACHE_SIZE:
+            _compact_debug_info_cache.popitem(last=False)
+    return compacted
@@ -30,6 +30,16 @@ class SemaphoreRecord(models.Model):
         return self.key
 
 
+class CircuitBreakerRecord(models.Model):
+    name = models.CharField(max_length=512, primary_key=True, editable=False, help_text='circuit unique name')
+    state = models.CharField(max_length=16, help_text='circuit state: closed, open or half-open')
+    opened_at = models.DateTimeField(null=True, blank=True, help_text='circuit last opened at')
+    modified = models.DateTimeField(auto_now=True, editable=False, help_text='database record last modified at')
+
+    def __str__(self):
+        return self.name
+
+
 class TaskHandle(models.Model):
     task_id = models.CharField('Task ID', max_length=32, editable=False);  """Django-Q task unique ID."""
     ormq_id = models.IntegerField(
@@ -68,18 +78,21 @@ class TaskHandle(models.Model):
     @classmethod
     def get(cls, handle_or_task_id: int | str) -> Optional['TaskHandle']:
         """Get Task Handle by ID or task_id. Returns None if not found."""
-        if TaskHandle.objects.filter(id=handle_or_task_id).exists():
-            return TaskHandle.objects.get(id=handle_or_task_id)
-        elif TaskHandle.objects.filter(task_id=handle_or_task_id).exists():
-            return TaskHandle.objects.get(task_id=handle_or_task_id)
-        else:
-            return None
+        if isinstance(handle_or_task_id, int) or str(handle_or_task_id).isdigit():
+            task_handle = TaskHandle.objects.filter(id=handle_or_task_id).first()
+            if task_handle:
+                return task_handle
+        return TaskHandle.objects.filter(task_id=handle_or_task_id).first()
 
     class Meta:
         constraints = [
             models.UniqueConstraint(fields=['task_id'], name='uniq_task_handle_task_id')
         ]
 
+        indexes = [
+            models.Index(fields=['created_at'], name='idx_task_handle_created_at'),
+        ]
+
 
 LOG_LEVELS = (
     (logging.NOTSET, 'NotSet'),
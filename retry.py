@@ -1,82 +1,507 @@
-import datetime
+import asyncio
+import inspect
 import time
 import typing
 import random
 import logging
 import functools
+import threading
 from collections.abc import Iterable
+from asgiref.sync import sync_to_async
 
 # local imports
 from .misc import exception_descr
-from .dateutils import local_now_tz_aware
+from .circuit import CircuitBreaker
+
+log = logging.getLogger(__name__)
+
+RETRY_BUDGET_RATIO_DEFAULT = 0.1;           """default share of successful calls allowed to be retried"""
+RETRY_BUDGET_MIN_PER_SECOND_DEFAULT = 1.0;  """default number of retries per second always allowed (local reserve)"""
+RETRY_BUDGET_MAX_TOKENS_DEFAULT = 100.0;    """default maximal number of retries accumulated in the budget"""
+RETRY_BUDGET_CACHE_ALIAS = 'default';       """Django cache used for budgets shared between processes"""
+RETRY_BUDGET_CACHE_KEY_PREFIX = 'helpers:retry_budget:'
+RETRY_BUDGET_TOKEN_SCALE = 1000;            """shared budget keeps integer milli-tokens for atomic cache incr/decr"""
+
+
+class RetryBudget:
+    """
+    Token bucket limiting retries to a share of successful calls, to prevent retry storms.
+
+    Every successful call deposits ratio tokens, every retry withdraws one token. Additionally, min_per_second
+    retries per second are always allowed from the local reserve, so rarely called services still get retried.
+    When the budget is exhausted, retry_callable raises the intercepted exception immediately instead of retrying.
+
+    With shared=True the deposited tokens are kept in Django cache (RETRY_BUDGET_CACHE_ALIAS), so the budget
+    is shared by all processes using the same cache backend (e.g. Redis or Memcached). Coroutines must use
+    async_deposit and async_try_withdraw then, which access the cache by sync_to_async, off the event loop.
+    """
+    _registry: dict[str, 'RetryBudget'] = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(
+            self, name: str,
+            ratio: float = RETRY_BUDGET_RATIO_DEFAULT,
+            min_per_second: float = RETRY_BUDGET_MIN_PER_SECOND_DEFAULT,
+            max_tokens: float = RETRY_BUDGET_MAX_TOKENS_DEFAULT,
+            shared: bool = False,
+            clock: callable = time.monotonic
+    ):
+        """
+        @param name: budget name, shared by all retry_callable calls given the same name
+        @param ratio: number of retries allowed per successful call
+        @param min_per_second: number of retries per second allowed regardless of successful calls
+        @param max_tokens: maximal number of retries accumulated from successful calls and the reserve
+        @param shared: keep tokens from successful calls in Django cache to share them between processes
+        @param clock: monotonic clock function, replaceable for tests
+        """
+        if ratio < 0 or min_per_second < 0 or max_tokens <= 0:
+            raise ValueError('ratio and min_per_second must be non-negative, max_tokens must be positive')
+
+        self.name = name
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.shared = shared
+        self.clock = clock
+
+        self.deposits = 0;  """number of successful calls registered"""
+        self.retries = 0;   """number of retries allowed"""
+        self.rejected = 0;  """number of retries rejected because the budget was exhausted"""
+
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._reserve = min(min_per_second, max_tokens)
+        self._reserve_refilled_at = clock()
+        self._cache_key = f'{RETRY_BUDGET_CACHE_KEY_PREFIX}{name}'
+
+    def __str__(self):
+        return f'RetryBudget(name={self.name}, retries={self.retries}, rejected={self.rejected})'
+
+    @classmethod
+    def get(cls, name: str, **kwargs) -> 'RetryBudget':
+        """Returns process-wide retry budget with given name, creates it with given parameters on first use."""
+        budget = cls._registry.get(name)
+        if budget is None:
+            with cls._registry_lock:
+                budget = cls._registry.get(name)
+                if budget is None:
+                    budget = cls._registry[name] = cls(name, **kwargs)
+        return budget
+
+    @staticmethod
+    def _cache():
+        from django.core.cache import caches
+        return caches[RETRY_BUDGET_CACHE_ALIAS]
+
+    def deposit(self) -> None:
+        """Registers successful call."""
+        if self.shared:
+            cache = self._cache()
+            amount = int(self.ratio * RETRY_BUDGET_TOKEN_SCALE)
+            cache.add(self._cache_key, 0, timeout=None)
+            if cache.incr(self._cache_key, amount) > self.max_tokens * RETRY_BUDGET_TOKEN_SCALE:
+                cache.decr(self._cache_key, amount)
+            with self._lock:
+                self.deposits += 1
+        else:
+            with self._lock:
+                self.deposits += 1
+                self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    async def async_deposit(self) -> None:
+        """Asyncio variant of deposit."""
+        if self.shared:
+            await sync_to_async(self.deposit)()
+        else:
+            self.deposit()
+
+    def _withdraw_reserve(self) -> bool:
+        now = self.clock()
+        self._reserve = min(self.max_tokens, self._reserve + (now - self._reserve_refilled_at) * self.min_per_second)
+        self._reserve_refilled_at = now
+        if self._reserve >= 1:
+            self._reserve -= 1
+            return True
+        return False
+
+    def _withdraw_shared(self) -> bool:
+        """
+        Takes a token from the cache if a whole one is there. Memcached clamps decr at 0 instead of going negative,
+        so the balance is checked first; concurrent withdrawals passing the check together are reverted if the balance
+        went negative (Redis, local memory), or may overdraw the budget by at most one token each (Memcached).
+        """
+        cache = self._cache()
+        tokens = cache.get(self._cache_key)
+        if tokens is None or tokens < RETRY_BUDGET_TOKEN_SCALE:
+            return False  # no successful calls registered yet or less than a whole token left
+        try:
+            tokens = cache.decr(self._cache_key, RETRY_BUDGET_TOKEN_SCALE)
+        except ValueError:
+            return False  # expired meanwhile
+        if tokens < 0:
+            cache.incr(self._cache_key, RETRY_BUDGET_TOKEN_SCALE)
+            return False
+        return True
+
+    def _withdraw_local(self) -> bool:
+        with self._lock:
+            allowed = self._withdraw_reserve()
+            if not allowed and not self.shared and self._tokens >= 1:
+                self._tokens -= 1
+                allowed = True
+        return allowed
+
+    def try_withdraw(self) -> bool:
+        """Takes a token for a retry. Returns False if the budget is exhausted and the retry is not allowed."""
+        allowed = self._withdraw_local()
+        if not allowed and self.shared:
+            allowed = self._withdraw_shared()
+        return self._register_withdrawal(allowed)
+
+    async def async_try_withdraw(self) -> bool:
+        """Asyncio variant of try_withdraw."""
+        allowed = self._withdraw_local()
+        if not allowed and self.shared:
+            allowed = await sync_to_async(self._withdraw_shared)()
+        return self._register_withdrawal(allowed)
+
+    def _register_withdrawal(self, allowed: bool) -> bool:
+        with self._lock:
+            if allowed:
+                self.retries += 1
+            else:
+                self.rejected += 1
+        if not allowed:
+            log.debug(f'retry budget "{self.name}" exhausted, retry rejected')
+        return allowed
+
+
+class Backoff:
+    """Pause strategy: computes pause before the retry. Stateless, may be shared by many retry loops."""
+
+    def pause(self, try_num: int, prev_pause: float | None) -> float:
+        """
+        @param try_num: number of the failed try, counts from 1
+        @param prev_pause: pause before the failed try, None for the first try
+        @return: pause before the next try, in seconds
+        """
+        raise NotImplementedError
+
+
+class ConstantBackoff(Backoff):
+    """Same pause before every retry."""
+
+    def __init__(self, pause: float):
+        self._pause = pause
+
+    def pause(self, try_num: int, prev_pause: float | None) -> float:
+        return self._pause
+
+
+class RandomBackoff(Backoff):
+    """Random pause within pause/2...pause*3/2 interval, the classic random_pause behaviour."""
+
+    def __init__(self, pause: float, rng: random.Random = None):
+        self._pause = pause
+        self._rng = rng or random
+
+    def pause(self, try_num: int, prev_pause: float | None) -> float:
+        return self._rng.uniform(self._pause*0.5, self._pause*1.5)
+
+
+class ExponentialBackoff(Backoff):
+    """Pause base*factor^(try_num-1), limited by max_pause."""
+
+    def __init__(self, base: float, factor: float = 2.0, max_pause: float = None):
+        self._base = base
+        self._factor = factor
+        self._max_pause = max_pause
+
+    def pause(self, try_num: int, prev_pause: float | None) -> float:
+        try:
+            pause = self._base * self._factor ** (try_num - 1)
+        except OverflowError:
+            if self._max_pause is None:
+                raise
+            return self._max_pause  # many tries with tries=None and timeout
+        return min(pause, self._max_pause) if self._max_pause is not None else pause
+
+
+class FullJitterBackoff(ExponentialBackoff):
+    """Random pause within 0...exponential pause interval, spreads retries of simultaneously failed callers."""
+
+    def __init__(self, base: float, factor: float = 2.0, max_pause: float = None, rng: random.Random = None):
+        super().__init__(base, factor, max_pause)
+        self._rng = rng or random
+
+    def pause(self, try_num: int, prev_pause: float | None) -> float:
+        return self._rng.uniform(0, super().pause(try_num, prev_pause))
+
+
+class DecorrelatedJitterBackoff(Backoff):
+    """Random pause within base...prev_pause*3 interval, limited by max_pause."""
+
+    def __init__(self, base: float, max_pause: float, rng: random.Random = None):
+        self._base = base
+        self._max_pause = max_pause
+        self._rng = rng or random
+
+    def pause(self, try_num: int, prev_pause: float | None) -> float:
+        return min(self._max_pause, self._rng.uniform(self._base, (prev_pause or self._base) * 3))
+
+
+class ManualClock:
+    """
+    Deterministic clock for tests and benchmarks: sleeping just advances the time.
+    Usage:
+        clock = ManualClock()
+        retry_callable(func, tries=5, backoff=ExponentialBackoff(1), clock=clock.monotonic, sleep=clock.sleep)
+    """
+
+    def __init__(self, now: float = 0.0):
+        self.now = now
+        self.sleeps: list[float] = [];  """all pauses requested, in order"""
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    async def async_sleep(self, seconds: float) -> None:
+        self.sleep(seconds)
+
+
+def _get_circuit(circuit: CircuitBreaker | str | None) -> CircuitBreaker | None:
+    """Resolves circuit breaker given by name."""
+    return CircuitBreaker.get(circuit) if isinstance(circuit, str) else circuit
+
+
+def _get_budget(budget: RetryBudget | str | None) -> RetryBudget | None:
+    """Resolves retry budget given by name."""
+    return RetryBudget.get(budget) if isinstance(budget, str) else budget
+
+
+class _RetryLoop:
+    """Retry decisions shared by retry_callable and async_retry_callable."""
+
+    def __init__(
+            self,
+            exceptions: typing.Type[Exception] | Iterable[typing.Type[Exception]],
+            tries: int | None, timeout: float | None, random_pause: float | None, backoff: Backoff | None,
+            logger: logging.Logger | None, loglevel: int, failures_nolog: int | None,
+            circuit: CircuitBreaker | str | None, budget: RetryBudget | str | None, clock: callable
+    ):
+        if tries is not None and tries <= 0:
+            raise ValueError('tries must be positive integer or None')
+        if timeout is not None and timeout <= 0:
+            raise ValueError('timeout must be positive float or None')
+        if random_pause is not None and random_pause <= 0:
+            raise ValueError('random_pause must be positive float or None')
+        if random_pause is not None and backoff is not None:
+            raise ValueError('random_pause and backoff cannot be given simultaneously')
+        if not tries and not timeout:
+            raise ValueError('tries number or timeout must be given')
+        if failures_nolog is not None and failures_nolog <= 0:
+            raise ValueError('failures_nolog must be positive integer or None')
+
+        self.exceptions = exceptions if isinstance(exceptions, Iterable) else [exceptions]
+        self.tries = tries
+        self.backoff = RandomBackoff(random_pause) if random_pause else backoff
+        self.logger = logger
+        self.loglevel = loglevel
+        self.failures_nolog = failures_nolog
+        self.circuit = _get_circuit(circuit)
+        self.budget = _get_budget(budget)
+        self.clock = clock
+        self.time_timeout = clock() + timeout if timeout else None
+        self.try_num = 1
+        self.prev_pause = None
+
+    def before_try(self) -> None:
+        if self.circuit:
+            self.circuit.before_call()
+
+    async def async_before_try(self) -> None:
+        if self.circuit:
+            await self.circuit.async_before_call()
+
+    def on_success(self) -> None:
+        if self.circuit:
+            self.circuit.record_success()
+        if self.budget:
+            self.budget.deposit()
+
+    async def async_on_success(self) -> None:
+        if self.circuit:
+            await self.circuit.async_record_success()
+        if self.budget:
+            await self.budget.async_deposit()
+
+    def on_failure(self, ex: Exception) -> float | None:
+        """Registers failed try. Returns pause before the retry in seconds, None if the exception must be raised."""
+        intercepted = any(isinstance(ex, x) for x in self.exceptions)
+        if self.circuit and intercepted:
+            self.circuit.record_failure()
+        elif self.circuit:
+            self.circuit.record_ignored()
+        if not self._may_retry(intercepted) or (self.budget and not self.budget.try_withdraw()):
+            return None
+        return self._retry_pause(ex)
+
+    async def async_on_failure(self, ex: Exception) -> float | None:
+        """Asyncio variant of on_failure."""
+        intercepted = any(isinstance(ex, x) for x in self.exceptions)
+        if self.circuit and intercepted:
+            await self.circuit.async_record_failure()
+        elif self.circuit:
+            self.circuit.record_ignored()
+        if not self._may_retry(intercepted) or (self.budget and not await self.budget.async_try_withdraw()):
+            return None
+        return self._retry_pause(ex)
+
+    def _may_retry(self, intercepted: bool) -> bool:
+        """Checks the failed try may be retried by tries number and timeout, the budget is checked last."""
+        if self.tries is not None and self.try_num >= self.tries:
+            return False
+        if not intercepted:
+            return False
+        return self.time_timeout is None or self.clock() <= self.time_timeout
+
+    def _retry_pause(self, ex: Exception) -> float:
+        retry_pause = self.backoff.pause(self.try_num, self.prev_pause) if self.backoff else 0
+        if self.logger and (self.failures_nolog is None or self.try_num > self.failures_nolog):
+            if retry_pause:
+                self.logger.log(
+                    self.loglevel, f'{exception_descr(ex)}, will retry after {round(retry_pause, 2)} seconds...'
+                )
+            else:
+                self.logger.log(self.loglevel, f'{exception_descr(ex)}, retrying...')
+        self.try_num += 1
+        self.prev_pause = retry_pause
+        return retry_pause
 
 
 def retry_callable(func: callable,
                    exceptions: typing.Type[Exception] | Iterable[typing.Type[Exception]] = Exception,
                    tries: int = None, timeout: float = None, random_pause: float = None,
                    logger: logging.Logger = None, loglevel: int = logging.WARN,
-                   failures_nolog: int = None):
+                   failures_nolog: int = None, circuit: CircuitBreaker | str = None,
+                   budget: RetryBudget | str = None, backoff: Backoff = None,
+                   clock: callable = time.monotonic, sleep: callable = time.sleep):
     """
     Calls given callable repeatedly until success
     :param func: callable to call
     :param exceptions: exception type or iterable of exception types to intercept
     :param tries: maximum number of tries; None - unlimited
     :param timeout: no retry after this number of seconds
-    :param random_pause: wait before each retry with random delay within random_pause/2...random_pause*3/4 interval
+    :param random_pause: wait before each retry with random delay within random_pause/2...random_pause*3/2 interval
     :param logger: if given, logs intercepted errors via this logger
     :param loglevel: level to log with
     :param failures_nolog: number first of failures not to log
+    :param circuit: circuit breaker or its name; tries fail fast with CircuitOpenException while the circuit is open
+    :param budget: retry budget or its name; no retry, intercepted exception is raised if the budget is exhausted
+    :param backoff: pause strategy, alternative to random_pause; None and no random_pause - retry without pause
+    :param clock: monotonic clock for timeout, replaceable for tests (see ManualClock)
+    :param sleep: sleeping function, replaceable for tests (see ManualClock)
     :return: what the callable returns
     """
-    if tries is not None and tries <= 0:
-        raise ValueError('tries must be positive integer or None')
-    if timeout is not None and timeout <= 0:
-        raise ValueError('timeout must be positive float or None')
-    if random_pause is not None and random_pause <= 0:
-        raise ValueError('random_pause must be positive float or None')
-    if not tries and not timeout:
-        raise ValueError('tries number or timeout must be given')
-    if failures_nolog is not None and failures_nolog <= 0:
-        raise ValueError('failures_nolog must be positive integer or None')
-
-    if not isinstance(exceptions, Iterable):
-        exceptions = [exceptions]
-
-    dt_timeout = local_now_tz_aware() + datetime.timedelta(seconds=timeout) if timeout else None
-    try_num = 1
+    loop = _RetryLoop(
+        exceptions, tries, timeout, random_pause, backoff, logger, loglevel, failures_nolog, circuit, budget, clock
+    )
     while True:
+        loop.before_try()
         # noinspection PyBroadException
         try:
-            return func()
+            result = func()
         except Exception as ex:
-            if tries is not None and try_num >= tries:
-                raise
-            if not any(isinstance(ex, x) for x in exceptions):
+            retry_pause = loop.on_failure(ex)
+            if retry_pause is None:
                 raise
-            if timeout and local_now_tz_aware() > dt_timeout:
-                raise
-            retry_pause = random.uniform(random_pause*0.5, random_pause*1.5) if random_pause else None
-            if logger and (failures_nolog is None or try_num > failures_nolog):
-                if retry_pause:
-                    logger.log(loglevel, f'{exception_descr(ex)}, will retry after {round(retry_pause, 2)} seconds...')
-                    time.sleep(retry_pause)
-                else:
-                    logger.log(loglevel, f'{exception_descr(ex)}, retrying...')
             if retry_pause:
-                time.sleep(retry_pause)
-            try_num += 1
+                sleep(retry_pause)
+        else:
+            loop.on_success()
+            return result
+
+
+async def async_retry_callable(
+        func: callable,
+        exceptions: typing.Type[Exception] | Iterable[typing.Type[Exception]] = Exception,
+        tries: int = None, timeout: float = None, random_pause: float = None,
+        logger: logging.Logger = None, loglevel: int = logging.WARN,
+        failures_nolog: int = None, deadline: float = None, circuit: CircuitBreaker | str = None,
+        budget: RetryBudget | str = None, backoff: Backoff = None,
+        clock: callable = time.monotonic, sleep: callable = asyncio.sleep):
+    """
+    Awaits given coroutine function repeatedly until success. Asyncio variant of retry_callable:
+    pauses with asyncio.sleep, so waiting coroutines do not occupy threads.
+    Cancellation (asyncio.CancelledError) is never intercepted and stops retrying immediately.
+    :param func: callable without arguments returning awaitable, e.g. coroutine function
+    :param deadline: overall limit in seconds for all tries and pauses, raises TimeoutError when exceeded
+    :param sleep: coroutine function for sleeping, replaceable for tests (see ManualClock)
+    For other parameters see retry_callable.
+    :return: what the awaitable returns
+    """
+    loop = _RetryLoop(
+        exceptions, tries, timeout, random_pause, backoff, logger, loglevel, failures_nolog, circuit, budget, clock
+    )
+    if deadline is not None and deadline <= 0:
+        raise ValueError('deadline must be positive float or None')
+
+    async def _retry_loop():
+        while True:
+            await loop.async_before_try()
+            # noinspection PyBroadException
+            try:
+                result = await func()
+            except Exception as ex:
+                retry_pause = await loop.async_on_failure(ex)
+                if retry_pause is None:
+                    raise
+                if retry_pause:
+                    await sleep(retry_pause)
+            else:
+                await loop.async_on_success()
+                return result
+
+    if deadline is None:
+        return await _retry_loop()
+    return await asyncio.wait_for(_retry_loop(), deadline)
 
 
 def retry(exceptions: typing.Type[Exception] | Iterable[typing.Type[Exception]] = Exception,
           tries: int = None, timeout: float = None, random_pause: float = None,
-          logger: logging.Logger = None, loglevel: int = logging.WARN, failures_nolog: int = None):
+          logger: logging.Logger = None, loglevel: int = logging.WARN, failures_nolog: int = None,
+          deadline: float = None, circuit: CircuitBreaker | str = None, budget: RetryBudget | str = None,
+          backoff: Backoff = None):
+    """
+    Retrying decorator, see retry_callable. Coroutine functions are retried with async_retry_callable.
+    :param deadline: overall time limit in seconds, for coroutine functions only
+    """
     def decorator(func: callable):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                return await async_retry_callable(
+                    lambda: func(*args, **kwargs),
+                    exceptions=exceptions, tries=tries, timeout=timeout, random_pause=random_pause,
+                    logger=logger, loglevel=loglevel, failures_nolog=failures_nolog, deadline=deadline,
+                    circuit=circuit, budget=budget, backoff=backoff
+                )
+            return async_wrapper
+
+        if deadline is not None:
+            raise ValueError('deadline is supported for coroutine functions only')
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             return retry_callable(
                 lambda: func(*args, **kwargs),
                 exceptions=exceptions, tries=tries, timeout=timeout, random_pause=random_pause,
-                logger=logger, loglevel=loglevel, failures_nolog=failures_nolog
+                logger=logger, loglevel=loglevel, failures_nolog=failures_nolog, circuit=circuit, budget=budget,
+                backoff=backoff
             )
         return wrapper
     return decorator
@@ -1,6 +1,5 @@
 import functools
 import logging
-import threading
 from django.db import transaction
 from django.dispatch import receiver
 from django.conf import settings
@@ -9,13 +8,10 @@ from django_q.signals import pre_execute
 
 # local imports
 from .models import TaskHandle
+from .context import current_task_info_var, RequestCache
 
 log = logging.getLogger(__name__)
 
-_thread_locals = threading.local()
-CURRENT_TASK_INFO_ATTR_NAME = '__current_task_info'
-"""Attribute name for saving Task Info of the current Django-Q task into _thead_locals."""
-
 
 class TaskInfo:
     """Information of the currently running Django-Q task."""
@@ -45,6 +41,7 @@ class TaskInfo:
         self.task_dict: dict = task_dict;  """Dictionary passed to Django-Q pre_execute callback handler."""
         self.handle = task_handle;  """Task Handle"""
         self._history: list[TaskHandle] = [];  """List of Task Handles of the retry chain."""
+        self.cache = RequestCache();  """Memoization cache of the task, see current_request.request_cached."""
 
     def __str__(self):
         handle_id = self.handle.id
@@ -86,6 +83,13 @@ class TaskInfo:
         return self.handle.try_num >= self.handle.max_tries
 
 
+def get_current_task_info() -> TaskInfo | None:
+    """
+    @return: Task Info of the Django-Q task running in the current context (thread or asyncio task) if any.
+    """
+    return current_task_info_var.get()
+
+
 def async_task_with_handle(func, *args, prev: TaskHandle = None, tries: int = None, **kwargs) -> TaskHandle:
     """
     Creates asynchronous task for executing by Django-Q cluster, by calling async_task.
@@ -123,29 +127,29 @@ def async_task_with_handle(func, *args, prev: TaskHandle = None, tries: int = No
 @receiver(pre_execute)
 def django_q_pre_execute_callback(sender, func, task, **kwargs):
     """
-    Saves task info globally (in the current thread).
+    Saves task info globally (in the current context).
     Turned on by settings.CURRENT_TASK_INFO_TRACKING = True.
-    If turned on, requires clearing the global attribute after each task execution (use '@managed_task' decorator).
+    If turned on, requires clearing the task info after each task execution (use '@managed_task' decorator).
     Supposed that only one Django-Q task can be run on any particular thread.
     """
     _, _, _ = sender, func, kwargs  # suppress PyCharm warning about unused params
     if getattr(settings, 'CURRENT_TASK_INFO_TRACKING', None):
-        existing_task_info: TaskInfo = getattr(_thread_locals, CURRENT_TASK_INFO_ATTR_NAME, None)
+        existing_task_info: TaskInfo = current_task_info_var.get()
         if existing_task_info:
             raise RuntimeError(
-                f'{CURRENT_TASK_INFO_ATTR_NAME} already set to "... task_id={existing_task_info.handle.task_id} ...", '
+                f'current task info already set to "... task_id={existing_task_info.handle.task_id} ...", '
                 f'forgot to use "@managed_task" decorator?'
             )
         log.info(f'pre_execute: task_id={task["id"]}')
         task_info = TaskInfo(task_dict=task)
-        setattr(_thread_locals, CURRENT_TASK_INFO_ATTR_NAME, task_info)  # save the task info globally
+        current_task_info_var.set(task_info)  # save the task info globally
 
 
 def managed_task(_func: callable = None):
     """
     This decorator turns a task function to a managed Django-Q task:
        • gives TaskInfo to this function as task_info additional attribute;
-       • clears the task_info global (in the current thread) attribute on exit;
+       • clears the task_info global (in the current context) variable and the task memoization cache on exit;
        • automatically manages required task retries;
        • automatically skips task execution if next task try is already queued;
        • automatically skips task execution if task cancellation is requested;
@@ -161,7 +165,7 @@ def managed_task(_func: callable = None):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             # retrieve current task information, previously saved via pre_execute Django-Q handler
-            task_info: TaskInfo = getattr(_thread_locals, CURRENT_TASK_INFO_ATTR_NAME)
+            task_info: TaskInfo = current_task_info_var.get()
             if not task_info:
                 raise RuntimeError('no task_info, forgot to to set settings.CURRENT_TASK_INFO_TRACKING=True?')
 
@@ -189,15 +193,16 @@ def managed_task(_func: callable = None):
                 raise
 
             finally:
-                # verify the task info in the _thread_locals is not changed during task execution
-                actual_task_info: TaskInfo = getattr(_thread_locals, CURRENT_TASK_INFO_ATTR_NAME)
-                actual_task_id = actual_task_info.handle.task_id
-                expected_task_id = task_info.handle.task_id
+                # verify the task info in the current context is not changed during task execution
+                actual_task_info: TaskInfo = current_task_info_var.get()
                 if actual_task_info != task_info:
+                    actual_task_id = actual_task_info.handle.task_id if actual_task_info else None
+                    expected_task_id = task_info.handle.task_id
                     raise RuntimeError(f'incorrect task id: {actual_task_id}, expected: {expected_task_id}')
 
-                # always clear correctly saved task_info attribute on exit
-                delattr(_thread_locals, CURRENT_TASK_INFO_ATTR_NAME)
+                # always clear correctly saved task_info variable and the task cache on exit
+                task_info.cache.clear()
+                current_task_info_var.set(None)
 
         return wrapper
 
@@ -206,17 +211,3 @@ def managed_task(_func: callable = None):
     else:
         return decorator(_func)
 
-
-# official pattern to extend log records: https://docs.python.org/3/library/logging.html#logging.LogRecord
-__old_log_record_factory = logging.getLogRecordFactory()
-
-
-def record_with_task_id_factory(*args, **kwargs):
-    """Adds task_id attribute to every log record. If no task_id - sets attribute to empty string."""
-    record = __old_log_record_factory(*args, **kwargs)
-    task_info: TaskInfo = getattr(_thread_locals, CURRENT_TASK_INFO_ATTR_NAME, None)
-    record.task_id = task_info.handle.task_id if task_info else ''
-    return record
-
-
-logging.setLogRecordFactory(record_with_task_id_factory)
@@ -3,7 +3,8 @@ from django import template
 from django.template.defaultfilters import stringfilter
 
 # local imports
-from helpers.misc import exception_descr, compact_debug_info
+from helpers.misc import exception_descr, compact_debug_info_cached
+from helpers.dba import ATTRIBUTE_NAME_DEBUG_INFO, ATTRIBUTE_SUFFIX_COMPACT, ATTRIBUTE_SUFFIX_MINIMIZED
 
 register = template.Library()
 log = logging.getLogger(__name__)
@@ -12,9 +13,9 @@ log = logging.getLogger(__name__)
 @register.filter
 @stringfilter
 def debug_info_compact(value):
-    """Compact debug info using misc.compact_debug_info."""
+    """Compact debug info using misc.compact_debug_info, memoized."""
     try:
-        return compact_debug_info(value)
+        return compact_debug_info_cached(value)
     except Exception as ex:
         return exception_descr(ex)
 
@@ -22,8 +23,34 @@ def debug_info_compact(value):
 @register.filter
 @stringfilter
 def debug_info_minimize(value):
-    """Compact debug info using misc.compact_debug_info with removing all protected attributes."""
+    """Compact debug info using misc.compact_debug_info with removing all protected attributes, memoized."""
     try:
-        return compact_debug_info(value, remove_protected=True)
+        return compact_debug_info_cached(value, remove_protected=True)
     except Exception as ex:
         return exception_descr(ex)
+
+
+def _stored_or_compacted(entity, attr_name: str, suffix: str, remove_protected: bool) -> str:
+    stored = getattr(entity, f'{attr_name}{suffix}', None)
+    if stored:
+        return stored
+    try:
+        return compact_debug_info_cached(getattr(entity, attr_name) or '', remove_protected=remove_protected)
+    except Exception as ex:
+        return exception_descr(ex)
+
+
+@register.filter
+def entity_debug_info_compact(entity, attr_name: str = ATTRIBUTE_NAME_DEBUG_INFO):
+    """
+    Compacted debug info of the entity: precomputed by dba.save_debug_info into attr_name + '_compact' attribute,
+    so listings do no parsing, or compacted by debug_info_compact if the attribute is absent or empty.
+    Usage: {{ order|entity_debug_info_compact }}, {{ order|entity_debug_info_compact:"request_info" }}
+    """
+    return _stored_or_compacted(entity, attr_name, ATTRIBUTE_SUFFIX_COMPACT, remove_protected=False)
+
+
+@register.filter
+def entity_debug_info_minimized(entity, attr_name: str = ATTRIBUTE_NAME_DEBUG_INFO):
+    """Minimized debug info of the entity, precomputed into attr_name + '_minimized', see entity_debug_info_compact."""
+    return _stored_or_compacted(entity, attr_name, ATTRIBUTE_SUFFIX_MINIMIZED, remove_protected=True)
@@ -1,18 +1,102 @@
+import io
+import os
+import shutil
+import random
+import asyncio
+import logging
 import datetime
 import decimal
+import threading
+import tempfile
+import gzip
+import dataclasses
+from unittest import mock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from decimal import Decimal
-from django.test import TransactionTestCase
+from django.test import TransactionTestCase, RequestFactory, override_settings
+from django.contrib.auth.models import User
+from django.utils.functional import SimpleLazyObject
+from sqlalchemy import create_engine, select, func, Text, Numeric
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, sessionmaker
 
 # library imports
 from .dateutils import date_range, strip_time, local_now_tz_aware, month_first_day, month_last_day
 from .dateutils import prev_month_first_day, prev_month_last_day, next_month_first_day, next_month_last_day
 from .semaphore import Semaphore, SemaphoreLockedException, semaphore_wait
 from .decimal import dec_round_down, dec_round_up
-from .misc import iter_blocks, in_memory_csv
+from .misc import iter_blocks, map_blocks, in_memory_csv, iter_csv, iter_queryset_csv
+from .misc import http_request, get_http_session, http_request_many
+from .misc import json_dumps, json_dumps_bytes, json_loads, jsonpickle_dumps, compact_debug_info
+from .misc import JsonBackend, SimplejsonBackend, json_backend, json_backend_register, json_backend_select
+from .misc import compact_debug_info_cached, _compact_pickled_data, todict, todict_register, frozen_slots
+from .benchmarks import _compact_corpus, _legacy_compact_pickled_data
+from .retry import retry, retry_callable, RetryBudget, ManualClock, ExponentialBackoff, DecorrelatedJitterBackoff
+from .retry import FullJitterBackoff, async_retry_callable
+from .circuit import CircuitBreaker, CircuitOpenException, CIRCUIT_OPEN, CIRCUIT_HALF_OPEN, CIRCUIT_CLOSED
+from .models import TaskHandle
+from .archive import archive_task_handles
+from .httpcache import HttpCache
+from .debuginfo import DebugInfoSerializer
+from .templatetags import debug_info_filters
+from . import dba
+from .addresses import AddressTypeNormalizer, ADDRESS_EXPAND, abbreviate_address, expand_address, name_variants
+from .current_request import SetCurrentRequest, AsyncCurrentRequestMiddleware, get_current_request
+from .current_request import request_cache, request_cached
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    """
+    Local stand-in HTTP server: /status/<code>/<n> responds with <code> to the first n requests, then 200;
+    /etag/... responds with ETag and supports If-None-Match; /cookie/... sets cookie and responds with Cookie header.
+    """
+    protocol_version = 'HTTP/1.1'
+    counters = {}
+
+    def do_GET(self):
+        status = 200
+        if self.path.startswith('/status/'):
+            code, times = self.path.split('/')[2:4]
+            count = self.counters[self.path] = self.counters.get(self.path, 0) + 1
+            status = int(code) if count <= int(times) else 200
+        body = self.path.encode()
+        if self.path.startswith('/cookie/'):
+            body = (self.headers.get('Cookie') or '').encode()
+        if self.path.startswith('/etag/'):
+            if self.headers.get('If-None-Match') == '"v1"':
+                status, body = 304, b''
+            self.counters[self.path] = self.counters.get(self.path, 0) + 1
+        self.send_response(status)
+        if self.path.startswith('/cookie/'):
+            self.send_header('Set-Cookie', 'sid=secret; Path=/')
+        if self.path.startswith('/etag/'):
+            self.send_header('ETag', '"v1"')
+        if self.path.startswith('/etag/vary'):
+            self.send_header('Vary', 'Accept-Language')
+        if self.path.startswith('/etag/cache-control/'):
+            self.send_header('Cache-Control', f'{self.path.split("/")[3]}, max-age=60')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
 
 
 class HelpersTests(TransactionTestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.http_server = ThreadingHTTPServer(('127.0.0.1', 0), _StandInHandler)
+        cls.http_url = f'http://127.0.0.1:{cls.http_server.server_port}'
+        threading.Thread(target=cls.http_server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.http_server.shutdown()
+        cls.http_server.server_close()
+        super().tearDownClass()
+
     def test_decimal(self):
         prec = decimal.getcontext().prec
         a = Decimal(f'3.{"3"*(prec-1)}')
@@ -104,6 +188,645 @@ class HelpersTests(TransactionTestCase):
         blocks = list(iter_blocks(list(range(25)), 10))
         self.assertEqual(len(blocks), 3)
         self.assertEqual(blocks[-1], [20, 21, 22, 23, 24])
+        self.assertEqual(list(iter_blocks((x for x in range(5)), 2)), [[0, 1], [2, 3], [4]])
+        data = bytearray(b'abcde')
+        views = list(iter_blocks(data, 2, zero_copy=True))
+        data[0:1] = b'A'
+        self.assertEqual([bytes(x) for x in views], [b'Ab', b'cd', b'e'])
+        sums = list(map_blocks(sum, iter(range(100)), 10, workers=3))
+        self.assertEqual(sums, [sum(range(x, x + 10)) for x in range(0, 100, 10)])
+        self.assertEqual(sorted(map_blocks(len, range(25), 10, ordered=False)), [5, 10, 10])
 
         mem_csv = in_memory_csv((1, 2, 3), headers=('one', 'two', 'three'), values=lambda x: (x, x**2, x**3))
         self.assertEqual(mem_csv.read().splitlines(), ['one,two,three', '1,1,1', '2,4,8', '3,9,27'])
+        chunks = list(iter_csv(range(1000), headers=('one', 'two'), values=lambda x: (x, x**2), chunk_size=100))
+        self.assertGreater(len(chunks), 10)
+        mem_csv = in_memory_csv(range(1000), headers=('one', 'two'), values=lambda x: (x, x**2))
+        self.assertEqual(b''.join(chunks).decode(), mem_csv.read())
+        gzipped = iter_csv(range(1000), headers=('one', 'two'), values=lambda x: (x, x**2), gzip=True, delimiter=';')
+        self.assertEqual(gzip.decompress(b''.join(gzipped)), b''.join(chunks).replace(b',', b';'))
+        for encoding in ('utf-8-sig', 'utf-16'):
+            encoded = b''.join(iter_csv(range(2000), ('n',), lambda x: (x,), chunk_size=1024, encoding=encoding))
+            self.assertEqual(encoded.decode(encoding).splitlines(), ['n'] + [str(x) for x in range(2000)])
+        User.objects.create(username='csv1', email='csv1@example.com')
+        rows = iter_queryset_csv(User.objects.order_by('id'), ('username', 'email'), iterator_chunk_size=1)
+        csv_data = b''.join(rows)
+        self.assertEqual(csv_data.decode().splitlines(), ['username,email', 'csv1,csv1@example.com'])
+
+    def test_archive_task_handles(self):
+        from django_q.models import Task, OrmQ
+
+        old = local_now_tz_aware() - datetime.timedelta(days=10)
+        first = TaskHandle.objects.create(task_id='a1', max_tries=2)
+        second = TaskHandle.objects.create(task_id='a2', prev=first, max_tries=2, try_num=2)
+        first.next = second
+        first.save()
+        queued = OrmQ.objects.create(key='test', payload='')
+        unfinished = TaskHandle.objects.create(task_id='b1', ormq_id=queued.id)
+        TaskHandle.objects.create(task_id='c1', ormq_id=queued.id + 1)  # Task record pruned by Django-Q
+        not_started = TaskHandle.objects.create(task_id='d1')  # other broker or not picked by a worker yet
+        TaskHandle.objects.update(created_at=old)
+        Task.objects.create(id='a2', name='a2', func='f', started=old, stopped=old, success=True)
+
+        self.assertEqual(TaskHandle.get(first.id), first)
+        self.assertEqual(TaskHandle.get('a2'), second)
+        self.assertIsNone(TaskHandle.get('missing'))
+
+        self.assertEqual(archive_task_handles(older_than_days=5, chunk_size=1, pruned_grace_days=20), 2)
+        self.assertEqual(archive_task_handles(older_than_days=5, chunk_size=1), 1)
+        self.assertEqual(list(TaskHandle.objects.order_by('id')), [unfinished, not_started])
+
+    def test_current_request_context(self):
+        factory = RequestFactory()
+
+        async def view(request):
+            await asyncio.sleep(0.01)
+            return get_current_request() is request
+
+        async def main():
+            middleware = AsyncCurrentRequestMiddleware(view)
+            return await asyncio.gather(*[middleware(factory.get(f'/{x}')) for x in range(5)])
+
+        self.assertEqual(asyncio.run(main()), [True] * 5)
+
+        request = factory.get('/user')
+        request.user = User(username='tester')
+        with SetCurrentRequest(request):
+            record = logging.getLogger(__name__).makeRecord(__name__, logging.INFO, __file__, 0, 'msg', (), None)
+        self.assertEqual(logging.Formatter('%(username)s').format(record), 'tester')
+        self.assertEqual(record.task_id, '')
+
+        request = factory.get('/lazy')
+        request.user = SimpleLazyObject(mock.Mock(side_effect=AssertionError('user loaded by log formatting')))
+        with SetCurrentRequest(request):
+            record = logging.getLogger(__name__).makeRecord(__name__, logging.INFO, __file__, 0, 'msg', (), None)
+        self.assertEqual(logging.Formatter('%(username)s').format(record), '?')  # not loaded by the request
+        request._cached_user = User(username='loaded')
+        self.assertEqual(logging.Formatter('%(username)s').format(record), 'loaded')
+        self.assertIsNone(get_current_request())
+
+        outer, inner = factory.get('/outer'), factory.get('/inner')
+        with SetCurrentRequest(outer):
+            with SetCurrentRequest(inner):
+                self.assertIs(get_current_request(), inner)
+            self.assertIs(get_current_request(), outer)
+        self.assertIsNone(get_current_request())
+
+    def test_request_cache(self):
+        calls = []
+
+        @request_cached
+        def square(x):
+            calls.append(x)
+            return x * x if isinstance(x, int) else x * 2
+
+        self.assertEqual([square(2), square(2)], [4, 4])
+        self.assertEqual(len(calls), 2)  # no caching outside of request
+        self.assertIsNone(request_cache())
+
+        with SetCurrentRequest(RequestFactory().get('/')):
+            self.assertEqual([square(2), square(2), square(3), square([1])], [4, 4, 9, [1, 1]])
+            self.assertEqual(calls, [2, 2, 2, 3, [1]])
+            self.assertEqual((request_cache().hits, request_cache().misses), (1, 2))
+
+        with SetCurrentRequest(RequestFactory().get('/')):
+            self.assertEqual(square(2), 4)
+            self.assertEqual(request_cache().misses, 1)
+
+        def make_multiplier(factor):
+            @request_cached
+            def multiply(x):
+                return x * factor
+            return multiply
+
+        with SetCurrentRequest(RequestFactory().get('/')):
+            self.assertEqual([make_multiplier(2)(5), make_multiplier(3)(5)], [10, 15])  # same __qualname__
+
+    def test_async_retry(self):
+        calls = []
+
+        @retry(exceptions=ValueError, tries=3, random_pause=0.01)
+        async def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise ValueError('not yet')
+            return len(calls)
+
+        self.assertEqual(asyncio.run(flaky()), 3)
+
+        @retry(timeout=60, random_pause=0.01, deadline=0.1)
+        async def failing():
+            raise ValueError('always')
+
+        self.assertRaises(TimeoutError, lambda: asyncio.run(failing()))
+
+    def test_circuit_breaker(self):
+        now = [0.0]
+        circuit = CircuitBreaker('test', min_calls=4, reset_timeout=10, shared=True, clock=lambda: now[0])
+
+        def failing():
+            raise ConnectionError('down')
+
+        self.assertRaises(ConnectionError, lambda: retry_callable(failing, tries=4, circuit=circuit))
+        self.assertEqual(circuit.state, CIRCUIT_OPEN)
+        self.assertRaises(CircuitOpenException, lambda: retry_callable(lambda: 1, tries=4, circuit=circuit))
+        self.assertEqual(circuit.rejected, 1)
+
+        other = CircuitBreaker('test', shared=True, clock=lambda: now[0])
+        self.assertEqual(other.state, CIRCUIT_OPEN)  # state shared via database
+
+        now[0] = 11.0
+        self.assertEqual(circuit.state, CIRCUIT_HALF_OPEN)
+        self.assertEqual(retry_callable(lambda: 1, tries=4, circuit=circuit), 1)
+        self.assertEqual(circuit.state, CIRCUIT_CLOSED)
+
+    def test_circuit_breaker_async(self):
+        circuit = CircuitBreaker('test-async', min_calls=2, shared=True)
+
+        async def failing():
+            raise ConnectionError('down')
+
+        async def main():
+            with self.assertRaises(ConnectionError):
+                await async_retry_callable(failing, tries=2, circuit=circuit)
+            with self.assertRaises(CircuitOpenException):
+                await async_retry_callable(failing, tries=2, circuit=circuit)
+
+        asyncio.run(main())
+        self.assertEqual(CircuitBreaker('test-async', shared=True).state, CIRCUIT_OPEN)
+
+    def test_retry_budget(self):
+        for shared in (False, True):
+            budget = RetryBudget(f'test-{shared}', ratio=0.5, min_per_second=0, shared=shared)
+            calls = []
+
+            def flaky():
+                calls.append(1)
+                if len(calls) % 2:
+                    raise ConnectionError('flaky')
+                return len(calls)
+
+            self.assertRaises(ConnectionError, lambda: retry_callable(flaky, tries=5, budget=budget))
+            for _ in range(2):
+                retry_callable(lambda: 1, tries=5, budget=budget)
+            calls.clear()
+            self.assertEqual(retry_callable(flaky, tries=5, budget=budget), 2)
+            self.assertEqual((budget.deposits, budget.retries, budget.rejected), (3, 1, 1))
+
+        budget = RetryBudget('test-partial', ratio=0.75, min_per_second=0, shared=True)
+        budget.deposit()
+        budget.deposit()
+        self.assertTrue(budget.try_withdraw())
+        self.assertFalse(budget.try_withdraw())
+        self.assertEqual(budget._cache().get(budget._cache_key), 500)  # partial balance kept
+
+        budget = RetryBudget('test-async', ratio=0.5, min_per_second=0, shared=True)
+        cache = budget._cache()
+
+        def _cache_off_loop():
+            self.assertRaises(RuntimeError, asyncio.get_running_loop)  # shared budget must not block the event loop
+            return cache
+
+        async def succeeding():
+            return 1
+
+        async def failing_once():
+            calls.append(1)
+            if len(calls) == 1:
+                raise ConnectionError('flaky')
+            return 2
+
+        async def main():
+            for _ in range(2):
+                await async_retry_callable(succeeding, tries=2, budget=budget)
+            return await async_retry_callable(failing_once, tries=2, budget=budget)
+
+        calls.clear()
+        with mock.patch.object(budget, '_cache', _cache_off_loop):
+            self.assertEqual(asyncio.run(main()), 2)
+        self.assertEqual((budget.deposits, budget.retries, budget.rejected), (3, 1, 0))
+
+    def test_retry_backoff(self):
+        def failing():
+            raise ConnectionError('down')
+
+        self.assertEqual(ExponentialBackoff(0.1, max_pause=30).pause(1100, None), 30)
+        self.assertLessEqual(FullJitterBackoff(0.1, max_pause=30, rng=random.Random(1)).pause(5000, None), 30)
+
+        clock = ManualClock()
+        backoff = ExponentialBackoff(1, max_pause=10)
+        self.assertRaises(ConnectionError, lambda: retry_callable(
+            failing, timeout=30, backoff=backoff, clock=clock.monotonic, sleep=clock.sleep
+        ))
+        self.assertEqual(clock.sleeps, [1, 2, 4, 8, 10, 10])
+
+        clock = ManualClock()
+        backoff = DecorrelatedJitterBackoff(1, max_pause=5)
+        self.assertRaises(ConnectionError, lambda: retry_callable(
+            failing, tries=20, backoff=backoff, clock=clock.monotonic, sleep=clock.sleep
+        ))
+        self.assertEqual(len(clock.sleeps), 19)
+        self.assertTrue(all(1 <= x <= 5 for x in clock.sleeps))
+
+    def test_http_request(self):
+        resp = http_request('GET', f'{self.http_url}/status/503/2', retries=2)
+        self.assertEqual(resp.content, b'/status/503/2')
+        self.assertRaises(RuntimeError, lambda: http_request('GET', f'{self.http_url}/status/404/1'))
+        self.assertEqual(http_request('GET', f'{self.http_url}/status/404/1', ok_statuses=(200, 404)).status_code, 200)
+        self.assertIs(get_http_session(f'{self.http_url}/a'), get_http_session(f'{self.http_url}/b'))
+        with mock.patch('helpers.misc.HTTP_SESSIONS_MAX', 2):
+            sessions = [get_http_session(f'http://host{x}.test/') for x in range(3)]
+            self.assertIsNot(get_http_session('http://host0.test/'), sessions[0])  # evicted as least recently used
+            self.assertIs(get_http_session('http://host2.test/'), sessions[2])
+
+        resp = http_request('GET', f'{self.http_url}/cookie/1')
+        self.assertEqual(resp.cookies.get('sid'), 'secret')
+        self.assertEqual(http_request('GET', f'{self.http_url}/cookie/2').content, b'')  # not sent by shared session
+        self.assertEqual(http_request('GET', f'{self.http_url}/cookie/3', cookies={'a': 'b'}).content, b'a=b')
+
+    def test_http_request_many(self):
+        urls = [('GET', f'{self.http_url}/item/{x}') for x in range(50)] + [('GET', f'{self.http_url}/status/404/99')]
+        results = dict(http_request_many(iter(urls), concurrency=8, per_host=3, rate=500))
+        self.assertEqual(len(results), 51)
+        self.assertEqual(results[7].content, b'/item/7')
+        self.assertIsInstance(results[50], RuntimeError)
+
+        # throttled host does not hold workers: the other host is served while the first waits for its rate
+        other_url = self.http_url.replace('127.0.0.1', 'localhost')
+        urls = [('GET', f'{self.http_url}/item/{x}') for x in range(4)] + [('GET', f'{other_url}/item/other')]
+        order = [index for index, _ in http_request_many(urls, concurrency=2, rate=5)]
+        self.assertLess(order.index(4), 2)
+
+    def test_http_cache(self):
+        url = f'{self.http_url}/etag/x'
+        with tempfile.TemporaryDirectory() as directory:
+            cache = HttpCache(directory, ttl=60)
+            for _ in range(3):
+                self.assertEqual(http_request('GET', url, cache=cache).content, b'/etag/x')
+            self.assertEqual((cache.misses, cache.hits, _StandInHandler.counters[url[len(self.http_url):]]), (1, 2, 1))
+
+            cache = HttpCache(directory, ttl=0)  # reloaded from disk, always stale
+            resp = http_request('GET', url, cache=cache)
+            self.assertEqual((resp.status_code, resp.content, cache.revalidations), (200, b'/etag/x', 1))
+
+            for body_dir in os.scandir(os.path.join(directory, 'bodies')):
+                shutil.rmtree(body_dir.path)
+            resp = http_request('GET', url, cache=cache)  # 304 without cached body: repeated unconditionally
+            self.assertEqual((resp.status_code, resp.content, cache.revalidations), (200, b'/etag/x', 1))
+
+            cache = HttpCache(directory, ttl=60)
+            for headers in ({'Authorization': 'a'}, {'Authorization': 'b'}, {'Authorization': 'a'}):
+                http_request('GET', url, cache=cache, headers=headers)
+            self.assertEqual((cache.misses, cache.hits), (2, 1))
+            url = f'{self.http_url}/etag/vary'
+            for language in ('en', 'en', 'ru'):  # single variant kept per URL, other variants are not served
+                http_request('GET', url, cache=cache, headers={'Accept-Language': language})
+            self.assertEqual((cache.misses, cache.hits), (4, 2))
+
+            cache = HttpCache(directory, ttl=60)
+            stored = len(cache._entries)
+            for directive in ('no-store', 'private'):
+                for _ in range(2):
+                    http_request('GET', f'{self.http_url}/etag/cache-control/{directive}', cache=cache)
+            self.assertEqual((cache.misses, cache.hits, len(cache._entries)), (4, 0, stored))
+            for _ in range(2):  # stored, but always revalidated
+                http_request('GET', f'{self.http_url}/etag/cache-control/no-cache', cache=cache)
+            self.assertEqual((cache.misses, cache.hits, cache.revalidations), (5, 0, 1))
+
+    def test_json(self):
+        data = {'price': Decimal('10.10'), 'at': datetime.datetime(2024, 1, 2, 3, 4, 5), 'name': 'имя', 1: [None]}
+        compact = json_dumps_bytes(data)
+        self.assertEqual(compact, '{"price":10.10,"at":"2024-01-02T03:04:05","name":"имя","1":[null]}'.encode())
+        self.assertEqual(json_dumps(data, compact=True), compact.decode())
+        self.assertEqual(json_loads(compact)['price'], Decimal('10.10'))
+        self.assertEqual(json_loads(json_dumps(data)), json_loads(compact))
+
+        try:
+            json_backend_select('simplejson')
+            self.assertEqual(json_dumps_bytes(data), compact)
+            self.assertEqual(json_loads(json_dumps(data)), json_loads(compact))
+            self.assertIsInstance(json_loads(compact, use_decimal=False)['price'], float)
+            json_backend_register('test', mock.Mock(spec=JsonBackend, **{'loads.return_value': 'mocked'}))
+            json_backend_select('test')
+            self.assertEqual(json_loads(compact), 'mocked')
+            self.assertRaises(ValueError, json_backend_select, 'missing')
+        finally:
+            json_backend_select(None)
+        with override_settings(JSON_BACKEND='simplejson'):
+            self.assertIsInstance(json_backend(), SimplejsonBackend)  # selected by settings on first use
+        json_backend_select(None)
+
+    def test_debug_info_serializer(self):
+        info = {'price': Decimal('1.10'), 'at': datetime.date(2024, 1, 2), 'items': list(range(5)), '_p': (1, 2)}
+        full, compacted = DebugInfoSerializer(max_depth=None, max_items=None, max_bytes=None).dumps_with_compact(info)
+        self.assertEqual(full, jsonpickle_dumps(info))
+        self.assertEqual(compacted, compact_debug_info(full))
+        self.assertEqual(compact_debug_info_cached(full), compacted)
+        self.assertIs(compact_debug_info_cached(full), compact_debug_info_cached(full))
+        self.assertNotEqual(compact_debug_info_cached(full, remove_protected=True), compacted)
+
+        serializer = DebugInfoSerializer(max_items=3, max_bytes=40)
+        data = json_loads(serializer.dumps({'b': list(range(10)), 'z': 'x' * 100, 'zz': None}))
+        self.assertEqual(data['b'], [0, 1, 2, '... 7 more items truncated'])
+        self.assertEqual(data['z'], 'x' * 16 + '... [84 more chars truncated]')
+        self.assertEqual(data['...'], '1 more keys truncated')
+
+        walked = []
+
+        class Item:
+            def __init__(self, num):
+                self.num = num
+
+            def __getstate__(self):
+                walked.append(self.num)
+                return {'num': self.num}
+
+        data = DebugInfoSerializer(max_items=5, max_bytes=None).flatten({'items': [Item(x) for x in range(100000)]})
+        self.assertEqual(data['items'][-1], '... 99995 more items truncated')
+        self.assertEqual(len(walked), 5)  # dropped items are not flattened at all
+        walked.clear()
+        data = DebugInfoSerializer(max_items=None, max_bytes=200).flatten([Item(x) for x in range(100000)])
+        self.assertLess(len(walked), 30)
+        self.assertRegex(data[-1], r'^\.\.\. \d+ more items truncated$')
+        buffer = io.StringIO()
+        serializer.write(list(range(10)), buffer)
+        self.assertEqual(json_loads(buffer.getvalue())[-1], '... 7 more items truncated')
+
+    def test_compact_pickled_data(self):
+        corpus = _compact_corpus(objects=20)
+        for remove_protected in (False, True):
+            for data in ([], {}, ['none'], [{'a': 1}], {'a': {'b': 'c'}}, corpus):
+                self.assertEqual(
+                    _compact_pickled_data(data, remove_protected=remove_protected),
+                    _legacy_compact_pickled_data(data, remove_protected=remove_protected)
+                )
+
+        deep = ['x']
+        for num in range(5000):
+            deep = {'num': num, 'next': deep}
+        self.assertEqual(_compact_pickled_data(deep)['num'], 4999)
+
+        compacted = _compact_pickled_data({'a': list(range(100)), 'b': list(range(100))}, max_output=10)
+        self.assertEqual(compacted, {'a': list(range(10)) + ['...'], '...': '...'})
+
+    def test_todict(self):
+        @dataclasses.dataclass(slots=True)
+        class Point:
+            x: int
+            y: int
+            _hidden: int = 0
+
+        class Slotted:
+            __slots__ = ('name', 'points', '_cache')
+
+            def __init__(self):
+                self.name = 'slotted'
+                self.points = (Point(1, 2),)
+
+        class Money:
+            def __init__(self, amount):
+                self.amount = amount
+
+        class Plain:
+            def __init__(self):
+                self.at = datetime.datetime(2024, 1, 2, 3, 4, 5)
+                self.price = Money(Decimal('1.50'))
+                self.nested = {'slotted': Slotted()}
+                self._protected = 1
+                self.method = self.__init__
+
+        todict_register(Money, lambda obj, convert: f'{obj.amount} RUB')
+        self.assertEqual(todict([Plain()], class_key='class'), [{
+            'at': '2024-01-02 03:04:05', 'price': '1.50 RUB', 'class': 'Plain',
+            'nested': {'slotted': {
+                'name': 'slotted', 'points': [{'x': 1, 'y': 2, 'class': 'Point'}], 'class': 'Slotted'
+            }},
+        }])
+
+        shared = [1]
+        self.assertEqual(todict({'a': shared, 'b': shared}), {'a': [1], 'b': [1]})
+        cyclic = {'a': []}
+        cyclic['a'].append(cyclic)
+        with self.assertRaises(ValueError):
+            todict(cyclic)
+
+    def test_addresses(self):
+        self.assertEqual(name_variants('Ж/д остановочный (обгонный) пункт'), [
+            'Ж/д остановочный пункт', 'Ж/д обгонный пункт'
+        ])
+        self.assertEqual(name_variants('Выселки(ок)'), ['Выселки', 'Выселок'])
+        self.assertEqual(
+            abbreviate_address('ВЫСЕЛОК Новый, посёлок при  станции Ёлкино, Переулочная улица'),
+            'Высел Новый, п/ст Ёлкино, Переулочная ул'
+        )
+        self.assertEqual(
+            expand_address('ул.Ленина, пр-кт. Мира, ж/д_оп'), 'Улица Ленина, Проспект Мира, Ж/д остановочный пункт'
+        )
+        normalizer = AddressTypeNormalizer({'Улица': 'ул'}, mode=ADDRESS_EXPAND)
+        self.assertEqual(list(normalizer.normalize_many(iter(['ул Мира', 'улус']))), ['Улица Мира', 'улус'])
+
+    def test_frozen_slots(self):
+        @frozen_slots
+        class Value:
+            code: str
+            qty: int = 0
+
+        value = Value('a')
+        value.qty = 2
+        value.freeze()
+        with self.assertRaises(AttributeError):
+            value.other = 1
+        self.assertRaises(TypeError, value.unfreeze)  # unlike FrozenClass, attributes cannot be added back
+        self.assertEqual((value, hasattr(value, '__dict__')), (Value('a', 2), False))
+
+        @frozen_slots(immutable=True)
+        class Key:
+            code: str
+            qty: int = 0
+
+        key = Key('a', 1)
+        with self.assertRaises(dataclasses.FrozenInstanceError):
+            key.qty = 2
+        key.unfreeze()
+        key.qty = 2
+        key.freeze()
+        with self.assertRaises(dataclasses.FrozenInstanceError):
+            key.qty = 3
+        self.assertEqual(len({key, Key('a', 2)}), 1)
+
+    def test_dba_lazy_engine(self):
+        self.assertNotIn('engine', vars(dba))
+        with override_settings(SQLALCHEMY_ENGINE_OPTIONS={'pool_recycle': 60}):
+            self.assertEqual(dba.derive_sa_engine_options()['pool_recycle'], 60)
+        self.assertIs(dba.engine, dba.get_engine())
+        self.assertIs(dba.Session.kw['bind'], dba.engine)
+
+    def test_debug_info_writer(self):
+        class Base(DeclarativeBase):
+            pass
+
+        class Order(Base):
+            __tablename__ = 'test_order'
+            id: Mapped[int] = mapped_column(primary_key=True)
+            debug_info: Mapped[str] = mapped_column(Text, default='')
+            debug_info_compact: Mapped[str] = mapped_column(Text, default='')
+
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine(f'sqlite:///{directory}/test.sqlite3')
+            Base.metadata.create_all(engine)
+            session_factory = sessionmaker(bind=engine)
+            with session_factory.begin() as s:
+                s.add_all([Order(id=1), Order(id=2)])
+
+            writer = dba.DebugInfoWriter(session_factory=session_factory)
+
+            async def _save(n: int):
+                # superseded saves return only when the latest one is committed
+                await writer.save(Order, 1, {'n': n}, 'debug_info')
+                with session_factory() as s:
+                    return json_loads(s.get(Order, 1).debug_info)
+
+            async def _save_all():
+                return await asyncio.gather(*(_save(n) for n in range(5)),
+                                            writer.save(Order, 2, {'n': 'two'}, 'debug_info'),
+                                            writer.save(Order, 3, {'n': 'missing'}, 'debug_info'))
+
+            self.assertEqual(asyncio.run(_save_all())[:5], [{'n': 4}] * 5)
+            with session_factory() as s:
+                self.assertEqual(json_loads(s.get(Order, 1).debug_info), {'n': 4})
+                self.assertEqual(s.get(Order, 2).debug_info_compact, '"n=two"')
+                order = s.get(Order, 2)
+                with mock.patch.object(debug_info_filters, 'compact_debug_info_cached') as compact:
+                    self.assertEqual(debug_info_filters.entity_debug_info_compact(order), '"n=two"')
+                compact.assert_not_called()  # precomputed column is used, no parsing
+                order.debug_info_compact = ''
+                self.assertEqual(debug_info_filters.entity_debug_info_compact(order), '"n=two"')
+            self.assertEqual(writer.coalesced, 4)
+            self.assertEqual(writer.written, 2)
+            self.assertLess(writer.batches, 7)
+            engine.dispose()
+
+    def test_bulk_helpers(self):
+        class Base(DeclarativeBase):
+            pass
+
+        class Item(Base):
+            __tablename__ = 'test_item'
+            id: Mapped[int] = mapped_column(primary_key=True)
+            code: Mapped[str] = mapped_column('Code', Text, key='code', unique=True)  # like sa_table mirrors
+            price: Mapped[Decimal] = mapped_column(Numeric(12, 2), nullable=True)
+
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine(f'sqlite:///{directory}/test.sqlite3')
+            Base.metadata.create_all(engine)
+            result = dba.bulk_insert(Item, ((x, f'c{x}', Decimal('1.10')) for x in range(2500)), engine=engine)
+            self.assertEqual(result.rows, 2500)
+            self.assertGreater(result.rows_per_second, 0)
+
+            self.assertEqual(dba.bulk_insert(Item, [{'id': 2500, 'code': 'm', 'price': None}], engine=engine).rows, 1)
+
+            rows = [{'code': 'c1', 'price': Decimal('2.20')}, {'code': 'new', 'price': None}]
+            self.assertEqual(dba.bulk_upsert(Item, rows, conflict_keys=['code'], engine=engine).rows, 2)
+            rows = [('c2', Decimal('3.30'))]
+            self.assertEqual(dba.bulk_upsert(
+                Item, rows, conflict_keys=['code'], columns=['code', 'price'], engine=engine
+            ).rows, 1)
+            with sessionmaker(bind=engine)() as s:
+                self.assertEqual(s.scalar(select(func.count()).select_from(Item)), 2502)
+                self.assertEqual(s.scalar(select(Item.price).where(Item.code == 'c1')), Decimal('2.20'))
+                self.assertEqual(s.scalar(select(Item.price).where(Item.code == 'c2')), Decimal('3.30'))
+            engine.dispose()
+
+        from .models import LogEntry
+        with tempfile.TemporaryDirectory() as directory:
+            # Python-side defaults of omitted columns are filled by the raw DB-API path too
+            engine = create_engine(f'sqlite:///{directory}/test.sqlite3')
+            table = dba.sa_table(LogEntry)
+            table.create(engine)
+            rows = [{'name': 'test', 'msg': f'm{x}', 'trace': '', 'task_id': '', 'username': ''} for x in range(3)]
+            self.assertEqual(dba.bulk_insert(LogEntry, rows, engine=engine).rows, 3)
+            with engine.connect() as conn:
+                self.assertEqual(set(conn.scalars(select(table.c.level))), {logging.ERROR})
+                self.assertEqual(conn.scalar(select(func.count()).where(table.c.created_at.is_not(None))), 3)
+            engine.dispose()
+
+        rows = [('a\tb\nc\\d', None, b'\x00\xff', True, Decimal('1.10')), ('', 1, memoryview(b'z'), False, 0)]
+        self.assertEqual(b''.join(dba._iter_copy_text(rows, tuple)), (
+            b'a\\tb\\nc\\\\d\t\\N\t\\\\x00ff\tt\t1.10\n'
+            b'\t1\t\\\\x7a\tf\t0\n'
+        ))
+        with self.assertRaises(TypeError):
+            list(dba._iter_copy_text([(1, [1, 2])], tuple))
+
+    def test_sa_mirrors(self):
+        from .models import LogEntry
+        self.assertEqual(dba.sa_table(LogEntry).c.task_id.type.length, LogEntry._meta.get_field('task_id').max_length)
+        self.assertIs(dba.sa_model(LogEntry), dba.LogEntry)
+        mirror = dba.sa_model(TaskHandle)
+        self.assertIs(dba.sa_model(TaskHandle), mirror)
+        self.assertEqual(mirror.__table__.c.prev_id.foreign_keys.pop().target_fullname, 'helpers_taskhandle.id')
+
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine(f'sqlite:///{directory}/test.sqlite3')
+            dba.Base.metadata.create_all(engine, tables=[mirror.__table__, dba.LogEntry.__table__])
+            self.assertEqual(dba.verify_sa_mirror(TaskHandle, engine), [])
+            with self.assertLogs('helpers.dba', level=logging.WARNING):
+                self.assertEqual(dba.verify_sa_mirror(User, engine), ['table "auth_user" not found'])
+            with engine.begin() as connection:
+                connection.exec_driver_sql('DROP TABLE helpers_logentry')
+                connection.exec_driver_sql(
+                    'CREATE TABLE helpers_logentry (id integer PRIMARY KEY, name varchar(100) NOT NULL, '
+                    'level smallint NOT NULL, msg text NOT NULL, trace text NOT NULL, task_id varchar(12) NOT NULL, '
+                    'created_at datetime NOT NULL, extra integer NOT NULL)'
+                )
+            with self.assertLogs('helpers.dba', level=logging.WARNING):
+                problems = dba.verify_sa_mirror(LogEntry, engine)
+            self.assertEqual(problems, [
+                'column "helpers_logentry.task_id" length is 12, mirror: 32',
+                'column "helpers_logentry.username" not found',
+                'column "helpers_logentry.extra" is not mirrored and has no default',
+            ])
+
+            with sessionmaker(bind=engine).begin() as s:
+                s.add(mirror(task_id='t1'))
+            rows = [{'id': 1, 'task_id': 't1', 'max_tries': 2}, {'id': 2, 'task_id': 't2', 'max_tries': 3}]
+            self.assertEqual(dba.bulk_upsert(TaskHandle, rows, conflict_keys=['id'], engine=engine).rows, 2)
+            with sessionmaker(bind=engine)() as s:
+                self.assertEqual(s.scalars(select(mirror.max_tries).order_by(mirror.id)).all(), [2, 3])
+            engine.dispose()
+
+    def test_stream_query(self):
+        class Base(DeclarativeBase):
+            pass
+
+        class Item(Base):
+            __tablename__ = 'test_item'
+            id: Mapped[int] = mapped_column(primary_key=True)
+            code: Mapped[str] = mapped_column(Text)
+            price: Mapped[Decimal] = mapped_column(Numeric(12, 2))
+
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine(f'sqlite:///{directory}/test.sqlite3')
+            Base.metadata.create_all(engine)
+            dba.bulk_insert(Item, ((x, f'c{x % 7}', Decimal(x) / 4) for x in range(2500)), engine=engine)
+
+            batches = list(dba.stream_query(select(Item.__table__), batch_size=1000, engine=engine))
+            self.assertEqual([len(x) for x in batches], [1000, 1000, 500])
+            self.assertEqual(batches[2][-1], (2499, 'c0', Decimal('624.75')))
+
+            stmt = select(Item.code, Item.price)
+            batches = list(dba.stream_query(stmt, 999, keys=[Item.code, Item.id], columns=True, engine=engine))
+            self.assertEqual([len(x['code']) for x in batches], [999, 999, 502])
+            self.assertEqual(batches[0]['code'][:2], ['c0', 'c0'])
+            self.assertEqual(batches[0]['price'][:2], [Decimal(0), Decimal('1.75')])
+            with self.assertRaises(ValueError):
+                next(dba.stream_query(select(select(Item.code).distinct().subquery()), engine=engine))
+
+            stmt = select(Item.id, Item.price).where(Item.id < 3)
+            csv_data = b''.join(dba.iter_query_csv(stmt, batch_size=2, engine=engine))
+            self.assertEqual(csv_data, b'id,price\r\n0,0.00\r\n1,0.25\r\n2,0.50\r\n')
+            jsonl = gzip.decompress(b''.join(dba.iter_query_jsonl(stmt, batch_size=2, engine=engine, gzip=True)))
+            self.assertEqual([json_loads(x) for x in jsonl.splitlines()], [
+                {'id': 0, 'price': Decimal(0)}, {'id': 1, 'price': Decimal('0.25')}, {'id': 2, 'price': Decimal('0.5')}
+            ])
+            engine.dispose()